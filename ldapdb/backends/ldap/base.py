@@ -30,12 +30,29 @@
 # POSSIBILITY OF SUCH DAMAGE.
 #
 
+import collections
 import ldap
+import logging
 import django
 
+from contextlib import contextmanager
+from ldap.controls import SimplePagedResultsControl
+
 from django.db.backends import (BaseDatabaseFeatures, BaseDatabaseOperations,
                                 BaseDatabaseWrapper)
 from django.db.backends.creation import BaseDatabaseCreation
+from django.utils.functional import cached_property
+
+from ldapdb.backends.ldap.pool import get_pool
+
+try:
+    # python-ldap >= 2.4.21
+    from ldap.controls.sss import SSSRequestControl
+except ImportError:
+    SSSRequestControl = None
+
+
+logger = logging.getLogger('ldapdb')
 
 
 class DatabaseCreation(BaseDatabaseCreation):
@@ -64,6 +81,19 @@ class DatabaseFeatures(BaseDatabaseFeatures):
         self.connection = connection
         self.supports_transactions = False
 
+    @cached_property
+    def supports_server_side_sort(self):
+        """
+        Whether the server advertises the Server Side Sorting control
+        (RFC 2891). It can be turned off with the SERVER_SIDE_SORT setting.
+        """
+        settings_dict = self.connection.settings_dict
+        if SSSRequestControl is None or \
+                not settings_dict.get('SERVER_SIDE_SORT', True):
+            return False
+        return SSSRequestControl.controlType in \
+            self.connection.supported_controls()
+
 
 class DatabaseOperations(BaseDatabaseOperations):
     compiler_module = "ldapdb.backends.ldap.compiler"
@@ -91,60 +121,294 @@ class DatabaseWrapper(BaseDatabaseWrapper):
         if hasattr(self, 'validate_thread_sharing'):
             # django >= 1.4
             self.validate_thread_sharing()
-        if self.connection is not None:
-            self.connection.unbind_s()
-            self.connection = None
 
     def ensure_connection(self):
-        if self.connection is None:
-            self.connection = ldap.initialize(self.settings_dict['NAME'])
-
-            options = self.settings_dict.get('CONNECTION_OPTIONS', {})
-            for opt, value in options.items():
-                self.connection.set_option(opt, value)
+        # connections are checked out of the pool for each operation
+        pass
 
-            if self.settings_dict.get('TLS', False):
-                self.connection.start_tls_s()
+    @property
+    def pool(self):
+        return get_pool(self.alias, self.settings_dict)
 
-            self.connection.simple_bind_s(
-                self.settings_dict['USER'],
-                self.settings_dict['PASSWORD'])
+    def pool_stats(self):
+        """
+        Returns the usage statistics of the connection pool.
+        """
+        return self.pool.stats()
 
     def _commit(self):
         pass
 
+    @contextmanager
     def _cursor(self):
-        self.ensure_connection()
-        return DatabaseCursor(self.connection)
+        with self.pool.connection() as connection:
+            yield DatabaseCursor(connection)
 
     def _rollback(self):
         pass
 
     def add_s(self, dn, modlist):
-        cursor = self._cursor()
-        return cursor.connection.add_s(dn.encode(self.charset), modlist)
+        with self._cursor() as cursor:
+            return cursor.connection.add_s(dn.encode(self.charset), modlist)
 
     def delete_s(self, dn):
-        cursor = self._cursor()
-        return cursor.connection.delete_s(dn.encode(self.charset))
+        with self._cursor() as cursor:
+            return cursor.connection.delete_s(dn.encode(self.charset))
 
     def modify_s(self, dn, modlist):
-        cursor = self._cursor()
-        return cursor.connection.modify_s(dn.encode(self.charset), modlist)
+        with self._cursor() as cursor:
+            return cursor.connection.modify_s(dn.encode(self.charset),
+                                              modlist)
 
     def rename_s(self, dn, newrdn):
-        cursor = self._cursor()
-        return cursor.connection.rename_s(dn.encode(self.charset),
-                                          newrdn.encode(self.charset))
+        with self._cursor() as cursor:
+            return cursor.connection.rename_s(dn.encode(self.charset),
+                                              newrdn.encode(self.charset))
 
     def search_s(self, base, scope, filterstr='(objectClass=*)',
                  attrlist=None):
-        cursor = self._cursor()
-        results = cursor.connection.search_s(base, scope,
-                                             filterstr.encode(self.charset),
-                                             attrlist)
-        output = []
-        for dn, attrs in results:
-            if dn is not None:
-                output.append((dn.decode(self.charset), attrs))
+        return list(self.search_iter(base, scope, filterstr=filterstr,
+                                     attrlist=attrlist))
+
+    def count_s(self, base, scope, filterstr='(objectClass=*)'):
+        """
+        Returns the number of entries matching the search.
+
+        No attributes are requested and the entries are counted as they
+        arrive, so memory use does not depend on the size of the result.
+        As the entries are empty, paged searches may use a larger
+        COUNT_PAGE_SIZE to save round trips.
+        """
+        count = 0
+        page_size = self.settings_dict.get('COUNT_PAGE_SIZE')
+        for entry in self.search_iter(base, scope, filterstr=filterstr,
+                                      attrlist=['1.1'], attrsonly=1,
+                                      page_size=page_size):
+            count += 1
+        return count
+
+    def get_many_s(self, dns, filterstr='(objectClass=*)', attrlist=None):
+        """
+        Fetches the entries with the given Distinguished Names.
+
+        The base searches are pipelined on a single connection, with at
+        most PIPELINE_WINDOW (default 64) requests in flight, so fetching
+        many entries costs little more than a single round trip. Results
+        are collected in request order, which lets failures be matched to
+        their DN.
+
+        Returns a dictionary mapping each requested DN to a (dn, attrs)
+        tuple. Entries which do not exist or do not match filterstr are
+        left out.
+        """
+        window = self.settings_dict.get('PIPELINE_WINDOW', 64)
+        filterstr = filterstr.encode(self.charset)
+        output = {}
+        with self._cursor() as cursor:
+            connection = cursor.connection
+            pending = collections.deque()
+            dns = iter(dns)
+            exhausted = False
+            while True:
+                while not exhausted and len(pending) < window:
+                    try:
+                        dn = next(dns)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    msgid = connection.search_ext(dn.encode(self.charset),
+                                                  ldap.SCOPE_BASE, filterstr,
+                                                  attrlist)
+                    pending.append((msgid, dn))
+                if not pending:
+                    break
+
+                msgid, dn = pending.popleft()
+                try:
+                    rtype, rdata, rmsgid, rctrls = connection.result3(msgid)
+                except ldap.NO_SUCH_OBJECT:
+                    continue
+                except Exception:
+                    for msgid, dn in pending:
+                        connection.abandon(msgid)
+                    raise
+                for entry_dn, attrs in rdata:
+                    if entry_dn is not None:
+                        output[dn] = (entry_dn.decode(self.charset), attrs)
         return output
+
+    def bulk_s(self, operations):
+        """
+        Performs many write operations, pipelined on a single connection
+        with at most PIPELINE_WINDOW (default 64) requests in flight.
+
+        Each operation is one of the following tuples:
+
+            ('add', dn, modlist)
+            ('modify', dn, modlist)
+            ('delete', dn, None)
+            ('rename', dn, newrdn)
+
+        The operations must be independent of each other, as the server
+        may apply them in any order. A failed operation does not stop the
+        others: returns a list of (index, exception) tuples for the
+        operations which failed.
+        """
+        # check the operations before sending any of them
+        operations = list(operations)
+        for kind, dn, arg in operations:
+            if kind not in ('add', 'modify', 'delete', 'rename'):
+                raise ValueError("Unknown operation %r" % kind)
+
+        window = self.settings_dict.get('PIPELINE_WINDOW', 64)
+        errors = []
+        with self._cursor() as cursor:
+            connection = cursor.connection
+            pending = collections.deque()
+            operations = enumerate(operations)
+            exhausted = False
+            while True:
+                while not exhausted and len(pending) < window:
+                    try:
+                        index, (kind, dn, arg) = next(operations)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    dn = dn.encode(self.charset)
+                    if kind == 'add':
+                        msgid = connection.add_ext(dn, arg)
+                    elif kind == 'modify':
+                        msgid = connection.modify_ext(dn, arg)
+                    elif kind == 'delete':
+                        msgid = connection.delete_ext(dn)
+                    else:
+                        msgid = connection.rename(dn,
+                                                  arg.encode(self.charset))
+                    pending.append((msgid, index))
+                if not pending:
+                    break
+
+                msgid, index = pending.popleft()
+                try:
+                    connection.result3(msgid)
+                except ldap.SERVER_DOWN:
+                    raise
+                except ldap.LDAPError as e:
+                    errors.append((index, e))
+        return errors
+
+    def search_iter(self, base, scope, filterstr='(objectClass=*)',
+                    attrlist=None, attrsonly=0, serverctrls=None,
+                    sizelimit=0, page_size=None):
+        """
+        Yields the (dn, attrs) tuples matching the search.
+
+        If the database settings define a PAGE_SIZE, the search is
+        performed using the Simple Paged Results control (RFC 2696) and
+        only a single page of entries is held in memory at a time. This
+        also keeps large subtrees from being truncated by the server's
+        size limit.
+
+        If sizelimit is given, at most that many entries are returned.
+        The page_size argument overrides the PAGE_SIZE setting for paged
+        searches.
+        """
+        filterstr = filterstr.encode(self.charset)
+        serverctrls = list(serverctrls or [])
+        if self.settings_dict.get('PAGE_SIZE'):
+            page_size = page_size or self.settings_dict['PAGE_SIZE']
+            if sizelimit:
+                page_size = min(page_size, sizelimit)
+        else:
+            page_size = None
+
+        # a connection found dead before any entry was returned is
+        # replaced, anything later is reported to the caller
+        started = False
+        try:
+            with self._cursor() as cursor:
+                for entry in self._search_iter(cursor.connection, base, scope,
+                                               filterstr, attrlist, attrsonly,
+                                               serverctrls, sizelimit,
+                                               page_size):
+                    started = True
+                    yield entry
+            return
+        except ldap.SERVER_DOWN:
+            if started:
+                raise
+            logger.warning("LDAP server went away, reconnecting")
+        with self._cursor() as cursor:
+            for entry in self._search_iter(cursor.connection, base, scope,
+                                           filterstr, attrlist, attrsonly,
+                                           serverctrls, sizelimit, page_size):
+                yield entry
+
+    def _search_iter(self, connection, base, scope, filterstr, attrlist,
+                     attrsonly, serverctrls, sizelimit, page_size):
+        if not page_size:
+            msgid = connection.search_ext(base, scope, filterstr, attrlist,
+                                          attrsonly, serverctrls=serverctrls,
+                                          sizelimit=sizelimit)
+            done = False
+            try:
+                while not done:
+                    try:
+                        rtype, rdata, rmsgid, rctrls = \
+                            connection.result3(msgid, all=0)
+                    except ldap.SIZELIMIT_EXCEEDED:
+                        # only the limit requested by the caller is expected,
+                        # a limit imposed by the server truncates the results
+                        if not sizelimit:
+                            raise
+                        done = True
+                        break
+                    done = (rtype == ldap.RES_SEARCH_RESULT)
+                    for dn, attrs in rdata:
+                        if dn is not None:
+                            yield (dn.decode(self.charset), attrs)
+            finally:
+                if not done:
+                    connection.abandon(msgid)
+            return
+
+        control = SimplePagedResultsControl(True, size=page_size, cookie='')
+        count = 0
+        try:
+            while True:
+                msgid = connection.search_ext(
+                    base, scope, filterstr, attrlist, attrsonly,
+                    serverctrls=serverctrls + [control])
+                rtype, rdata, rmsgid, rctrls = connection.result3(msgid)
+                control.cookie = ''
+                for ctrl in rctrls:
+                    if ctrl.controlType == control.controlType:
+                        control.cookie = ctrl.cookie
+                for dn, attrs in rdata:
+                    if dn is not None:
+                        yield (dn.decode(self.charset), attrs)
+                        count += 1
+                        if count == sizelimit:
+                            return
+                if not control.cookie:
+                    break
+        finally:
+            if control.cookie:
+                # the caller stopped early, release the server-side state
+                control.size = 0
+                connection.search_ext_s(
+                    base, scope, filterstr, attrlist, attrsonly,
+                    serverctrls=serverctrls + [control])
+
+    def supported_controls(self):
+        """
+        Returns the OIDs of the controls advertised in the server's root DSE.
+        """
+        try:
+            results = self.search_s('', ldap.SCOPE_BASE,
+                                    attrlist=['supportedControl'])
+        except ldap.LDAPError:
+            return []
+        for dn, attrs in results:
+            return attrs.get('supportedControl', [])
+        return []
@@ -30,73 +30,325 @@
 # POSSIBILITY OF SUCH DAMAGE.
 #
 
+import functools
+import heapq
+import itertools
+import threading
+from collections import OrderedDict
+
 import ldap
 
 from django.db.models.sql import aggregates, compiler
 from django.db.models.sql.where import AND, OR
 
+from ldapdb.backends.ldap.base import SSSRequestControl
+
+
+# filters matching every entry and no entry at all
+MATCH_ALL = '(objectClass=*)'
+MATCH_NONE = '(!(objectClass=*))'
+
+# parameters are written as \0<index>\0 in the compiled filters, NUL
+# characters being always escaped in values
+PARAM_MARKER = '\0'
+
 
 def get_lookup_operator(lookup_type):
     if lookup_type == 'gte':
         return '>='
     elif lookup_type == 'lte':
         return '<='
+    elif lookup_type == 'approx':
+        return '~='
     else:
         return '='
 
 
+def unique(bits):
+    """
+    Returns the given filter clauses without duplicates, keeping the
+    order in which they first appear.
+    """
+    seen = set()
+    result = []
+    for bit in bits:
+        if bit not in seen:
+            seen.add(bit)
+            result.append(bit)
+    return result
+
+
+def hashable(value):
+    """
+    Returns a hashable equivalent of a row value, multi-valued attributes
+    being decoded as lists.
+    """
+    if isinstance(value, list):
+        return tuple([hashable(x) for x in value])
+    return value
+
+
 def query_as_ldap(query):
     # starting with django 1.6 we can receive empty querysets
     if hasattr(query, 'is_empty') and query.is_empty():
         return
 
-    filterstr = ''.join(['(objectClass=%s)' % cls for cls in
-                         query.model.object_classes])
-    sql, params = where_as_ldap(query.where)
-    filterstr += sql
-    return '(&%s)' % filterstr
+    values = []
+    tree = where_tree(query.where, values, {})
+    template = get_template(tuple(query.model.object_classes), tree)
+    if template is None:
+        # no need to ask the server
+        return
+    return render(template, values)
 
 
 def where_as_ldap(self):
-    bits = []
-    for item in self.children:
+    values = []
+    tree = where_tree(self, values, {})
+    return render(get_template(None, tree), values), []
+
+
+def where_tree(node, values, seen):
+    """
+    Returns the shape of a where node as nested tuples, appending the
+    lookup values to `values`. Equal values share the same parameter
+    index, so that duplicated clauses are detected on the shape alone.
+    """
+    def param(value):
+        key = (type(value), value)
+        try:
+            hash(key)
+        except TypeError:
+            values.append(value)
+            return len(values) - 1
+        if key not in seen:
+            seen[key] = len(values)
+            values.append(value)
+        return seen[key]
+
+    children = []
+    for item in node.children:
         if hasattr(item, 'lhs') and hasattr(item, 'rhs'):
             # Django 1.7
             item = item.lhs.target.column, item.lookup_name, None, item.rhs
         elif hasattr(item, 'as_sql'):
-            sql, params = where_as_ldap(item)
-            bits.append(sql)
+            children.append(where_tree(item, values, seen))
             continue
 
-        constraint, lookup_type, y, values = item
+        constraint, lookup_type, y, value = item
         if hasattr(constraint, 'col'):
             constraint = constraint.col
-        comp = get_lookup_operator(lookup_type)
-        if lookup_type == 'in':
-            equal_bits = ["(%s%s%s)" % (constraint, comp, value) for value
-                          in values]
-            clause = '(|%s)' % ''.join(equal_bits)
+        if lookup_type == 'isnull':
+            arg = bool(value)
+        elif lookup_type == 'in':
+            arg = tuple([param(v) for v in value])
         else:
-            clause = "(%s%s%s)" % (constraint, comp, values)
+            arg = param(value)
+        children.append(('lookup', constraint, lookup_type, arg))
+    return ('node', node.connector, node.negated, tuple(children))
 
-        bits.append(clause)
+
+# compiled filter templates, by object classes and where tree shape
+FILTER_CACHE_SIZE = 512
+
+_filter_cache = OrderedDict()
+_filter_cache_lock = threading.Lock()
+_filter_cache_stats = {'hits': 0, 'misses': 0}
+
+
+def get_template(object_classes, tree):
+    """
+    Returns the filter template for a query on the given object classes
+    (or for the where tree alone if object_classes is None), compiling it
+    on first use. Returns None if the query cannot match any entry.
+    """
+    key = (object_classes, tree)
+    with _filter_cache_lock:
+        try:
+            template = _filter_cache.pop(key)
+        except KeyError:
+            _filter_cache_stats['misses'] += 1
+        else:
+            _filter_cache_stats['hits'] += 1
+            _filter_cache[key] = template
+            return template
+
+    if object_classes is None:
+        sql = compile_where(tree)
+    else:
+        sql = compile_query(object_classes, tree)
+    template = None
+    if sql is not None:
+        template = sql.split(PARAM_MARKER)
+        for i in range(1, len(template), 2):
+            template[i] = int(template[i])
+        template = tuple(template)
+
+    with _filter_cache_lock:
+        _filter_cache[key] = template
+        if len(_filter_cache) > FILTER_CACHE_SIZE:
+            _filter_cache.popitem(last=False)
+    return template
+
+
+def filter_cache_stats():
+    """
+    Returns the hit and miss counts of the compiled filter cache.
+    """
+    with _filter_cache_lock:
+        stats = dict(_filter_cache_stats)
+        stats['size'] = len(_filter_cache)
+        return stats
+
+
+def clear_filter_cache():
+    """
+    Empties the compiled filter cache. The statistics are kept.
+    """
+    with _filter_cache_lock:
+        _filter_cache.clear()
+
+
+def render(template, values):
+    """
+    Substitutes the lookup values into a filter template.
+    """
+    bits = list(template)
+    for i in range(1, len(bits), 2):
+        bits[i] = '%s' % (values[bits[i]],)
+    return ''.join(bits)
+
+
+def compile_query(object_classes, tree):
+    connector, negated, children = tree[1:]
+    if connector == AND and not negated:
+        bits = where_bits(tree)
+    else:
+        sql = compile_where(tree)
+        bits = sql and [sql] or []
+    if MATCH_NONE in bits:
+        return None
+    bits = ['(objectClass=%s)' % cls for cls in object_classes] + \
+        [bit for bit in bits if bit != MATCH_ALL]
+    return '(&%s)' % ''.join(unique(bits))
+
+
+def is_single_clause(sql):
+    """
+    Returns True if the filter is made of a single parenthesized clause.
+    Parentheses in values are always escaped, so counting them is enough.
+    """
+    depth = 0
+    for i, char in enumerate(sql):
+        if char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+            if depth == 0:
+                return i == len(sql) - 1
+    return False
+
+
+def negate(sql):
+    if sql == MATCH_ALL:
+        return MATCH_NONE
+    elif sql == MATCH_NONE:
+        return MATCH_ALL
+    elif sql.startswith('(!') and is_single_clause(sql[2:-1]):
+        return sql[2:-1]
+    return '(!%s)' % sql
+
+
+def placeholder(index):
+    return '%s%d%s' % (PARAM_MARKER, index, PARAM_MARKER)
+
+
+def lookup_as_ldap(column, lookup_type, arg):
+    """
+    Returns the filter clauses for a single lookup, as alternatives to be
+    ORed.
+    """
+    if lookup_type == 'in':
+        return ["(%s=%s)" % (column, placeholder(index)) for index in arg]
+    elif lookup_type == 'isnull':
+        if arg:
+            return ["(!(%s=*))" % column]
+        return ["(%s=*)" % column]
+    comp = get_lookup_operator(lookup_type)
+    return ["(%s%s%s)" % (column, comp, placeholder(arg))]
+
+
+def where_clauses(tree):
+    """
+    Returns the filter clauses combined by the node's connector. Nested
+    nodes using the same connector, or holding a single child, are
+    flattened into their parent, as are the alternatives of 'in'
+    lookups in an OR node.
+    """
+    connector, negated, children = tree[1:]
+    bits = []
+    for item in children:
+        if item[0] == 'node':
+            if item[3] and not item[2] and \
+                    (item[1] == connector or len(item[3]) == 1):
+                bits.extend(where_clauses(item))
+            else:
+                bits.append(compile_where(item) or MATCH_ALL)
+            continue
+
+        alternatives = unique(lookup_as_ldap(*item[1:]))
+        if not alternatives:
+            bits.append(MATCH_NONE)
+        elif len(alternatives) == 1 or connector == OR:
+            bits.extend(alternatives)
+        else:
+            bits.append('(|%s)' % ''.join(alternatives))
+    return bits
+
+
+def where_bits(tree):
+    """
+    Returns the simplified list of clauses to be combined by the node's
+    connector, ignoring its negation.
+    """
+    connector, negated, children = tree[1:]
+    bits = unique(where_clauses(tree))
+    if connector == AND:
+        if MATCH_NONE in bits:
+            return [MATCH_NONE]
+        return [bit for bit in bits if bit != MATCH_ALL]
+    elif connector == OR:
+        if MATCH_ALL in bits:
+            return [MATCH_ALL]
+        bits = [bit for bit in bits if bit != MATCH_NONE]
+        if not bits and children:
+            # every alternative is impossible
+            return [MATCH_NONE]
+        return bits
+    else:
+        raise Exception("Unhandled WHERE connector: %s" % connector)
+
+
+def compile_where(tree):
+    connector, negated, children = tree[1:]
+    bits = where_bits(tree)
 
     if not len(bits):
-        return '', []
+        if negated:
+            return MATCH_NONE
+        return ''
 
     if len(bits) == 1:
         sql_string = bits[0]
-    elif self.connector == AND:
+    elif connector == AND:
         sql_string = '(&%s)' % ''.join(bits)
-    elif self.connector == OR:
-        sql_string = '(|%s)' % ''.join(bits)
     else:
-        raise Exception("Unhandled WHERE connector: %s" % self.connector)
+        sql_string = '(|%s)' % ''.join(bits)
 
-    if self.negated:
-        sql_string = ('(!%s)' % sql_string)
+    if negated:
+        sql_string = negate(sql_string)
 
-    return sql_string, []
+    return sql_string
 
 
 class SQLCompiler(object):
@@ -118,16 +370,15 @@ class SQLCompiler(object):
             return
 
         try:
-            vals = self.connection.search_s(
+            count = self.connection.count_s(
                 self.query.model.base_dn,
                 self.query.model.search_scope,
                 filterstr=filterstr,
-                attrlist=['dn'],
             )
         except ldap.NO_SUCH_OBJECT:
-            vals = []
+            count = 0
 
-        if not vals:
+        if not count:
             return None
 
         output = []
@@ -135,7 +386,7 @@ class SQLCompiler(object):
             output.append(col[0])
         for key, aggregate in self.query.aggregate_select.items():
             if isinstance(aggregate, aggregates.Count):
-                output.append(len(vals))
+                output.append(count)
             else:
                 output.append(None)
         return output
@@ -145,28 +396,90 @@ class SQLCompiler(object):
         if not filterstr:
             return
 
+        fields = self.get_fields()
+        ordering = self.get_ordering()
+
+        attrlist = [x.db_column for x in fields if x.db_column]
+        for field, negate in ordering:
+            if field.db_column and field.db_column not in attrlist:
+                attrlist.append(field.db_column)
+        if not attrlist:
+            # only the DNs are needed, ask for no attributes (RFC 4511)
+            attrlist = ['1.1']
+
+        low_mark, high_mark = self.query.low_mark, self.query.high_mark
+        # duplicates must be dropped before slicing, so the server cannot
+        # be asked to stop early for distinct queries
+        sizelimit = 0
+        if high_mark is not None and not self.query.distinct:
+            sizelimit = high_mark
+
+        vals = None
+        if ordering:
+            vals = self.server_sorted_iter(filterstr, attrlist, ordering,
+                                           sizelimit)
+        if vals is None:
+            vals = self.search_iter(filterstr, attrlist,
+                                    sizelimit=0 if ordering else sizelimit)
+            if ordering:
+                vals = self.sort_entries(vals, ordering, sizelimit)
+
+        # process results as they arrive
+        pos = 0
+        seen = set()
+        for dn, attrs in vals:
+            if high_mark is not None and pos >= high_mark:
+                break
+            row = []
+            for field in iter(fields):
+                if field.attname == 'dn':
+                    row.append(dn)
+                elif hasattr(field, 'from_ldap'):
+                    row.append(field.from_ldap(attrs.get(field.db_column, []),
+                                               connection=self.connection))
+                else:
+                    row.append(None)
+            if self.query.distinct:
+                key = tuple([hashable(value) for value in row])
+                if key in seen:
+                    continue
+                seen.add(key)
+            pos += 1
+            if pos > low_mark:
+                yield row
+
+    def get_fields(self):
+        """
+        Returns the fields making up each row, honouring values(),
+        values_list(), only() and defer(). Only these attributes are
+        requested from the server and decoded.
+        """
         if hasattr(self.query, 'select_fields') and len(self.query.select_fields):
             # django < 1.6
-            fields = self.query.select_fields
+            return self.query.select_fields
         elif len(self.query.select):
             # django >= 1.6
-            fields = [x.field for x in self.query.select]
-        else:
-            fields = self.query.model._meta.fields
-
-        attrlist = [x.db_column for x in fields if x.db_column]
-
-        try:
-            vals = self.connection.search_s(
-                self.query.model.base_dn,
-                self.query.model.search_scope,
-                filterstr=filterstr,
-                attrlist=attrlist,
-            )
-        except ldap.NO_SUCH_OBJECT:
-            return
-
-        # perform sorting
+            return [x.field for x in self.query.select]
+
+        only_load = self.query.get_loaded_field_names()
+        if not only_load:
+            return self.query.model._meta.concrete_fields
+
+        # deferred rows hold the loaded fields only, in the order expected
+        # by QuerySet.iterator()
+        fields = []
+        opts = self.query.model._meta
+        for field, model in opts.get_concrete_fields_with_model():
+            if model is None:
+                model = self.query.model
+            if model not in only_load or field.name in only_load[model]:
+                fields.append(field)
+        return fields
+
+    def get_ordering(self):
+        """
+        Returns the query ordering as a list of (field, negate) tuples.
+        """
         if self.query.extra_order_by:
             ordering = self.query.extra_order_by
         elif not self.query.default_ordering:
@@ -174,59 +487,100 @@ class SQLCompiler(object):
         else:
             ordering = self.query.order_by or self.query.model._meta.ordering
 
-        def cmpvals(x, y):
-            for fieldname in ordering:
-                if fieldname.startswith('-'):
-                    fieldname = fieldname[1:]
-                    negate = True
+        result = []
+        for fieldname in ordering:
+            if fieldname.startswith('-'):
+                fieldname = fieldname[1:]
+                negate = True
+            else:
+                negate = False
+            if fieldname == 'pk':
+                fieldname = self.query.model._meta.pk.name
+            field = self.query.model._meta.get_field(fieldname)
+            result.append((field, negate))
+        return result
+
+    def server_sorted_iter(self, filterstr, attrlist, ordering, sizelimit):
+        """
+        Returns an iterator over the entries sorted by the server using the
+        Server Side Sorting control (RFC 2891), or None if the server cannot
+        sort this query and sorting has to be done locally.
+        """
+        if not self.connection.features.supports_server_side_sort:
+            return None
+        rules = []
+        for field, negate in ordering:
+            if not field.db_column:
+                return None
+            rules.append(negate and '-' + field.db_column or field.db_column)
+
+        control = SSSRequestControl(True, rules)
+        vals = self.search_iter(filterstr, attrlist, serverctrls=[control],
+                                sizelimit=sizelimit)
+        # the server rejects the sort before sending any entry, so the
+        # error can be caught here and the query retried unsorted
+        try:
+            first = next(vals)
+        except StopIteration:
+            return iter([])
+        except (ldap.UNAVAILABLE_CRITICAL_EXTENSION,
+                ldap.INAPPROPRIATE_MATCHING):
+            return None
+        return itertools.chain([first], vals)
+
+    def sort_entries(self, vals, ordering, limit=0):
+        """
+        Sorts the entries locally. Every sort key is decoded only once per
+        entry and, when only the first `limit` entries are needed, a heap
+        is used instead of sorting the whole result set.
+        """
+        def sort_key(dn, attrs):
+            key = []
+            for field, negate in ordering:
+                if field.attname == 'dn':
+                    value = dn
                 else:
-                    negate = False
-                if fieldname == 'pk':
-                    fieldname = self.query.model._meta.pk.name
-                field = self.query.model._meta.get_field(fieldname)
-                attr_x = field.from_ldap(x[1].get(field.db_column, []),
-                                         connection=self.connection)
-                attr_y = field.from_ldap(y[1].get(field.db_column, []),
-                                         connection=self.connection)
+                    value = field.from_ldap(attrs.get(field.db_column, []),
+                                            connection=self.connection)
                 # perform case insensitive comparison
-                if hasattr(attr_x, 'lower'):
-                    attr_x = attr_x.lower()
-                if hasattr(attr_y, 'lower'):
-                    attr_y = attr_y.lower()
+                if hasattr(value, 'lower'):
+                    value = value.lower()
+                key.append(value)
+            return key
+
+        negates = [negate for field, negate in ordering]
+
+        def cmpkeys(x, y):
+            for negate, attr_x, attr_y in zip(negates, x[0], y[0]):
                 val = negate and cmp(attr_y, attr_x) or cmp(attr_x, attr_y)
                 if val:
                     return val
             return 0
-        vals = sorted(vals, cmp=cmpvals)
 
-        # process results
-        pos = 0
-        results = []
-        for dn, attrs in vals:
-            # FIXME : This is not optimal, we retrieve more results than we
-            # need but there is probably no other options as we can't perform
-            # ordering server side.
-            if (self.query.low_mark and pos < self.query.low_mark) or \
-               (self.query.high_mark is not None and
-                    pos >= self.query.high_mark):
-                pos += 1
-                continue
-            row = []
-            for field in iter(fields):
-                if field.attname == 'dn':
-                    row.append(dn)
-                elif hasattr(field, 'from_ldap'):
-                    row.append(field.from_ldap(attrs.get(field.db_column, []),
-                                               connection=self.connection))
-                else:
-                    row.append(None)
-            if self.query.distinct:
-                if row in results:
-                    continue
-                else:
-                    results.append(row)
-            yield row
-            pos += 1
+        decorated = ((sort_key(dn, attrs), (dn, attrs)) for dn, attrs in vals)
+        if limit:
+            decorated = heapq.nsmallest(limit, decorated,
+                                        key=functools.cmp_to_key(cmpkeys))
+        else:
+            decorated = sorted(decorated, cmp=cmpkeys)
+        return [entry for key, entry in decorated]
+
+    def search_iter(self, filterstr, attrlist, serverctrls=None, sizelimit=0):
+        """
+        Iterates over the entries matching the query, treating a missing
+        base_dn as an empty result set.
+        """
+        try:
+            for entry in self.connection.search_iter(
+                    self.query.model.base_dn,
+                    self.query.model.search_scope,
+                    filterstr=filterstr,
+                    attrlist=attrlist,
+                    serverctrls=serverctrls,
+                    sizelimit=sizelimit):
+                yield entry
+        except ldap.NO_SUCH_OBJECT:
+            return
 
     def has_results(self):
         import inspect
@@ -260,9 +614,12 @@ class SQLDeleteCompiler(compiler.SQLDeleteCompiler, SQLCompiler):
         except ldap.NO_SUCH_OBJECT:
             return
 
-        # FIXME : there is probably a more efficient way to do this
-        for dn, attrs in vals:
-            self.connection.delete_s(dn)
+        # the deletions are pipelined, report the first failure once all
+        # the other entries are deleted
+        errors = self.connection.bulk_s([('delete', dn, None)
+                                         for dn, attrs in vals])
+        if errors:
+            raise errors[0][1]
 
 
 class SQLUpdateCompiler(compiler.SQLUpdateCompiler, SQLCompiler):
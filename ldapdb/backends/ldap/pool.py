@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+#
+# django-ldapdb
+# Copyright (c) 2009-2011, Bolloré telecom
+# Copyright (c) 2013, Jeremy Lainé
+# All rights reserved.
+#
+# See AUTHORS file for a full list of contributors.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright notice,
+#        this list of conditions and the following disclaimer.
+#
+#     2. Redistributions in binary form must reproduce the above copyright
+#        notice, this list of conditions and the following disclaimer in the
+#        documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import ldap
+
+
+logger = logging.getLogger('ldapdb')
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(alias, settings_dict):
+    """
+    Returns the connection pool shared by all the threads using the given
+    database alias, creating it if needed.
+    """
+    with _pools_lock:
+        pool = _pools.get(alias)
+        if pool is None or pool.pid != os.getpid():
+            # never share sockets with a parent process
+            pool = ConnectionPool(settings_dict)
+            _pools[alias] = pool
+        return pool
+
+
+class ConnectionPool(object):
+    """
+    A bounded pool of bound LDAP connections.
+
+    Connections are checked out for the duration of a single operation.
+    Once opened, a connection keeps its TLS session and bind across
+    checkouts. The pool is configured by the following database settings:
+
+    POOL_SIZE: maximum number of open connections (default 10)
+    POOL_TIMEOUT: seconds to wait for a free connection, None waits forever
+        (default 30)
+    POOL_MAX_IDLE: seconds after which idle connections are closed
+        (default 300)
+    POOL_CHECK_INTERVAL: connections idle for longer than this many seconds
+        are checked with a "Who am I?" request before being reused
+        (default 30)
+    """
+
+    def __init__(self, settings_dict):
+        self.settings_dict = settings_dict
+        self.size = settings_dict.get('POOL_SIZE', 10)
+        self.timeout = settings_dict.get('POOL_TIMEOUT', 30)
+        self.max_idle = settings_dict.get('POOL_MAX_IDLE', 300)
+        self.check_interval = settings_dict.get('POOL_CHECK_INTERVAL', 30)
+        self.pid = os.getpid()
+
+        self.lock = threading.Condition()
+        # idle connections as (connection, release time), most recent last
+        self.idle = []
+        self.in_use = 0
+
+        # statistics
+        self.checkouts = 0
+        self.created = 0
+        self.discarded = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    def connect(self):
+        """
+        Opens and binds a new connection.
+        """
+        connection = ldap.initialize(self.settings_dict['NAME'])
+
+        options = self.settings_dict.get('CONNECTION_OPTIONS', {})
+        for opt, value in options.items():
+            connection.set_option(opt, value)
+
+        if self.settings_dict.get('TLS', False):
+            connection.start_tls_s()
+
+        connection.simple_bind_s(
+            self.settings_dict['USER'],
+            self.settings_dict['PASSWORD'])
+        return connection
+
+    def acquire(self):
+        """
+        Checks a connection out of the pool, waiting for one to be released
+        if the pool is exhausted.
+        """
+        start = time.time()
+        waited = False
+        with self.lock:
+            while True:
+                discarded = self._evict(time.time())
+                if self.idle or self.in_use + len(self.idle) < self.size:
+                    break
+                if not waited:
+                    waited = True
+                    self.waits += 1
+                remaining = None
+                if self.timeout is not None:
+                    remaining = start + self.timeout - time.time()
+                    if remaining <= 0:
+                        raise ldap.TIMEOUT({
+                            'desc': 'Timed out waiting for a pooled '
+                                    'connection'})
+                self.lock.wait(remaining)
+
+            entry = self.idle and self.idle.pop() or None
+            self.in_use += 1
+            self.checkouts += 1
+            if waited:
+                wait_time = time.time() - start
+                self.wait_time += wait_time
+                self.max_wait_time = max(self.max_wait_time, wait_time)
+        self._unbind(discarded)
+
+        try:
+            if entry is not None:
+                connection, released = entry
+                if time.time() - released < self.check_interval or \
+                        self._is_usable(connection):
+                    return connection
+                self._unbind([connection])
+                with self.lock:
+                    self.discarded += 1
+            connection = self.connect()
+        except Exception:
+            with self.lock:
+                self.in_use -= 1
+                self.lock.notify()
+            raise
+        with self.lock:
+            self.created += 1
+        return connection
+
+    def release(self, connection, discard=False):
+        """
+        Returns a connection to the pool. Broken connections must be
+        discarded instead of being reused.
+        """
+        with self.lock:
+            self.in_use -= 1
+            if discard:
+                self.discarded += 1
+            else:
+                self.idle.append((connection, time.time()))
+            self.lock.notify()
+        if discard:
+            self._unbind([connection])
+
+    @contextmanager
+    def connection(self):
+        """
+        Checks a connection out of the pool for the duration of the block.
+        If the server went away, the connection and all the idle ones
+        are discarded.
+        """
+        connection = self.acquire()
+        discard = False
+        try:
+            yield connection
+        except ldap.SERVER_DOWN:
+            discard = True
+            raise
+        finally:
+            # also reached when a generator using the connection is
+            # closed early
+            self.release(connection, discard=discard)
+            if discard:
+                self.clear()
+
+    def clear(self):
+        """
+        Closes all the idle connections.
+        """
+        with self.lock:
+            idle = [connection for connection, released in self.idle]
+            self.discarded += len(idle)
+            self.idle = []
+        self._unbind(idle)
+
+    def stats(self):
+        """
+        Returns a dictionary describing the pool usage.
+        """
+        with self.lock:
+            return {
+                'size': self.size,
+                'connections': self.in_use + len(self.idle),
+                'in_use': self.in_use,
+                'idle': len(self.idle),
+                'checkouts': self.checkouts,
+                'created': self.created,
+                'discarded': self.discarded,
+                'waits': self.waits,
+                'wait_time': self.wait_time,
+                'max_wait_time': self.max_wait_time,
+            }
+
+    def _evict(self, now):
+        """
+        Removes from the pool the connections idle for too long and returns
+        them. Must be called with the lock held.
+        """
+        if self.max_idle is None:
+            return []
+        expired = [connection for connection, released in self.idle
+                   if now - released > self.max_idle]
+        if expired:
+            self.idle = [(connection, released)
+                         for connection, released in self.idle
+                         if now - released <= self.max_idle]
+            self.discarded += len(expired)
+        return expired
+
+    def _is_usable(self, connection):
+        try:
+            connection.whoami_s()
+            return True
+        except ldap.LDAPError:
+            return False
+
+    def _unbind(self, connections):
+        for connection in connections:
+            try:
+                connection.unbind_s()
+            except ldap.LDAPError:
+                pass
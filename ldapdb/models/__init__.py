@@ -31,3 +31,5 @@
 #
 
 from ldapdb.models.base import Model  # noqa
+from ldapdb.models.cache import entry_cache  # noqa
+from ldapdb.models.query import BulkWriteError, Manager, QuerySet  # noqa
@@ -30,18 +30,50 @@
 # POSSIBILITY OF SUCH DAMAGE.
 #
 
+import copy
 import ldap
 import logging
+import re
+import threading
+from collections import OrderedDict
 
 import django.db.models
 from django.db import connections, router
 from django.db.models import signals
 
 import ldapdb  # noqa
+from ldapdb.models.cache import (cache_entry, cached_entries,
+                                 invalidate_entry, normalize_dn)
+from ldapdb.models.query import Manager
 
 
 logger = logging.getLogger('ldapdb')
 
+# maximum number of classes returned by Model.scoped() kept in memory
+SCOPED_CACHE_SIZE = 256
+
+_scoped_classes = OrderedDict()
+_scoped_lock = threading.Lock()
+
+
+def _unregister_model(model):
+    """
+    Removes the model from the application registry, if it is the model
+    registered under its name, so that it can be garbage collected.
+    """
+    if hasattr(model._meta, 'apps'):
+        # django >= 1.7
+        app_models = model._meta.apps.all_models[model._meta.app_label]
+        clear_cache = model._meta.apps.clear_cache
+    else:
+        from django.db.models.loading import cache
+        app_models = cache.app_models[model._meta.app_label]
+        clear_cache = cache._get_models_cache.clear
+    if app_models.get(model._meta.model_name) is model:
+        del app_models[model._meta.model_name]
+        # the registry caches the lists of models
+        clear_cache()
+
 
 class Model(django.db.models.base.Model):
     """
@@ -49,14 +81,33 @@ class Model(django.db.models.base.Model):
     """
     dn = django.db.models.fields.CharField(max_length=200)
 
+    objects = Manager()
+
     # meta-data
     base_dn = None
     search_scope = ldap.SCOPE_SUBTREE
     object_classes = ['top']
 
+    # compare against a fresh copy of the entry when saving instead of the
+    # values loaded with the instance
+    verify_on_save = False
+
     def __init__(self, *args, **kwargs):
         super(Model, self).__init__(*args, **kwargs)
         self.saved_pk = self.pk
+        self.saved_values = self._snapshot()
+
+    def _snapshot(self):
+        """
+        Returns a copy of the loaded attribute values. Deferred fields are
+        left out, so that taking the snapshot does not load them.
+        """
+        values = {}
+        for field in self._meta.fields:
+            if field.db_column and field.attname in self.__dict__:
+                values[field.attname] = copy.copy(
+                    self.__dict__[field.attname])
+        return values
 
     def build_rdn(self):
         """
@@ -86,11 +137,67 @@ class Model(django.db.models.base.Model):
         connection = connections[using]
         logger.debug("Deleting LDAP entry %s" % self.dn)
         connection.delete_s(self.dn)
+        invalidate_entry(self.dn)
         signals.post_delete.send(sender=self.__class__, instance=self)
 
-    def save(self, using=None):
+    def build_entry(self, connection):
+        """
+        Returns the Distinguished Name and the attribute list needed to
+        create this entry.
+        """
+        entry = [('objectClass', self.object_classes)]
+        for field in self._meta.fields:
+            if not field.db_column:
+                continue
+            value = getattr(self, field.name)
+            value = field.get_db_prep_save(value, connection=connection)
+            if value:
+                entry.append((field.db_column, value))
+        return self.build_dn(), entry
+
+    def build_modlist(self, connection, saved_values=None, fields=None):
+        """
+        Returns the modifications needed to bring the entry up to date,
+        compared to saved_values (by default, the values the instance was
+        loaded with). If fields is given, only those fields are compared.
+        """
+        if saved_values is None:
+            saved_values = self.saved_values
+        modlist = []
+        for field in self._meta.fields:
+            if not field.db_column:
+                continue
+            if fields is not None and field.name not in fields:
+                continue
+            if field.attname not in self.__dict__:
+                # deferred and never loaded, hence unchanged
+                continue
+            new_value = self.__dict__[field.attname]
+            if field.attname in saved_values:
+                old_value = saved_values[field.attname]
+                if old_value == new_value:
+                    continue
+            else:
+                # loaded after the snapshot was taken, the previous value
+                # is unknown so assume it is set
+                old_value = True
+            new_value = field.get_db_prep_save(new_value,
+                                               connection=connection)
+            if new_value:
+                modlist.append((ldap.MOD_REPLACE, field.db_column,
+                                new_value))
+            elif old_value:
+                modlist.append((ldap.MOD_DELETE, field.db_column, None))
+        return modlist
+
+    def save(self, using=None, verify=None):
         """
         Saves the current instance.
+
+        Changes are detected by comparing the attributes with the values
+        they had when the instance was loaded or last saved. If verify is
+        True, or verify_on_save is set on the class, the entry is fetched
+        again and compared with the server's copy instead.
         """
         signals.pre_save.send(sender=self.__class__, instance=self)
         
@@ -99,16 +206,7 @@ class Model(django.db.models.base.Model):
         if not self.dn:
             # create a new entry
             record_exists = False
-            entry = [('objectClass', self.object_classes)]
-            new_dn = self.build_dn()
-
-            for field in self._meta.fields:
-                if not field.db_column:
-                    continue
-                value = getattr(self, field.name)
-                value = field.get_db_prep_save(value, connection=connection)
-                if value:
-                    entry.append((field.db_column, value))
+            new_dn, entry = self.build_entry(connection)
 
             logger.debug("Creating new LDAP entry %s" % new_dn)
             connection.add_s(new_dn, entry)
@@ -119,22 +217,15 @@ class Model(django.db.models.base.Model):
         else:
             # update an existing entry
             record_exists = True
-            modlist = []
-            orig = self.__class__.objects.get(pk=self.saved_pk)
-            for field in self._meta.fields:
-                if not field.db_column:
-                    continue
-                old_value = getattr(orig, field.name, None)
-                new_value = getattr(self, field.name, None)
-                if old_value != new_value:
-                    new_value = field.get_db_prep_save(new_value, 
-                                        connection=connection)
-                    if new_value:
-                        modlist.append((ldap.MOD_REPLACE, field.db_column, 
-                                        new_value))
-                    elif old_value:
-                        modlist.append((ldap.MOD_DELETE, field.db_column,
-                                        None))
+            invalidate_entry(self.dn)
+            if verify is None:
+                verify = self.verify_on_save
+            if verify:
+                orig = self.__class__.objects.using(using).get(
+                    pk=self.saved_pk)
+                modlist = self.build_modlist(connection, orig.saved_values)
+            else:
+                modlist = self.build_modlist(connection)
 
             if len(modlist):
                 # handle renaming
@@ -152,26 +243,169 @@ class Model(django.db.models.base.Model):
                              self.dn)
 
         # done
+        invalidate_entry(self.dn)
         self.saved_pk = self.pk
+        self.saved_values = self._snapshot()
         signals.post_save.send(sender=self.__class__, instance=self,
                                created=(not record_exists))
 
+    @classmethod
+    def from_ldap_entry(cls, dn, attrs, connection):
+        """
+        Builds an instance from a (dn, attrs) search result.
+        """
+        row = []
+        for field in cls._meta.fields:
+            if field.attname == 'dn':
+                row.append(dn)
+            elif hasattr(field, 'from_ldap'):
+                row.append(field.from_ldap(attrs.get(field.db_column, []),
+                                           connection=connection))
+            else:
+                row.append(None)
+        return cls(*row)
+
+    @classmethod
+    def get_by_dn(cls, dn, using=None):
+        """
+        Returns the entry with the given Distinguished Name, raising
+        DoesNotExist if there is none.
+        """
+        objs = cls.get_many([dn], using=using)
+        if not objs:
+            raise cls.DoesNotExist(
+                "%s matching DN %s does not exist." % (
+                    cls._meta.object_name, dn))
+        return objs[0]
+
+    @classmethod
+    def get_many(cls, dns, using=None):
+        """
+        Returns the entries with the given Distinguished Names, in the same
+        order. The searches are pipelined on a single connection and
+        entries which do not exist are left out.
+        """
+        using = using or router.db_for_read(cls)
+        connection = connections[using]
+        result, missing = cached_entries(cls, dns)
+        if missing:
+            filterstr = '(&%s)' % ''.join(['(objectClass=%s)' % x for x in
+                                           cls.object_classes])
+            attrlist = [x.db_column for x in cls._meta.fields if x.db_column]
+            entries = connection.get_many_s(missing, filterstr=filterstr,
+                                            attrlist=attrlist)
+            for dn in missing:
+                obj = None
+                if dn in entries:
+                    obj = cls.from_ldap_entry(entries[dn][0], entries[dn][1],
+                                              connection)
+                    result[dn] = obj
+                cache_entry(cls, dn, obj)
+        return [result[dn] for dn in dns if dn in result]
+
+    @classmethod
+    def resolve_dns(cls, dns, using=None, chunk_size=100):
+        """
+        Returns a dictionary mapping the given Distinguished Names to the
+        corresponding instances.
+
+        The DNs are grouped by parent container and naming attribute, and
+        each group is fetched with one-level searches ORing up to
+        chunk_size RDN values, e.g. (|(uid=a)(uid=b)...). DNs which cannot
+        be grouped, such as those with multi-valued RDNs, are fetched with
+        get_many(). Entries which do not exist are left out.
+        """
+        using = using or router.db_for_read(cls)
+        connection = connections[using]
+        charset = connection.charset
+        result, dns = cached_entries(cls, dns)
+
+        groups = {}
+        others = []
+        wanted = {}
+        for dn in dns:
+            try:
+                rdns = ldap.dn.str2dn(dn.encode(charset))
+            except ldap.DECODING_ERROR:
+                others.append(dn)
+                continue
+            if len(rdns) < 2 or len(rdns[0]) != 1:
+                others.append(dn)
+                continue
+            attr, value, flags = rdns[0][0]
+            parent = ldap.dn.dn2str(rdns[1:])
+            key = (parent.lower(), attr.lower())
+            groups.setdefault(key, (parent, attr, []))[2].append(
+                value.decode(charset))
+            wanted.setdefault(normalize_dn(dn), []).append(dn)
+
+        objectclasses = ''.join(['(objectClass=%s)' % x for x in
+                                 cls.object_classes])
+        attrlist = [x.db_column for x in cls._meta.fields if x.db_column]
+        for parent, attr, values in groups.values():
+            for i in range(0, len(values), chunk_size):
+                filterstr = '(&%s(|%s))' % (objectclasses, ''.join(
+                    ['(%s=%s)' % (attr, ldapdb.escape_ldap_filter(v))
+                     for v in values[i:i + chunk_size]]))
+                try:
+                    entries = connection.search_s(parent,
+                                                  ldap.SCOPE_ONELEVEL,
+                                                  filterstr=filterstr,
+                                                  attrlist=attrlist)
+                except ldap.NO_SUCH_OBJECT:
+                    continue
+                for dn, attrs in entries:
+                    requested = wanted.get(normalize_dn(dn), [])
+                    if requested:
+                        obj = cls.from_ldap_entry(dn, attrs, connection)
+                        for requested_dn in requested:
+                            result[requested_dn] = obj
+
+        if others:
+            entries = connection.get_many_s(others,
+                                            filterstr='(&%s)' % objectclasses,
+                                            attrlist=attrlist)
+            for requested_dn, (dn, attrs) in entries.items():
+                result[requested_dn] = cls.from_ldap_entry(dn, attrs,
+                                                           connection)
+
+        # remember the entries which were fetched, or found missing
+        for dn in dns:
+            cache_entry(cls, dn, result.get(dn))
+        return result
+
     @classmethod
     def scoped(base_class, base_dn):
         """
         Returns a copy of the current class with a different base_dn.
+
+        The classes are cached, so repeated calls with the same base_dn
+        return the same class instead of running the model metaclass and
+        registering a new model each time. The SCOPED_CACHE_SIZE least
+        recently used classes are kept.
         """
-        class Meta:
-            proxy = True
-            verbose_name = base_class._meta.verbose_name
-            verbose_name_plural = base_class._meta.verbose_name_plural
-        import re
-        suffix = re.sub('[=,]', '_', base_dn)
-        name = "%s_%s" % (base_class.__name__, str(suffix))
-        new_class = type(name, (base_class,), {
-            'base_dn': base_dn, '__module__': base_class.__module__,
-            'Meta': Meta})
-        return new_class
+        key = (base_class, base_dn)
+        with _scoped_lock:
+            new_class = _scoped_classes.pop(key, None)
+            if new_class is not None:
+                _scoped_classes[key] = new_class
+                return new_class
+
+            class Meta:
+                proxy = True
+                verbose_name = base_class._meta.verbose_name
+                verbose_name_plural = base_class._meta.verbose_name_plural
+            suffix = re.sub('[=,]', '_', base_dn)
+            name = "%s_%s" % (base_class.__name__, str(suffix))
+            new_class = type(name, (base_class,), {
+                'base_dn': base_dn, '__module__': base_class.__module__,
+                'Meta': Meta})
+
+            _scoped_classes[key] = new_class
+            if len(_scoped_classes) > SCOPED_CACHE_SIZE:
+                key, old_class = _scoped_classes.popitem(last=False)
+                _unregister_model(old_class)
+            return new_class
 
     class Meta:
         abstract = True
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+#
+# django-ldapdb
+# Copyright (c) 2009-2011, Bolloré telecom
+# Copyright (c) 2013, Jeremy Lainé
+# All rights reserved.
+#
+# See AUTHORS file for a full list of contributors.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright notice,
+#        this list of conditions and the following disclaimer.
+#
+#     2. Redistributions in binary form must reproduce the above copyright
+#        notice, this list of conditions and the following disclaimer in the
+#        documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+import threading
+from contextlib import contextmanager
+
+import ldap
+
+
+# identity map of the entries, see entry_cache()
+_entry_cache = threading.local()
+
+
+@contextmanager
+def entry_cache():
+    """
+    Caches the entries fetched by Model.get_by_dn(), get_many() and
+    resolve_dns() for the duration of the block, so that each DN is
+    fetched and decoded at most once and the same instance is returned
+    every time. Entries which do not exist are remembered too.
+
+    The cache belongs to the current thread and nested blocks share the
+    outermost cache. Entries written through the models are invalidated,
+    changes made by others during the block are not seen.
+    """
+    if getattr(_entry_cache, 'entries', None) is not None:
+        yield
+        return
+    _entry_cache.entries = {}
+    try:
+        yield
+    finally:
+        _entry_cache.entries = None
+
+
+def normalize_dn(dn):
+    """
+    Returns a normalized form of the DN, suitable as a dictionary key.
+    """
+    try:
+        return ldap.dn.dn2str(ldap.dn.str2dn(dn.encode('utf-8'))).lower()
+    except ldap.DECODING_ERROR:
+        return dn.lower()
+
+
+def invalidate_entry(dn):
+    """
+    Removes the entry with the given DN from the entry cache, if any.
+    """
+    entries = getattr(_entry_cache, 'entries', None)
+    if entries is not None and dn:
+        entries.pop(normalize_dn(dn), None)
+
+
+def cached_entries(model, dns):
+    """
+    Looks the DNs up in the entry cache. Returns a dictionary of the
+    cached instances of the model and the list of the DNs which are not
+    cached.
+    """
+    entries = getattr(_entry_cache, 'entries', None)
+    if entries is None:
+        return {}, list(dns)
+    found = {}
+    missing = []
+    for dn in dns:
+        cached = entries.get(normalize_dn(dn), {})
+        if model in cached:
+            if cached[model] is not None:
+                found[dn] = cached[model]
+        else:
+            missing.append(dn)
+    return found, missing
+
+
+def cache_entry(model, dn, obj):
+    """
+    Stores an instance, or None if the entry does not exist, in the entry
+    cache.
+    """
+    entries = getattr(_entry_cache, 'entries', None)
+    if entries is not None:
+        entries.setdefault(normalize_dn(dn), {})[model] = obj
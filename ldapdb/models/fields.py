@@ -36,6 +36,12 @@ from ldapdb import escape_ldap_filter
 
 import datetime
 
+try:
+    # django >= 1.7
+    from django.db.models.lookups import Lookup
+except ImportError:
+    Lookup = None
+
 
 class CharField(fields.CharField):
     def __init__(self, *args, **kwargs):
@@ -51,18 +57,9 @@ class CharField(fields.CharField):
     def get_db_prep_lookup(self, lookup_type, value, connection,
                            prepared=False):
         "Returns field's value prepared for database lookup."
-        if lookup_type == 'endswith':
-            return ["*%s" % escape_ldap_filter(value)]
-        elif lookup_type == 'startswith':
-            return ["%s*" % escape_ldap_filter(value)]
-        elif lookup_type in ['contains', 'icontains']:
-            return ["*%s*" % escape_ldap_filter(value)]
-        elif lookup_type == 'exact':
-            return [escape_ldap_filter(value)]
-        elif lookup_type == 'in':
+        if lookup_type == 'in':
             return [escape_ldap_filter(v) for v in value]
-
-        raise TypeError("CharField has invalid lookup: %s" % lookup_type)
+        return [self.get_prep_lookup(lookup_type, value)]
 
     def get_db_prep_save(self, value, connection):
         if not value:
@@ -71,16 +68,20 @@ class CharField(fields.CharField):
 
     def get_prep_lookup(self, lookup_type, value):
         "Perform preliminary non-db specific lookup checks and conversions"
-        if lookup_type == 'endswith':
+        # string matching rules are usually case insensitive in LDAP, so
+        # the 'i' lookups translate to the same filters
+        if lookup_type in ['endswith', 'iendswith']:
             return "*%s" % escape_ldap_filter(value)
-        elif lookup_type == 'startswith':
+        elif lookup_type in ['startswith', 'istartswith']:
             return "%s*" % escape_ldap_filter(value)
         elif lookup_type in ['contains', 'icontains']:
             return "*%s*" % escape_ldap_filter(value)
-        elif lookup_type == 'exact':
+        elif lookup_type in ['exact', 'iexact', 'approx', 'gte', 'lte']:
             return escape_ldap_filter(value)
         elif lookup_type == 'in':
             return [escape_ldap_filter(v) for v in value]
+        elif lookup_type == 'isnull':
+            return bool(value)
 
         raise TypeError("CharField has invalid lookup: %s" % lookup_type)
 
@@ -104,6 +105,8 @@ class ImageField(fields.Field):
 
     def get_prep_lookup(self, lookup_type, value):
         "Perform preliminary non-db specific lookup checks and conversions"
+        if lookup_type == 'isnull':
+            return bool(value)
         raise TypeError("ImageField has invalid lookup: %s" % lookup_type)
 
 
@@ -117,6 +120,8 @@ class IntegerField(fields.IntegerField):
     def get_db_prep_lookup(self, lookup_type, value, connection,
                            prepared=False):
         "Returns field's value prepared for database lookup."
+        if lookup_type == 'in':
+            return self.get_prep_lookup(lookup_type, value)
         return [self.get_prep_lookup(lookup_type, value)]
 
     def get_db_prep_save(self, value, connection):
@@ -128,6 +133,10 @@ class IntegerField(fields.IntegerField):
         "Perform preliminary non-db specific lookup checks and conversions"
         if lookup_type in ('exact', 'gte', 'lte'):
             return value
+        elif lookup_type == 'in':
+            return list(value)
+        elif lookup_type == 'isnull':
+            return bool(value)
         raise TypeError("IntegerField has invalid lookup: %s" % lookup_type)
 
 
@@ -141,6 +150,8 @@ class FloatField(fields.FloatField):
     def get_db_prep_lookup(self, lookup_type, value, connection,
                            prepared=False):
         "Returns field's value prepared for database lookup."
+        if lookup_type == 'in':
+            return self.get_prep_lookup(lookup_type, value)
         return [self.get_prep_lookup(lookup_type, value)]
 
     def get_db_prep_save(self, value, connection):
@@ -152,6 +163,10 @@ class FloatField(fields.FloatField):
         "Perform preliminary non-db specific lookup checks and conversions"
         if lookup_type in ('exact', 'gte', 'lte'):
             return value
+        elif lookup_type == 'in':
+            return list(value)
+        elif lookup_type == 'isnull':
+            return bool(value)
         raise TypeError("FloatField has invalid lookup: %s" % lookup_type)
 
 
@@ -175,6 +190,8 @@ class ListField(fields.Field):
         "Perform preliminary non-db specific lookup checks and conversions"
         if lookup_type == 'contains':
             return escape_ldap_filter(value)
+        elif lookup_type == 'isnull':
+            return bool(value)
         raise TypeError("ListField has invalid lookup: %s" % lookup_type)
 
     def to_python(self, value):
@@ -227,4 +244,19 @@ class DateField(fields.DateField):
         "Perform preliminary non-db specific lookup checks and conversions"
         if lookup_type in ('exact',):
             return value
+        elif lookup_type == 'isnull':
+            return bool(value)
         raise TypeError("DateField has invalid lookup: %s" % lookup_type)
+
+
+if Lookup is not None:
+    class ApproximateMatch(Lookup):
+        """
+        The 'approx' lookup, translated by the LDAP compiler to an
+        approximate match filter such as (cn~=jon smith). What is
+        considered a match is up to the server, often a phonetic
+        comparison.
+        """
+        lookup_name = 'approx'
+
+    CharField.register_lookup(ApproximateMatch)
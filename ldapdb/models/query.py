@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+#
+# django-ldapdb
+# Copyright (c) 2009-2011, Bolloré telecom
+# Copyright (c) 2013, Jeremy Lainé
+# All rights reserved.
+#
+# See AUTHORS file for a full list of contributors.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     1. Redistributions of source code must retain the above copyright notice,
+#        this list of conditions and the following disclaimer.
+#
+#     2. Redistributions in binary form must reproduce the above copyright
+#        notice, this list of conditions and the following disclaimer in the
+#        documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+import logging
+
+import django.db.models
+from django.db import connections, router
+from django.db.models import signals
+
+from ldapdb.models.cache import invalidate_entry
+
+
+logger = logging.getLogger('ldapdb')
+
+
+class BulkWriteError(Exception):
+    """
+    Raised when some of the operations of a bulk write failed. The errors
+    attribute holds a list of (instance, exception) tuples, the other
+    operations were performed.
+    """
+    def __init__(self, errors):
+        self.errors = errors
+        super(BulkWriteError, self).__init__(
+            "%d LDAP operation(s) failed: %s" % (
+                len(errors),
+                ', '.join(['%s (%s)' % (obj.dn or obj.pk,
+                                        e.__class__.__name__)
+                           for obj, e in errors])))
+
+
+class QuerySet(django.db.models.query.QuerySet):
+    """
+    QuerySet for LDAP models, writing many entries at once by pipelining
+    the requests on a single connection.
+    """
+
+    def defer(self, *fields):
+        # the DN is needed to save or delete the entry and is always
+        # returned by the server, so it is never deferred
+        if fields != (None,):
+            fields = [f for f in fields if f != 'dn']
+        return super(QuerySet, self).defer(*fields)
+
+    def only(self, *fields):
+        if fields == (None,):
+            return super(QuerySet, self).only(*fields)
+        return super(QuerySet, self).only(*(fields + ('dn',)))
+
+    def bulk_create(self, objs):
+        """
+        Creates the entries for the given instances.
+
+        No signals are sent. If some entries could not be created,
+        BulkWriteError is raised once all the others were.
+        """
+        objs = list(objs)
+        if not objs:
+            return objs
+        connection = connections[self._db or router.db_for_write(self.model)]
+        operations = []
+        for obj in objs:
+            new_dn, entry = obj.build_entry(connection)
+            operations.append((obj, ('add', new_dn, entry)))
+        logger.debug("Creating %d LDAP entries" % len(operations))
+        errors = self._perform(connection, operations)
+        for obj, (kind, new_dn, entry) in operations:
+            if id(obj) not in errors:
+                obj.dn = new_dn
+                obj.saved_pk = obj.pk
+                obj.saved_values = obj._snapshot()
+        self._raise_errors(operations, errors)
+        return objs
+    bulk_create.alters_data = True
+
+    def bulk_update(self, objs, fields=None):
+        """
+        Saves the changes made to the given instances since they were
+        loaded, optionally restricted to the given field names.
+
+        Entries whose primary key changed are renamed first, and their
+        attributes only modified if the rename succeeded. No signals are
+        sent. If some entries could not be updated, BulkWriteError is
+        raised once all the others were.
+        """
+        objs = list(objs)
+        connection = connections[self._db or router.db_for_write(self.model)]
+        renames = []
+        modifies = []
+        for obj in objs:
+            modlist = obj.build_modlist(connection, fields=fields)
+            if not modlist:
+                continue
+            if obj.build_dn() != obj.dn:
+                renames.append((obj, ('rename', obj.dn, obj.build_rdn())))
+            modifies.append((obj, ('modify', None, modlist)))
+
+        logger.debug("Renaming %d and modifying %d LDAP entries" % (
+            len(renames), len(modifies)))
+        errors = self._perform(connection, renames)
+        for obj, op in renames:
+            if id(obj) not in errors:
+                obj.dn = obj.build_dn()
+        modifies = [(obj, ('modify', obj.dn, changes))
+                    for obj, (kind, dn, changes) in modifies
+                    if id(obj) not in errors]
+        errors.update(self._perform(connection, modifies))
+        for obj, op in modifies:
+            if id(obj) not in errors:
+                obj.saved_pk = obj.pk
+                obj.saved_values = obj._snapshot()
+        self._raise_errors(renames + modifies, errors)
+    bulk_update.alters_data = True
+
+    def delete(self):
+        """
+        Deletes the matching entries.
+
+        A post_delete signal is sent for each deleted entry, as done by
+        Model.delete(). If some entries could not be deleted,
+        BulkWriteError is raised once all the others were.
+        """
+        assert self.query.can_filter(), \
+            "Cannot use 'limit' or 'offset' with delete."
+
+        connection = connections[self._db or router.db_for_write(self.model)]
+        del_query = self._clone()
+        del_query._for_write = True
+        if signals.post_delete.has_listeners(self.model):
+            objs = list(del_query)
+        else:
+            # the instances are not needed, only fetch the DNs
+            objs = [self.model(dn=dn) for dn in
+                    del_query.values_list('dn', flat=True)]
+
+        operations = [(obj, ('delete', obj.dn, None)) for obj in objs]
+        logger.debug("Deleting %d LDAP entries" % len(operations))
+        errors = self._perform(connection, operations)
+        for obj, op in operations:
+            if id(obj) not in errors:
+                signals.post_delete.send(sender=obj.__class__, instance=obj)
+        self._result_cache = None
+        self._raise_errors(operations, errors)
+    delete.alters_data = True
+    delete.queryset_only = True
+
+    def _perform(self, connection, operations):
+        """
+        Performs a list of (instance, operation) tuples and returns a
+        dictionary mapping the id() of the instances whose operation failed
+        to the exception.
+        """
+        errors = {}
+        if operations:
+            for index, e in connection.bulk_s([op for obj, op in operations]):
+                errors[id(operations[index][0])] = e
+            for obj, (kind, dn, arg) in operations:
+                invalidate_entry(dn)
+        return errors
+
+    def _raise_errors(self, operations, errors):
+        if errors:
+            # an instance may have several operations, report it once
+            failed = []
+            for obj, op in operations:
+                if id(obj) in errors:
+                    failed.append((obj, errors.pop(id(obj))))
+            raise BulkWriteError(failed)
+
+
+class Manager(django.db.models.manager.Manager):
+    """
+    Manager returning QuerySets which can write many entries at once.
+    """
+    def get_queryset(self):
+        return QuerySet(self.model, using=self._db)
+
+    def bulk_update(self, *args, **kwargs):
+        return self.get_queryset().bulk_update(*args, **kwargs)
+    bulk_update.alters_data = True
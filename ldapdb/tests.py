@@ -30,15 +30,38 @@
 # POSSIBILITY OF SUCH DAMAGE.
 #
 
+import ldap
+from ldap.controls import SimplePagedResultsControl
+
+from django.db import connections
 from django.test import TestCase
 from django.db.models.sql.where import Constraint, AND, OR, WhereNode
 
 from ldapdb import escape_ldap_filter
-from ldapdb.backends.ldap.compiler import where_as_ldap
+from ldapdb.backends.ldap.base import DatabaseWrapper
+from ldapdb.backends.ldap.compiler import (SQLCompiler, clear_filter_cache,
+                                           filter_cache_stats, query_as_ldap,
+                                           where_as_ldap)
+from ldapdb.backends.ldap.pool import ConnectionPool
+from ldapdb.models import BulkWriteError, base
+from ldapdb.models.base import Model
+from ldapdb.models.cache import entry_cache
 from ldapdb.models.fields import (CharField, IntegerField, FloatField,
                                   ListField, DateField)
 
 
+class Person(Model):
+    base_dn = 'ou=people,dc=example,dc=org'
+    object_classes = ['inetOrgPerson']
+
+    uid = CharField(db_column='uid', primary_key=True)
+    cn = CharField(db_column='cn')
+    mail = CharField(db_column='mail')
+
+    class Meta:
+        managed = False
+
+
 class WhereTestCase(TestCase):
     def test_escape(self):
         self.assertEquals(escape_ldap_filter(u'fôöbàr'), u'fôöbàr')
@@ -163,3 +186,755 @@ class WhereTestCase(TestCase):
                    "bar"), OR)
         self.assertEquals(where_as_ldap(where), ("(|(cn=foo)(givenName=bar))",
                                                  []))
+
+    def test_char_field_iexact(self):
+        where = WhereNode()
+        where.add((Constraint("cn", "cn", CharField()), 'iexact', "Test"),
+                  AND)
+        self.assertEquals(where_as_ldap(where), ("(cn=Test)", []))
+
+        where = WhereNode()
+        where.add((Constraint("cn", "cn", CharField()), 'istartswith',
+                   "te*st"), AND)
+        self.assertEquals(where_as_ldap(where), ("(cn=te\\2ast*)", []))
+
+    def test_char_field_approx(self):
+        where = WhereNode()
+        where.add((Constraint("cn", "cn", CharField()), 'approx', "jon"), AND)
+        self.assertEquals(where_as_ldap(where), ("(cn~=jon)", []))
+
+    def test_char_field_approx_queryset(self):
+        query = Person.objects.filter(cn__approx="jon").query
+        self.assertEquals(query_as_ldap(query),
+                          "(&(objectClass=inetOrgPerson)(cn~=jon))")
+
+    def test_char_field_ordering(self):
+        where = WhereNode()
+        where.add((Constraint("modifyTimestamp", "modifyTimestamp",
+                              CharField()), 'gte', "20140101000000Z"), AND)
+        self.assertEquals(where_as_ldap(where),
+                          ("(modifyTimestamp>=20140101000000Z)", []))
+
+        where = WhereNode()
+        where.add((Constraint("cn", "cn", CharField()), 'lte', "te*st"), AND)
+        self.assertEquals(where_as_ldap(where), ("(cn<=te\\2ast)", []))
+
+    def test_isnull(self):
+        where = WhereNode()
+        where.add((Constraint("mail", "mail", CharField()), 'isnull', True),
+                  AND)
+        self.assertEquals(where_as_ldap(where), ("(!(mail=*))", []))
+
+        where = WhereNode()
+        where.add((Constraint("mail", "mail", CharField()), 'isnull', False),
+                  AND)
+        self.assertEquals(where_as_ldap(where), ("(mail=*)", []))
+
+    def test_in_single_and_empty(self):
+        where = WhereNode()
+        where.add((Constraint("cn", "cn", CharField()), 'in', ["foo", "foo"]),
+                  AND)
+        self.assertEquals(where_as_ldap(where), ("(cn=foo)", []))
+
+        where = WhereNode()
+        where.add((Constraint("cn", "cn", CharField()), 'in', []), AND)
+        where.add((Constraint("sn", "sn", CharField()), 'exact', "bar"), AND)
+        self.assertEquals(where_as_ldap(where), ("(!(objectClass=*))", []))
+
+        where.negate()
+        self.assertEquals(where_as_ldap(where), ("(objectClass=*)", []))
+
+    def test_negated_in(self):
+        where = WhereNode()
+        where.add((Constraint("uid", "uid", IntegerField()), 'in', [1, 2]),
+                  AND)
+        where.negate()
+        self.assertEquals(where_as_ldap(where), ("(!(|(uid=1)(uid=2)))", []))
+
+    def test_flatten_and_dedupe(self):
+        inner = WhereNode()
+        inner.add((Constraint("cn", "cn", CharField()), 'exact', "foo"), AND)
+        inner.add((Constraint("sn", "sn", CharField()), 'exact', "bar"), AND)
+        where = WhereNode()
+        where.add((Constraint("cn", "cn", CharField()), 'exact', "foo"), AND)
+        where.children.append(inner)
+        self.assertEquals(where_as_ldap(where), ("(&(cn=foo)(sn=bar))", []))
+
+        inner = WhereNode()
+        inner.add((Constraint("cn", "cn", CharField()), 'exact', "foo"), AND)
+        inner.add((Constraint("cn", "cn", CharField()), 'exact', "bar"), OR)
+        where = WhereNode()
+        where.add((Constraint("cn", "cn", CharField()), 'exact', "foo"), AND)
+        where.add((Constraint("cn", "cn", CharField()), 'exact', "baz"), OR)
+        where.children.append(inner)
+        self.assertEquals(where_as_ldap(where),
+                          ("(|(cn=foo)(cn=baz)(cn=bar))", []))
+
+
+class DummyConnection(object):
+    charset = 'utf-8'
+
+
+def named_field(field_class, name):
+    field = field_class(db_column=name)
+    field.set_attributes_from_name(name)
+    return field
+
+
+class SortTestCase(TestCase):
+    def setUp(self):
+        self.compiler = SQLCompiler(None, DummyConnection(), None)
+        self.entries = [
+            ('uid=c', {'cn': ['Charlie'], 'uidNumber': ['2']}),
+            ('uid=a', {'cn': ['alice'], 'uidNumber': ['3']}),
+            ('uid=b', {'cn': ['Bob'], 'uidNumber': ['2']}),
+        ]
+
+    def test_sort(self):
+        ordering = [(named_field(CharField, 'cn'), False)]
+        self.assertEquals(
+            [dn for dn, attrs in self.compiler.sort_entries(self.entries,
+                                                            ordering)],
+            ['uid=a', 'uid=b', 'uid=c'])
+
+    def test_sort_multiple_keys(self):
+        ordering = [(named_field(IntegerField, 'uidNumber'), True),
+                    (named_field(CharField, 'cn'), True)]
+        self.assertEquals(
+            [dn for dn, attrs in self.compiler.sort_entries(self.entries,
+                                                            ordering)],
+            ['uid=a', 'uid=c', 'uid=b'])
+
+    def test_sort_limit(self):
+        ordering = [(named_field(CharField, 'cn'), True)]
+        self.assertEquals(
+            [dn for dn, attrs in self.compiler.sort_entries(self.entries,
+                                                            ordering, 2)],
+            ['uid=c', 'uid=b'])
+
+
+class DummyLDAPObject(object):
+    def whoami_s(self):
+        return ''
+
+    def unbind_s(self):
+        pass
+
+
+class DummyConnectionPool(ConnectionPool):
+    def connect(self):
+        return DummyLDAPObject()
+
+
+class PoolTestCase(TestCase):
+    def test_reuse(self):
+        pool = DummyConnectionPool({'POOL_SIZE': 2})
+        with pool.connection() as first:
+            pass
+        with pool.connection() as second:
+            self.assertTrue(first is second)
+        stats = pool.stats()
+        self.assertEquals(stats['created'], 1)
+        self.assertEquals(stats['checkouts'], 2)
+        self.assertEquals(stats['idle'], 1)
+        self.assertEquals(stats['in_use'], 0)
+
+    def test_timeout(self):
+        pool = DummyConnectionPool({'POOL_SIZE': 1, 'POOL_TIMEOUT': 0.01})
+        with pool.connection():
+            self.assertRaises(ldap.TIMEOUT, pool.acquire)
+        self.assertEquals(pool.stats()['waits'], 1)
+
+    def test_server_down(self):
+        pool = DummyConnectionPool({'POOL_SIZE': 2})
+        with pool.connection() as first:
+            pass
+        try:
+            with pool.connection():
+                raise ldap.SERVER_DOWN()
+        except ldap.SERVER_DOWN:
+            pass
+        with pool.connection() as third:
+            self.assertFalse(third is first)
+        self.assertEquals(pool.stats()['discarded'], 1)
+
+    def test_error(self):
+        pool = DummyConnectionPool({'POOL_SIZE': 1})
+        try:
+            with pool.connection() as first:
+                raise ValueError()
+        except ValueError:
+            pass
+        with pool.connection() as second:
+            self.assertTrue(first is second)
+        self.assertEquals(pool.stats()['discarded'], 0)
+
+    def test_generator_closed(self):
+        pool = DummyConnectionPool({'POOL_SIZE': 1})
+
+        def search():
+            with pool.connection():
+                yield 1
+                yield 2
+        results = search()
+        next(results)
+        results.close()
+        stats = pool.stats()
+        self.assertEquals(stats['in_use'], 0)
+        self.assertEquals(stats['idle'], 1)
+
+    def test_idle_eviction(self):
+        pool = DummyConnectionPool({'POOL_SIZE': 2, 'POOL_MAX_IDLE': 0})
+        with pool.connection() as first:
+            pass
+        with pool.connection() as second:
+            self.assertFalse(first is second)
+        self.assertEquals(pool.stats()['discarded'], 1)
+
+
+class SizeLimitLDAPObject(object):
+    """
+    Returns a single entry, then fails as if the size limit was reached.
+    """
+    def search_ext(self, *args, **kwargs):
+        self.results = iter([(ldap.RES_SEARCH_ENTRY,
+                              [('uid=foo', {'uid': ['foo']})])])
+        return 1
+
+    def result3(self, msgid, all=1):
+        for result in self.results:
+            return result + (msgid, [])
+        raise ldap.SIZELIMIT_EXCEEDED()
+
+    def abandon(self, msgid):
+        pass
+
+
+class PagedLDAPObject(object):
+    """
+    Returns the entries page by page, as a server supporting the Simple
+    Paged Results control does, and records the (size, cookie) of each
+    paged search.
+    """
+    def __init__(self, entries):
+        self.entries = entries
+        self.pages = []
+
+    def search_ext(self, base, scope, filterstr, attrlist=None, attrsonly=0,
+                   serverctrls=None, sizelimit=0):
+        control = serverctrls[-1]
+        self.pages.append((control.size, control.cookie))
+        start = int(control.cookie or 0)
+        end = start + control.size
+        if control.size and end < len(self.entries):
+            cookie = str(end)
+        else:
+            cookie = ''
+        self.result = (ldap.RES_SEARCH_RESULT, self.entries[start:end], 1,
+                       [SimplePagedResultsControl(True, size=control.size,
+                                                  cookie=cookie)])
+        return 1
+
+    def search_ext_s(self, base, scope, filterstr, attrlist=None,
+                     attrsonly=0, serverctrls=None):
+        self.search_ext(base, scope, filterstr, attrlist, attrsonly,
+                        serverctrls)
+        return self.result[1]
+
+    def result3(self, msgid, all=1):
+        return self.result
+
+
+class SearchTestCase(TestCase):
+    entries = [('uid=%d,dc=example' % i, {'uid': [str(i)]}) for i in range(5)]
+
+    def setUp(self):
+        self.connection = DatabaseWrapper({}, 'ldap-test')
+
+    def search(self, sizelimit):
+        return list(self.connection._search_iter(
+            SizeLimitLDAPObject(), 'dc=example', ldap.SCOPE_SUBTREE,
+            '(objectClass=*)', None, 0, [], sizelimit, None))
+
+    def paged_search(self, ldap_object, sizelimit=0):
+        return self.connection._search_iter(
+            ldap_object, 'dc=example', ldap.SCOPE_SUBTREE, '(objectClass=*)',
+            None, 0, [], sizelimit, 2)
+
+    def test_requested_size_limit(self):
+        self.assertEquals(self.search(1), [(u'uid=foo', {'uid': ['foo']})])
+
+    def test_server_size_limit(self):
+        self.assertRaises(ldap.SIZELIMIT_EXCEEDED, self.search, 0)
+
+    def test_paged(self):
+        ldap_object = PagedLDAPObject(self.entries)
+        self.assertEquals(list(self.paged_search(ldap_object)), self.entries)
+        self.assertEquals(ldap_object.pages, [(2, ''), (2, '2'), (2, '4')])
+
+    def test_paged_size_limit(self):
+        # the cookie of the unfinished search is released
+        ldap_object = PagedLDAPObject(self.entries)
+        self.assertEquals(list(self.paged_search(ldap_object, 3)),
+                          self.entries[:3])
+        self.assertEquals(ldap_object.pages, [(2, ''), (2, '2'), (0, '4')])
+
+    def test_paged_stopped_early(self):
+        ldap_object = PagedLDAPObject(self.entries)
+        results = self.paged_search(ldap_object)
+        self.assertEquals(next(results), self.entries[0])
+        results.close()
+        self.assertEquals(ldap_object.pages, [(2, ''), (0, '2')])
+
+        # nothing to release once the last page was received
+        ldap_object = PagedLDAPObject(self.entries)
+        results = self.paged_search(ldap_object)
+        for i in range(5):
+            next(results)
+        results.close()
+        self.assertEquals(ldap_object.pages, [(2, ''), (2, '2'), (2, '4')])
+
+
+class FilterCacheTestCase(TestCase):
+    def setUp(self):
+        clear_filter_cache()
+
+    def test_cache(self):
+        before = filter_cache_stats()
+        where = WhereNode()
+        where.add((Constraint("uid", "uid", CharField()), 'exact', "foo"), AND)
+        self.assertEquals(where_as_ldap(where), ("(uid=foo)", []))
+
+        where = WhereNode()
+        where.add((Constraint("uid", "uid", CharField()), 'exact', "bar"), AND)
+        self.assertEquals(where_as_ldap(where), ("(uid=bar)", []))
+
+        after = filter_cache_stats()
+        self.assertEquals(after['misses'] - before['misses'], 1)
+        self.assertEquals(after['hits'] - before['hits'], 1)
+
+    def test_equal_values(self):
+        # duplicated clauses are only detected when the values are equal
+        where = WhereNode(connector=OR)
+        where.add((Constraint("uid", "uid", CharField()), 'exact', "foo"), OR)
+        where.add((Constraint("uid", "uid", CharField()), 'exact', "foo"), OR)
+        self.assertEquals(where_as_ldap(where), ("(uid=foo)", []))
+
+        where = WhereNode(connector=OR)
+        where.add((Constraint("uid", "uid", CharField()), 'exact', "foo"), OR)
+        where.add((Constraint("uid", "uid", CharField()), 'exact', "bar"), OR)
+        self.assertEquals(where_as_ldap(where), ("(|(uid=foo)(uid=bar))", []))
+
+
+class RecordingLDAPObject(DummyLDAPObject):
+    """
+    Records the write operations and answers searches with the given
+    entries. The operations on the DNs listed in fail_dns fail.
+    """
+    def __init__(self, entries=(), fail_dns=()):
+        self.entries = list(entries)
+        self.fail_dns = fail_dns
+        self.operations = []
+        self.searches = []
+        self.results = {}
+
+    def _record(self, kind, dn, arg):
+        self.operations.append((kind, dn, arg))
+        msgid = len(self.operations)
+        if dn in self.fail_dns:
+            self.results[msgid] = ldap.NO_SUCH_OBJECT()
+        else:
+            self.results[msgid] = (ldap.RES_ANY, [])
+        return msgid
+
+    def add_ext(self, dn, modlist):
+        return self._record('add', dn, modlist)
+
+    def modify_ext(self, dn, modlist):
+        return self._record('modify', dn, modlist)
+
+    def rename(self, dn, newrdn):
+        return self._record('rename', dn, newrdn)
+
+    def delete_ext(self, dn):
+        return self._record('delete', dn, None)
+
+    def delete_s(self, dn):
+        self.result3(self.delete_ext(dn))
+
+    def modify_s(self, dn, modlist):
+        self.result3(self.modify_ext(dn, modlist))
+
+    def rename_s(self, dn, newrdn):
+        self.result3(self.rename(dn, newrdn))
+
+    def search_ext(self, base, scope, filterstr, attrlist=None, attrsonly=0,
+                   serverctrls=None, sizelimit=0):
+        self.searches.append((base, scope, filterstr, attrlist, attrsonly,
+                              sizelimit))
+        msgid = len(self.operations) + len(self.results) + 1000
+        self.results[msgid] = (ldap.RES_SEARCH_RESULT, self.entries)
+        return msgid
+
+    def result3(self, msgid, all=1):
+        result = self.results.pop(msgid)
+        if isinstance(result, Exception):
+            raise result
+        return result + (msgid, [])
+
+
+class RecordingConnectionPool(ConnectionPool):
+    def __init__(self, ldap_object):
+        super(RecordingConnectionPool, self).__init__({'POOL_SIZE': 1})
+        self.ldap_object = ldap_object
+
+    def connect(self):
+        return self.ldap_object
+
+
+class RecordingDatabaseWrapper(DatabaseWrapper):
+    def __init__(self, ldap_object):
+        super(RecordingDatabaseWrapper, self).__init__({}, 'ldap-test')
+        self.recording_pool = RecordingConnectionPool(ldap_object)
+
+    @property
+    def pool(self):
+        return self.recording_pool
+
+
+class WriteTestCase(TestCase):
+    entry = ('uid=foo,ou=people,dc=example,dc=org',
+             {'uid': ['foo'], 'cn': ['Foo'], 'mail': ['foo@example.org']})
+
+    def setUp(self):
+        self.ldap_object = RecordingLDAPObject()
+        self.connection = RecordingDatabaseWrapper(self.ldap_object)
+        connections['ldap-test'] = self.connection
+
+    def tearDown(self):
+        del connections['ldap-test']
+
+    def load(self, dn, attrs):
+        return Person.from_ldap_entry(dn, attrs, self.connection)
+
+    def test_build_modlist(self):
+        person = self.load(*self.entry)
+        self.assertEquals(person.build_modlist(self.connection), [])
+
+        person.cn = 'Bar'
+        person.mail = ''
+        self.assertEquals(person.build_modlist(self.connection), [
+            (ldap.MOD_REPLACE, 'cn', ['Bar']),
+            (ldap.MOD_DELETE, 'mail', None)])
+        self.assertEquals(
+            person.build_modlist(self.connection, fields=['cn']),
+            [(ldap.MOD_REPLACE, 'cn', ['Bar'])])
+
+    def test_save_changed_attributes(self):
+        person = self.load(*self.entry)
+        person.cn = 'Bar'
+        person.save(using='ldap-test')
+        self.assertEquals(self.ldap_object.operations, [
+            ('modify', self.entry[0], [(ldap.MOD_REPLACE, 'cn', ['Bar'])])])
+
+        # nothing changed since the last save
+        person.save(using='ldap-test')
+        self.assertEquals(len(self.ldap_object.operations), 1)
+
+    def test_save_verify(self):
+        person = self.load(*self.entry)
+        # the entry was changed on the server since it was loaded
+        self.ldap_object.entries = [
+            (self.entry[0], dict(self.entry[1], cn=['Changed']))]
+        person.save(using='ldap-test')
+        self.assertEquals(self.ldap_object.operations, [])
+
+        person.save(using='ldap-test', verify=True)
+        self.assertEquals(self.ldap_object.operations, [
+            ('modify', self.entry[0], [(ldap.MOD_REPLACE, 'cn', ['Foo'])])])
+
+    def test_bulk_unknown_operation(self):
+        self.assertRaises(ValueError, self.connection.bulk_s, [
+            ('modify', self.entry[0], [(ldap.MOD_REPLACE, 'cn', ['Bar'])]),
+            ('frobnicate', self.entry[0], None)])
+        # nothing was sent
+        self.assertEquals(self.ldap_object.operations, [])
+
+    def test_bulk_create(self):
+        created = Person(uid='foo', cn='Foo')
+        failing = Person(uid='bar', cn='Bar')
+        self.ldap_object.fail_dns = ['uid=bar,ou=people,dc=example,dc=org']
+        try:
+            Person.objects.using('ldap-test').bulk_create([created, failing])
+        except BulkWriteError as e:
+            self.assertEquals([obj for obj, error in e.errors], [failing])
+        else:
+            self.fail("BulkWriteError not raised")
+
+        self.assertEquals(self.ldap_object.operations, [
+            ('add', 'uid=foo,ou=people,dc=example,dc=org', [
+                ('objectClass', ['inetOrgPerson']), ('uid', ['foo']),
+                ('cn', ['Foo'])]),
+            ('add', 'uid=bar,ou=people,dc=example,dc=org', [
+                ('objectClass', ['inetOrgPerson']), ('uid', ['bar']),
+                ('cn', ['Bar'])])])
+        # only the created entry is considered saved
+        self.assertEquals(created.dn, 'uid=foo,ou=people,dc=example,dc=org')
+        self.assertEquals(created.build_modlist(self.connection), [])
+        self.assertFalse(failing.dn)
+
+    def test_delete(self):
+        self.ldap_object.entries = [
+            self.entry, ('uid=bar,ou=people,dc=example,dc=org', {})]
+        self.ldap_object.fail_dns = ['uid=bar,ou=people,dc=example,dc=org']
+        try:
+            Person.objects.using('ldap-test').all().delete()
+        except BulkWriteError as e:
+            self.assertEquals([obj.dn for obj, error in e.errors],
+                              ['uid=bar,ou=people,dc=example,dc=org'])
+        else:
+            self.fail("BulkWriteError not raised")
+
+        # the deletions are pipelined, the failure does not stop them
+        self.assertEquals(self.ldap_object.operations, [
+            ('delete', self.entry[0], None),
+            ('delete', 'uid=bar,ou=people,dc=example,dc=org', None)])
+        # only the DNs were fetched
+        self.assertEquals(self.ldap_object.searches[0][2:4],
+                          ('(&(objectClass=inetOrgPerson))', ['1.1']))
+
+    def test_bulk_update(self):
+        unchanged = self.load(*self.entry)
+        changed = self.load('uid=bar,ou=people,dc=example,dc=org',
+                            {'uid': ['bar'], 'cn': ['Bar']})
+        changed.cn = 'Baz'
+        renamed = self.load('uid=baz,ou=people,dc=example,dc=org',
+                            {'uid': ['baz'], 'cn': ['Baz']})
+        renamed.uid = 'qux'
+        Person.objects.using('ldap-test').bulk_update(
+            [unchanged, changed, renamed])
+
+        # the renames are performed before the modifications
+        self.assertEquals(self.ldap_object.operations, [
+            ('rename', 'uid=baz,ou=people,dc=example,dc=org', 'uid=qux'),
+            ('modify', 'uid=bar,ou=people,dc=example,dc=org',
+             [(ldap.MOD_REPLACE, 'cn', ['Baz'])]),
+            ('modify', 'uid=qux,ou=people,dc=example,dc=org',
+             [(ldap.MOD_REPLACE, 'uid', ['qux'])])])
+        self.assertEquals(renamed.dn, 'uid=qux,ou=people,dc=example,dc=org')
+        self.assertEquals(changed.build_modlist(self.connection), [])
+
+    def test_bulk_update_errors(self):
+        failing = self.load(*self.entry)
+        failing.cn = 'Bar'
+        renamed = self.load('uid=baz,ou=people,dc=example,dc=org',
+                            {'uid': ['baz'], 'cn': ['Baz']})
+        renamed.uid = 'qux'
+        changed = self.load('uid=bar,ou=people,dc=example,dc=org',
+                            {'uid': ['bar'], 'cn': ['Bar']})
+        changed.cn = 'Baz'
+        self.ldap_object.fail_dns = [self.entry[0],
+                                     'uid=baz,ou=people,dc=example,dc=org']
+        try:
+            Person.objects.using('ldap-test').bulk_update(
+                [failing, renamed, changed])
+        except BulkWriteError as e:
+            self.assertEquals([obj for obj, error in e.errors],
+                              [renamed, failing])
+            self.assertTrue(all(isinstance(error, ldap.NO_SUCH_OBJECT)
+                                for obj, error in e.errors))
+        else:
+            self.fail("BulkWriteError not raised")
+
+        # the entry whose rename failed is not modified, the others are
+        self.assertEquals([op[:2] for op in self.ldap_object.operations], [
+            ('rename', 'uid=baz,ou=people,dc=example,dc=org'),
+            ('modify', self.entry[0]),
+            ('modify', 'uid=bar,ou=people,dc=example,dc=org')])
+        self.assertEquals(renamed.dn, 'uid=baz,ou=people,dc=example,dc=org')
+        self.assertEquals(failing.build_modlist(self.connection),
+                          [(ldap.MOD_REPLACE, 'cn', ['Bar'])])
+        self.assertEquals(changed.build_modlist(self.connection), [])
+
+    def test_bulk_update_errors_once(self):
+        failing = self.load(*self.entry)
+        failing.cn = 'Bar'
+        self.ldap_object.fail_dns = [self.entry[0]]
+        try:
+            Person.objects.using('ldap-test').bulk_update([failing, failing])
+        except BulkWriteError as e:
+            self.assertEquals([obj for obj, error in e.errors], [failing])
+        else:
+            self.fail("BulkWriteError not raised")
+
+
+class ReadTestCase(TestCase):
+    entries = [
+        ('uid=foo,ou=people,dc=example,dc=org',
+         {'uid': ['foo'], 'cn': ['Foo']}),
+        ('uid=bar,ou=people,dc=example,dc=org',
+         {'uid': ['bar'], 'cn': ['Bar']})]
+
+    def setUp(self):
+        self.ldap_object = RecordingLDAPObject(self.entries)
+        self.connection = RecordingDatabaseWrapper(self.ldap_object)
+        connections['ldap-test'] = self.connection
+
+    def tearDown(self):
+        del connections['ldap-test']
+
+    def test_count(self):
+        self.assertEquals(self.connection.count_s('dc=example,dc=org',
+                                                  ldap.SCOPE_SUBTREE), 2)
+        # no attributes are requested
+        self.assertEquals(self.ldap_object.searches, [
+            ('dc=example,dc=org', ldap.SCOPE_SUBTREE, '(objectClass=*)',
+             ['1.1'], 1, 0)])
+
+        self.assertEquals(Person.objects.using('ldap-test').count(), 2)
+        self.assertEquals(self.ldap_object.searches[-1][3:5], (['1.1'], 1))
+
+    def attrlist(self, queryset):
+        results = list(queryset)
+        return self.ldap_object.searches[-1][3], results
+
+    def test_entry_cache(self):
+        dn = self.entries[0][0]
+        self.ldap_object.entries = self.entries[:1]
+        with entry_cache():
+            person = Person.get_by_dn(dn, using='ldap-test')
+            self.assertTrue(Person.get_by_dn(dn, using='ldap-test') is person)
+            self.assertEquals(len(self.ldap_object.searches), 1)
+
+            # the entries written through the models are fetched again
+            person.cn = 'Baz'
+            person.save(using='ldap-test')
+            person = Person.get_by_dn(dn, using='ldap-test')
+            self.assertEquals(len(self.ldap_object.searches), 2)
+
+            person.cn = 'Baz'
+            Person.objects.using('ldap-test').bulk_update([person])
+            person = Person.get_by_dn(dn, using='ldap-test')
+            self.assertEquals(len(self.ldap_object.searches), 3)
+
+            person.delete(using='ldap-test')
+            self.ldap_object.entries = []
+            self.assertRaises(Person.DoesNotExist, Person.get_by_dn, dn,
+                              using='ldap-test')
+            self.assertEquals(len(self.ldap_object.searches), 4)
+
+        # nothing is cached outside of the block
+        Person.get_many([dn, dn], using='ldap-test')
+        self.assertEquals(len(self.ldap_object.searches), 6)
+
+    def test_only(self):
+        attrlist, results = self.attrlist(
+            Person.objects.using('ldap-test').only('cn'))
+        self.assertEquals(attrlist, ['uid', 'cn'])
+        self.assertEquals([person.cn for person in results], ['Foo', 'Bar'])
+        self.assertFalse('mail' in results[0].__dict__)
+
+    def test_defer(self):
+        attrlist, results = self.attrlist(
+            Person.objects.using('ldap-test').defer('cn'))
+        self.assertEquals(attrlist, ['uid', 'mail'])
+        self.assertEquals([person.uid for person in results], ['foo', 'bar'])
+        self.assertFalse('cn' in results[0].__dict__)
+
+    def test_distinct(self):
+        self.ldap_object.entries = self.entries + [
+            ('uid=baz,ou=people,dc=example,dc=org',
+             {'uid': ['baz'], 'cn': ['Foo']})]
+        queryset = Person.objects.using('ldap-test').values_list(
+            'cn', flat=True)
+        self.assertEquals(list(queryset), ['Foo', 'Bar', 'Foo'])
+        self.assertEquals(list(queryset.distinct()), ['Foo', 'Bar'])
+
+        # duplicates are dropped before slicing, the server is not asked
+        # to stop early
+        self.assertEquals(list(queryset.distinct()[1:2]), ['Bar'])
+        self.assertEquals(self.ldap_object.searches[-1][5], 0)
+        self.assertEquals(list(queryset.all()[1:2]), ['Bar'])
+        self.assertEquals(self.ldap_object.searches[-1][5], 2)
+
+    def test_values(self):
+        attrlist, results = self.attrlist(
+            Person.objects.using('ldap-test').values('cn'))
+        self.assertEquals(attrlist, ['cn'])
+        self.assertEquals(results, [{'cn': 'Foo'}, {'cn': 'Bar'}])
+
+        # only the DNs are needed
+        attrlist, results = self.attrlist(
+            Person.objects.using('ldap-test').values_list('dn', flat=True))
+        self.assertEquals(attrlist, ['1.1'])
+        self.assertEquals(results, [dn for dn, attrs in self.entries])
+
+    def test_resolve_dns(self):
+        dns = ['uid=%s,ou=people,dc=example,dc=org' % x for x in 'abc']
+        dns += ['cn=d,ou=people,dc=example,dc=org',
+                'uid=e,ou=other,dc=example,dc=org']
+        self.ldap_object.entries = [
+            (dn, {'uid': [dn[dn.index('=') + 1]]}) for dn in dns]
+        self.ldap_object.entries.append(
+            ('uid=x,ou=people,dc=example,dc=org', {'uid': ['x']}))
+
+        result = Person.resolve_dns(dns, using='ldap-test', chunk_size=2)
+        self.assertEquals(dict((dn, obj.uid) for dn, obj in result.items()),
+                          dict((dn, dn[dn.index('=') + 1]) for dn in dns))
+
+        # one search per parent, naming attribute and chunk of values
+        objectclass = '(objectClass=inetOrgPerson)'
+        self.assertEquals(sorted(search[:3] for search in
+                                 self.ldap_object.searches), [
+            ('ou=other,dc=example,dc=org', ldap.SCOPE_ONELEVEL,
+             '(&%s(|(uid=e)))' % objectclass),
+            ('ou=people,dc=example,dc=org', ldap.SCOPE_ONELEVEL,
+             '(&%s(|(cn=d)))' % objectclass),
+            ('ou=people,dc=example,dc=org', ldap.SCOPE_ONELEVEL,
+             '(&%s(|(uid=a)(uid=b)))' % objectclass),
+            ('ou=people,dc=example,dc=org', ldap.SCOPE_ONELEVEL,
+             '(&%s(|(uid=c)))' % objectclass)])
+        self.assertTrue(all(isinstance(search[0], str)
+                            for search in self.ldap_object.searches))
+
+
+class ScopedTestCase(TestCase):
+    def setUp(self):
+        self.size = base.SCOPED_CACHE_SIZE
+        base.SCOPED_CACHE_SIZE = 2
+
+    def tearDown(self):
+        base.SCOPED_CACHE_SIZE = self.size
+
+    def registered(self, model):
+        if hasattr(model._meta, 'apps'):
+            # django >= 1.7
+            return model in model._meta.apps.get_models()
+        from django.db.models.loading import get_models
+        return model in get_models()
+
+    def test_cache(self):
+        first = Person.scoped('ou=first,dc=example,dc=org')
+        self.assertTrue(first is Person.scoped('ou=first,dc=example,dc=org'))
+        self.assertEquals(first.base_dn, 'ou=first,dc=example,dc=org')
+        self.assertTrue(self.registered(first))
+
+    def test_eviction(self):
+        first = Person.scoped('ou=first,dc=example,dc=org')
+        second = Person.scoped('ou=second,dc=example,dc=org')
+        self.assertTrue(self.registered(first))
+
+        # the least recently used class is evicted
+        self.assertTrue(first is Person.scoped('ou=first,dc=example,dc=org'))
+        Person.scoped('ou=third,dc=example,dc=org')
+        self.assertFalse(self.registered(second))
+        self.assertTrue(self.registered(first))
+        self.assertFalse(
+            second is Person.scoped('ou=second,dc=example,dc=org'))
+
+    def test_unregister(self):
+        # the lists of models cached by the registry are updated too
+        model = Person.scoped('ou=unregistered,dc=example,dc=org')
+        self.assertTrue(self.registered(model))
+        base._unregister_model(model)
+        self.assertFalse(self.registered(model))
@@ -3,31 +3,76 @@
 u''' @package ldapsync.ldapsync
 Moduł zapewniający funkcje synchronizujące lokalną bazę danych z bazą LDAP i przydzielające uprawnienia użytkownikom.
 
-Podczas synchronizacji dane w bazie powinny zostać uznane za niespójne,
-tzn. serwis powinien być chwilowo niedostępny z zewnątrz.
+Etapy synchronizacji są wykonywane kolejno, w jednym wątku. Równolegle (patrz SYNC_PARALLEL) pobierane są
+jedynie wpisy LDAP, przed rozpoczęciem pierwszego etapu.
+Każdy etap jest wykonywany w osobnej transakcji (patrz SYNC_COMMIT_BATCH_SIZE),
+więc pozostałe połączenia z bazą nie widzą częściowo zsynchronizowanych danych etapu.
+Pomiędzy etapami dane w bazie mogą być jednak chwilowo niespójne, chyba że synchronizacja jest przeprowadzana
+z parametrem staged - wtedy wszystkie zmiany są zapisywane w jednej, krótkiej transakcji.
 
-LdapSync.sync() metoda przeprowadza pełną synchronizację.
+LdapSync.sync() metoda przeprowadza pełną synchronizację, a LdapSync.sync(incremental=True)
+synchronizację przyrostową, obejmującą jedynie wpisy LDAP zmienione od poprzedniej synchronizacji.
+LdapSync.syncEntries() i LdapSync.syncDeletions() stosują zmiany zgłaszane przez serwer LDAP (moduł ldapsync.syncrepl),
+a LdapSync.syncDependents() synchronizuje po nich jednostki organizacyjne, władze wydziału i uprawnienia.
 '''
 
 import pytz
+import ldap
 import logging
-from datetime import datetime
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from functools import partial
+from ldap.dn import str2dn, dn2str
+from datetime import datetime, timedelta
 from django.utils import timezone
 from django.contrib.auth.models import User
+from django.db import connections, transaction
 from django.db.models import Q
 from models import LdapStudent, LdapStudyCycle, LdapEmployee, LdapOrganizationalUnit, LdapOrganization, LdapAuthorities
 from models import DoesNotExist as ldapModels_DoesNotExist
+from models import SyncState
 from faculty.models import Student, StudyCycle, Employee, OrganizationalUnit, Organization, Authority
 from collections import namedtuple
+from ldapdb.backends.ldap.compiler import filter_cache_stats
+from ldapdb.models import entry_cache
+from ldapdb.models.cache import normalize_dn
 import permissions
 
+### Maksymalna liczba parametrów pojedynczego zapytania SQL (SQLite dopuszcza ich najwyżej 999)
+SQL_BATCH_SIZE = 500
+### Margines (w sekundach) odejmowany od znacznika czasu synchronizacji przyrostowej na wypadek rozbieżności zegarów
+SYNC_CLOCK_SKEW = 300
+### Odstęp (w sekundach) pomiędzy wyszukiwaniami wpisów usuniętych z bazy LDAP w trybie synchronizacji przyrostowej
+SYNC_SWEEP_INTERVAL = 3600
+### Czy wpisy LDAP potrzebne etapom synchronizacji są pobierane równolegle, przed wykonaniem etapów
+### (patrz LdapSync.__fetchSnapshot()); równoległe jest jedynie pobieranie - etapy są zawsze wykonywane kolejno,
+### w jednym wątku, a bez parametru staged każdy z nich zapisuje zmiany w osobnej transakcji
+SYNC_PARALLEL = True
+### Liczba wpisów LDAP, których obiekty są zapisywane pojedynczo w jednej transakcji;
+### None oznacza jedną transakcję na cały etap synchronizacji
+SYNC_COMMIT_BATCH_SIZE = None
+
+
+class SnapshotError(Exception):
+    u'''
+    Wyjątek wyrzucany wtedy, gdy migawka wpisów pobrana z bazy LDAP (synchronizacja z parametrem staged)
+    nie przeszła sprawdzenia i nie została zapisana w bazie.
+    '''
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return "LDAP snapshot rejected: %s." % (self.value)
+
 
 class LdapSync:
     u'''
     Klasa zapewniająca funkcje synchronizujące lokalną bazę danych z bazą LDAP.
 
-    Podczas synchronizacji dane w bazie powinny zostać uznane za niespójne,
-    tzn. serwis powinien być chwilowo niedostępny z zewnątrz.
+    Etapy synchronizacji są wykonywane kolejno, każdy w osobnej transakcji,
+    ale pomiędzy etapami dane w bazie mogą być chwilowo niespójne.
     '''
 
     class InstancesCounter:
@@ -43,12 +88,25 @@ class LdapSync:
             self.deleted = 0
             ### Licznik obiektów oznaczonych jako zsynchronizowane z bazą LDAP.
             self.synced = 0
+            ### Licznik istniejących obiektów, których dane uległy zmianie.
+            self.changed = 0
+            ### Licznik istniejących obiektów, których dane nie uległy zmianie.
+            self.unchanged = 0
             ### Licznik obiektów, które pozostały niezsynchronizowane z bazą LDAP.
             self.nonSynced = 0
 
+    ### migawka wpisów LDAP pobranych przed wykonaniem etapów synchronizacji, patrz LdapSync.__staging()
+    __snapshot = threading.local()
+    ### odpowiadające sobie nazwy ról władz wydziału w bazie LDAP i w bazie lokalnej
+    __authorityRoles = (
+        (LdapAuthorities.DEAN, Authority.DEAN),
+        (LdapAuthorities.VICE_DEAN_FOR_PROMOTION, Authority.VICE_DEAN_FOR_PROMOTION),
+        (LdapAuthorities.VICE_DEAN_FOR_RESEARCH, Authority.VICE_DEAN_FOR_RESEARCH),
+        (LdapAuthorities.VICE_DEAN_FOR_STUDENTS, Authority.VICE_DEAN_FOR_STUDENTS),
+    )
 
     @classmethod
-    def sync(cls, logger=None):
+    def sync(cls, logger=None, incremental=False, staged=False):
         u'''
         Metoda wykonująca wszystkie kroki synchronizacji we właściwej kolejności.
 
@@ -57,141 +115,645 @@ class LdapSync:
             to zostanie użyta domyślna instancja zwracana przez logging.getLogger(__name__).
             Jeśli instancja ta nie będzie miała przypisanego żadnego handlera, to przypisany
             zostanie handler typu logging.NullHandler.
+        @param incremental bool Jeśli jest ustawiony, to studenci, cykle kształcenia, pracownicy i organizacje
+            są synchronizowani tylko na podstawie wpisów LDAP zmienionych (atrybut modifyTimestamp)
+            od poprzedniej synchronizacji, a wpisy usunięte z bazy LDAP są wyszukiwane co SYNC_SWEEP_INTERVAL sekund.
+            Jeśli synchronizacja nie była wcześniej przeprowadzona, to zostanie przeprowadzona pełna synchronizacja.
+        @param staged bool Jeśli jest ustawiony, to wpisy LDAP są najpierw pobierane do pamięci i sprawdzane,
+            a dopiero potem wszystkie etapy są wykonywane w jednej transakcji (patrz LdapSync.__staging()).
+            Pozostałe połączenia z bazą widzą wtedy do końca synchronizacji poprzedni stan danych.
+        '''
+        logger = cls.__prepareLogger(logger)
+
+        state = SyncState.load()
+        startedAt = timezone.now()
+        since = state.highWaterMark if incremental else None
+        if incremental and since is None:
+            logger.info(u'Brak znacznika poprzedniej synchronizacji, zostanie przeprowadzona pełna synchronizacja.')
+        elif since is not None:
+            logger.info(u'Synchronizacja przyrostowa wpisów zmienionych od %s.', since)
+        lookups = {'modifyTimestamp__gte': since} if since is not None else None
+
+        #w trybie przyrostowym wpisy usunięte z bazy LDAP są wyszukiwane co SYNC_SWEEP_INTERVAL sekund
+        sweep = since is not None and (
+            state.lastSweepAt is None or startedAt - state.lastSweepAt >= timedelta(seconds=SYNC_SWEEP_INTERVAL))
+
+        #użytkownicy wskazani w bazie LDAP jako kierownicy jednostek organizacyjnych
+        departmentHeads = set()
+        # każdy wpis LDAP jest pobierany co najwyżej raz w trakcie synchronizacji
+        with entry_cache(), cls.__staging(logger, lookups, staged, sweep):
+            permissions.initialize()
+
+            #etapy synchronizacji: (nazwa, funkcja), w kolejności wykonywania
+            cls.__runPhases(logger, (
+                (u'studentów', lambda: cls.__syncStudents(logger, lookups)),
+                (u'cyklów kształcenia', lambda: cls.__syncStudyCycles(logger, lookups)),
+                (u'pracowników', lambda: cls.__syncEmployees(logger, lookups)),
+                (u'jednostek organizacyjnych', lambda: departmentHeads.update(cls.__syncOrganizationalUnits(logger))),
+                (u'organizacji', lambda: cls.__syncOrganizations(logger, lookups)),
+                (u'władz wydziału', lambda: cls.__syncAuthorities(logger)),
+            ))
+
+            if since is None:
+                state.lastFullSyncAt = startedAt
+                state.lastSweepAt = startedAt
+            elif sweep:
+                logger.info(u'Wyszukiwanie wpisów usuniętych z bazy LDAP...')
+                with transaction.atomic():
+                    cls.__sweep(logger)
+                state.lastSweepAt = startedAt
+            cls.__syncPermissions(logger, departmentHeads)
+        state.highWaterMark = (startedAt - timedelta(seconds=SYNC_CLOCK_SKEW)).astimezone(pytz.utc).strftime('%Y%m%d%H%M%SZ')
+        state.save()
+        logger.info(u'Synchronizacja zakończona.')
+        cacheStats = filter_cache_stats()
+        logger.debug(u'Bufor skompilowanych filtrów LDAP: %s trafień, %s chybień.', cacheStats['hits'], cacheStats['misses'])
+
+    @classmethod
+    def syncEntries(cls, dns, logger=None):
+        u'''
+        Synchronizuje obiekty odpowiadające podanym, dodanym lub zmienionym wpisom LDAP
+        (np. zgłoszonym przez serwer LDAP, patrz moduł ldapsync.syncrepl). Studenci, cykle kształcenia,
+        pracownicy i organizacje są synchronizowani tylko na podstawie podanych wpisów, w jednej transakcji.
+        Jednostki organizacyjne, władze wydziału i uprawnienia nie są synchronizowane - należy następnie wywołać
+        LdapSync.syncDependents(), także raz dla wielu wywołań tej metody.
+
+        @param dns iterable Distinguished Names wpisów LDAP
+        @param logger logging.Logger patrz LdapSync.sync()
+        @returns tuple (bool, bool) czy wśród wpisów są wpisy jednostek organizacyjnych, czy wpisy władz wydziału
+        '''
+        logger = cls.__prepareLogger(logger)
+
+        #przyporządkuj wpisy do modeli na podstawie ich położenia w drzewie LDAP
+        dnsByModel = {}
+        unitsDn = normalize_dn(LdapOrganizationalUnit.base_dn)
+        authoritiesDn = normalize_dn(LdapAuthorities.base_dn)
+        syncUnits = syncAuthorities = False
+        for dn in dns:
+            if not isinstance(dn, unicode):
+                dn = dn.decode('utf-8')
+            normalizedDn = normalize_dn(dn)
+            if normalizedDn == unitsDn or normalizedDn.endswith(',' + unitsDn):
+                syncUnits = True
+            elif normalizedDn == authoritiesDn or normalizedDn.endswith(',' + authoritiesDn):
+                syncAuthorities = True
+            else:
+                for ldapModel in (LdapStudent, LdapStudyCycle, LdapEmployee, LdapOrganization):
+                    if cls.__inScope(dn, ldapModel):
+                        dnsByModel.setdefault(ldapModel, []).append(dn)
+                        break
+                else:
+                    logger.info(u'Pominięto zmieniony wpis LDAP "%s", który nie odpowiada żadnemu synchronizowanemu obiektowi.', dn)
+
+        with entry_cache():
+            #wpisy spoza bazowego węzła modelu są pobierane z bazy LDAP przed rozpoczęciem transakcji
+            names = {}
+            for ldapModel, modelDns in dnsByModel.iteritems():
+                modelNames = cls.__namesByDn(ldapModel, modelDns)
+                for dn in modelDns:
+                    if dn not in modelNames:
+                        logger.info(u'Pominięto zmieniony wpis LDAP "%s", którego nie odnaleziono wśród wpisów %s.',
+                                    dn, ldapModel.__name__)
+                if modelNames:
+                    names[ldapModel] = modelNames.values()
+
+            #zmiany zgłoszone razem są stosowane w jednej transakcji
+            with transaction.atomic():
+                if LdapStudent in names:
+                    cls.__syncStudents(logger, {'pk__in': names[LdapStudent]})
+                if LdapStudyCycle in names:
+                    cls.__syncStudyCycles(logger, {'pk__in': names[LdapStudyCycle]})
+                if LdapEmployee in names:
+                    cls.__syncEmployees(logger, {'pk__in': names[LdapEmployee]})
+                if LdapOrganization in names:
+                    cls.__syncOrganizations(logger, {'pk__in': names[LdapOrganization]})
+        return syncUnits, syncAuthorities
+
+    @classmethod
+    def syncDeletions(cls, logger=None):
+        u'''
+        Oznacza jako niezsynchronizowane obiekty, których wpisy zostały usunięte z bazy LDAP.
+        Następnie należy wywołać LdapSync.syncDependents() dla jednostek organizacyjnych i władz wydziału.
+
+        @param logger logging.Logger patrz LdapSync.sync()
+        '''
+        logger = cls.__prepareLogger(logger)
+        with entry_cache(), transaction.atomic():
+            cls.__sweep(logger)
+
+    @classmethod
+    def syncDependents(cls, logger=None, units=True, authorities=True):
+        u'''
+        Synchronizuje ponownie jednostki organizacyjne i władze wydziału, a następnie uzgadnia uprawnienia,
+        po zastosowaniu zmian przez LdapSync.syncEntries() i LdapSync.syncDeletions().
+        Etapy te obejmują całą bazę LDAP, więc wystarczy je wykonać raz dla wielu paczek zmian.
+        Jeśli jednostki organizacyjne nie są synchronizowane, to przynależność do grupy kierowników katedr
+        pozostaje bez zmian.
+
+        @param logger logging.Logger patrz LdapSync.sync()
+        @param units bool czy synchronizować jednostki organizacyjne
+        @param authorities bool czy synchronizować władze wydziału
+        '''
+        logger = cls.__prepareLogger(logger)
+        with entry_cache(), transaction.atomic():
+            departmentHeads = cls.__syncOrganizationalUnits(logger) if units else None
+            if authorities:
+                cls.__syncAuthorities(logger)
+            cls.__syncPermissions(logger, departmentHeads)
+
+
+    @staticmethod
+    def __prepareLogger(logger):
+        u'''
+        Zwraca logger, który należy użyć do wypisania przebiegu synchronizacji (patrz LdapSync.sync()).
         '''
         if not logger:
             logger = logging.getLogger(__name__)
         if len(logger.handlers) == 0:
             logger.addHandler(logging.NullHandler())
-        
-        permissions.prepareForSync()
-
-        logger.info(u'Synchronizacja studentów...')
-        cls.__syncStudents(logger)
-        logger.info(u'Synchronizacja cyklów kształcenia...')
-        cls.__syncStudyCycles(logger)
-        logger.info(u'Synchronizacja pracowników...')
-        cls.__syncEmployees(logger)
-        logger.info(u'Synchronizacja jednostek organizacyjnych...')
-        cls.__syncOrganizationalUnits(logger)
-        logger.info(u'Synchronizacja organizacji...')
-        cls.__syncOrganizations(logger)
-        logger.info(u'Synchronizacja władz wydziału...')
-        cls.__syncAuthorities(logger)
-        logger.info(u'Synchronizacja zakończona.')
+        return logger
+
+    @staticmethod
+    def __runPhases(logger, phases):
+        u'''
+        Wykonuje kolejno etapy synchronizacji, mierząc czas ich trwania.
+        Jeśli SYNC_COMMIT_BATCH_SIZE nie jest ustawione, to każdy etap jest wykonywany w osobnej transakcji.
+        Etapy są wykonywane w jednym wątku, bo równoległe etapy zapisywałyby te same obiekty User
+        (np. użytkownika, który jest jednocześnie studentem i pracownikiem); równolegle pobierane są
+        jedynie wpisy LDAP (patrz LdapSync.__fetchSnapshot()).
+
+        @param logger logging.Logger patrz LdapSync.sync()
+        @param phases list krotki (nazwa, funkcja), w kolejności wykonywania
+        '''
+        for name, function in phases:
+            logger.info(u'Synchronizacja %s...', name)
+            startedAt = time.time()
+            if SYNC_COMMIT_BATCH_SIZE is None:
+                with transaction.atomic():
+                    function()
+            else:
+                function()
+            logger.info(u'Synchronizacja %s zakończona w %.1f s.', name, time.time() - startedAt)
+
+    @classmethod
+    @contextmanager
+    def __staging(cls, logger, lookups, staged, sweep):
+        u'''
+        Jeśli parametr staged jest ustawiony, to pobiera z bazy LDAP migawkę wszystkich danych potrzebnych
+        etapom synchronizacji, sprawdza ją (patrz LdapSync.__validateSnapshot()), a następnie wykonuje blok
+        w jednej transakcji, w której etapy korzystają z migawki (LdapSync.__fromSnapshot()) i bufora wpisów
+        (ldapdb.models.entry_cache()) zamiast odpytywać bazę LDAP. Dzięki temu transakcja trwa krótko,
+        a pozostałe połączenia z bazą nie widzą częściowo zsynchronizowanych danych.
+        W przeciwnym razie, jeśli ustawione jest SYNC_PARALLEL, to migawka jest pobierana równolegle i wykorzystywana
+        przez etapy bez sprawdzania, a jeśli nie - blok jest po prostu wykonywany.
+
+        @param lookups dict warunki, które muszą spełniać synchronizowane wpisy LDAP (patrz LdapSync.sync())
+        @param sweep bool czy w bloku będą wyszukiwane wpisy usunięte z bazy LDAP (LdapSync.__sweep())
+        '''
+        if not staged and not SYNC_PARALLEL:
+            yield
+            return
+
+        logger.info(u'Pobieranie migawki wpisów z bazy LDAP...')
+        startedAt = time.time()
+        snapshot = cls.__fetchSnapshot(lookups, sweep)
+        if staged:
+            #wpisy odczytywane przez etapy pojedynczo trafiają do bufora wpisów (ldapdb.models.entry_cache()),
+            # razem z informacją o wpisach, których nie ma
+            for ldapOrganizationalUnit in snapshot[LdapOrganizationalUnit]:
+                ldapOrganizationalUnit.head
+            for ldapName, localName in cls.__authorityRoles:
+                try:
+                    LdapAuthorities.getAuthority(ldapName)
+                except ldapModels_DoesNotExist:
+                    pass
+            cls.__namesByDn(LdapStudent, set(studentDn for ldapStudyCycle in snapshot[LdapStudyCycle]
+                                             for studentDn in ldapStudyCycle.studentsDnList))
+            cls.__namesByDn(LdapEmployee, snapshot['employeesIndex'].keys())
+        logger.info(u'Pobrano migawkę wpisów z bazy LDAP w %.1f s.', time.time() - startedAt)
+
+        cls.__snapshot.entries = snapshot
+        try:
+            if staged:
+                cls.__validateSnapshot(logger, snapshot, lookups)
+                with transaction.atomic():
+                    yield
+            else:
+                yield
+        finally:
+            cls.__snapshot.entries = None
+
+    @classmethod
+    def __fetchSnapshot(cls, lookups, sweep):
+        u'''
+        Pobiera z bazy LDAP wpisy synchronizowane przez wszystkie etapy, indeks pracowników jednostek organizacyjnych
+        oraz, jeśli parametr sweep jest ustawiony, identyfikatory wszystkich wpisów (patrz LdapSync.__sweep()).
+        Jeśli SYNC_PARALLEL jest ustawione, to każde zapytanie jest wykonywane w osobnym wątku
+        (z osobnym połączeniem z bazą LDAP). Wątki jedynie odczytują bazę LDAP - nie korzystają z lokalnej bazy.
+
+        @param lookups dict warunki, które muszą spełniać synchronizowane wpisy LDAP (patrz LdapSync.sync())
+        @returns dict migawka, patrz LdapSync.__fromSnapshot()
+        '''
+        queries = [(ldapModel, partial(cls.__ldapObjects, ldapModel, lookups))
+                   for ldapModel in (LdapStudent, LdapStudyCycle, LdapEmployee, LdapOrganization)]
+        queries.append((LdapOrganizationalUnit, partial(cls.__ldapObjects, LdapOrganizationalUnit)))
+        queries.append(('employeesIndex', cls.__fetchEmployeesIndex))
+        if sweep:
+            queries.extend((('ldapIds', ldapModel), partial(cls.__fetchLdapIds, ldapModel))
+                           for ldapModel in (LdapStudent, LdapStudyCycle, LdapEmployee, LdapOrganization))
+        snapshot = {}
+        if not SYNC_PARALLEL:
+            for key, fetch in queries:
+                snapshot[key] = fetch()
+            return snapshot
+
+        errors = []
+
+        def worker(key, fetch):
+            try:
+                snapshot[key] = fetch()
+            except Exception:
+                errors.append(sys.exc_info())
+            finally:
+                for connection in connections.all():
+                    connection.close()
+
+        threads = [threading.Thread(target=worker, args=query) for query in queries]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
+        return snapshot
+
+    @classmethod
+    def __fromSnapshot(cls, key, fetch):
+        u'''
+        Zwraca dane zapisane w migawce pod danym kluczem (model LDAP, 'employeesIndex' albo ('ldapIds', model LDAP)),
+        a jeśli migawka nie jest używana lub ich nie zawiera - wynik funkcji fetch, odpytującej bazę LDAP.
+        '''
+        snapshot = getattr(cls.__snapshot, 'entries', None)
+        if snapshot is not None and key in snapshot:
+            return snapshot[key]
+        return fetch()
+
+    @staticmethod
+    def __fetchEmployeesIndex():
+        u'''
+        Buduje od nowa i zwraca indeks LdapOrganizationalUnit.getEmployeesIndex().
+        '''
+        LdapOrganizationalUnit.clearEmployeesIndex()
+        return LdapOrganizationalUnit.getEmployeesIndex()
+
+    @staticmethod
+    def __fetchLdapIds(ldapModel):
+        u'''
+        Zwraca zbiór kluczy głównych wszystkich wpisów LDAP danego modelu.
+        '''
+        return set(ldapModel.objects.values_list(ldapModel._meta.pk.name, flat=True))
+
+    @staticmethod
+    def __validateSnapshot(logger, snapshot, lookups):
+        u'''
+        Sprawdza migawkę wpisów LDAP przed zapisaniem jej w bazie. Pełna synchronizacja na podstawie migawki,
+        w której brakuje wszystkich wpisów danego rodzaju, choć w bazie są obiekty zsynchronizowane z bazą LDAP,
+        oznaczyłaby je wszystkie jako niezsynchronizowane - najczęściej jest to skutek błędu konfiguracji lub serwera LDAP.
+
+        @throws SnapshotError jeśli migawka nie powinna zostać zapisana w bazie
+        '''
+        if lookups is not None:
+            return
+        for ldapModel, localModel in ((LdapStudent, Student), (LdapStudyCycle, StudyCycle),
+                                      (LdapEmployee, Employee), (LdapOrganization, Organization)):
+            if not snapshot[ldapModel] and localModel.objects.filter(isLdapSynced=True).exists():
+                logger.error(u'Baza LDAP nie zwróciła żadnych wpisów %s, a w bazie są zsynchronizowane obiekty %s. '
+                             u'Synchronizacja została przerwana.', ldapModel.__name__, localModel.__name__)
+                raise SnapshotError('no %s entries' % ldapModel.__name__)
+
+    @classmethod
+    def __ldapObjects(cls, ldapModel, lookups=None):
+        u'''
+        Zwraca listę wpisów LDAP danego modelu spełniających podane warunki: z migawki, jeśli jest używana
+        (patrz LdapSync.__staging()), a w przeciwnym razie bezpośrednio z bazy LDAP.
+
+        @param lookups dict warunki, które muszą spełniać wpisy LDAP, albo None - wszystkie wpisy
+        '''
+        if lookups is None:
+            return cls.__fromSnapshot(ldapModel, lambda: list(ldapModel.objects.all()))
+        return cls.__fromSnapshot(ldapModel, lambda: list(ldapModel.objects.filter(**lookups)))
+
+    @staticmethod
+    def __childName(dn, parentDn, attribute):
+        u'''
+        Zwraca wartość pierwszego RDN wpisu, jeśli leży on bezpośrednio pod wskazanym wpisem,
+        a RDN składa się z jednego, wskazanego atrybutu.
+
+        @param dn string Distinguished Name wpisu
+        @param parentDn string znormalizowany (ldapdb.models.cache.normalize_dn()) Distinguished Name wpisu nadrzędnego
+        @param attribute string nazwa atrybutu RDN (np. uid)
+        @returns unicode wartość RDN (np. nazwa użytkownika) albo None
+        '''
+        try:
+            rdns = str2dn(dn.encode('utf-8') if isinstance(dn, unicode) else dn)
+        except ldap.DECODING_ERROR:
+            return None
+        if not rdns or len(rdns[0]) != 1 or rdns[0][0][0].lower() != attribute.lower():
+            return None
+        if normalize_dn(dn2str(rdns[1:]).decode('utf-8')) != parentDn:
+            return None
+        return rdns[0][0][1].decode('utf-8')
+
+    @staticmethod
+    def __inScope(dn, ldapModel):
+        u'''
+        Sprawdza, czy wpis leży w zakresie wyszukiwania modelu LDAP: w poddrzewie ldapModel.base_dn,
+        a dla modeli wyszukujących z ldap.SCOPE_ONELEVEL - bezpośrednio pod ldapModel.base_dn.
+
+        @param dn string Distinguished Name wpisu
+        '''
+        baseDn = normalize_dn(ldapModel.base_dn)
+        if not normalize_dn(dn).endswith(',' + baseDn):
+            return False
+        if ldapModel.search_scope != ldap.SCOPE_ONELEVEL:
+            return True
+        try:
+            rdns = str2dn(dn.encode('utf-8') if isinstance(dn, unicode) else dn)
+        except ldap.DECODING_ERROR:
+            return False
+        return normalize_dn(dn2str(rdns[1:]).decode('utf-8')) == baseDn
+
+    @classmethod
+    def __namesByDn(cls, ldapModel, dns):
+        u'''
+        Wyznacza wartości klucza głównego (np. nazwy użytkowników) wpisów LDAP danego modelu o podanych DN.
+        Wartość jest odczytywana z RDN tylko wtedy, gdy jest nim atrybut klucza głównego, a wpis leży bezpośrednio
+        pod ldapModel.base_dn; pozostałe wpisy z zakresu wyszukiwania modelu (LdapSync.__inScope())
+        są pobierane zbiorczo z bazy LDAP (ldapdb.models.Model.resolve_dns()).
+
+        @param dns iterable Distinguished Names wpisów
+        @returns dict słownik, w którym kluczem jest DN, a wartością klucz główny wpisu;
+            wpisy spoza zakresu modelu i wpisy, których nie odnaleziono, są pomijane
+        '''
+        baseDn = normalize_dn(ldapModel.base_dn)
+        pk = ldapModel._meta.pk
+        names = {}
+        unresolved = []
+        for dn in dns:
+            name = cls.__childName(dn, baseDn, pk.db_column)
+            if name is not None:
+                names[dn] = name
+            elif cls.__inScope(dn, ldapModel):
+                unresolved.append(dn)
+        if unresolved:
+            for dn, ldapObject in ldapModel.resolve_dns(unresolved).iteritems():
+                names[dn] = getattr(ldapObject, pk.attname)
+        return names
+
+    @staticmethod
+    def __batches(items):
+        u'''
+        Dzieli listę na kolejne fragmenty o długości co najwyżej SQL_BATCH_SIZE,
+        żeby można ją było przekazać jako parametr warunku __in.
+        '''
+        for i in xrange(0, len(items), SQL_BATCH_SIZE):
+            yield items[i:i + SQL_BATCH_SIZE]
+
+    @staticmethod
+    def __commitBatches(items):
+        u'''
+        Dzieli listę wpisów LDAP na fragmenty o długości co najwyżej SYNC_COMMIT_BATCH_SIZE,
+        których obiekty są zapisywane w osobnych transakcjach. Jeśli SYNC_COMMIT_BATCH_SIZE nie jest ustawione,
+        to zwraca całą listę (transakcję obejmującą cały etap rozpoczyna LdapSync.__runPhases()).
+        '''
+        if SYNC_COMMIT_BATCH_SIZE is None:
+            yield items
+            return
+        for i in xrange(0, len(items), SYNC_COMMIT_BATCH_SIZE):
+            yield items[i:i + SYNC_COMMIT_BATCH_SIZE]
+
+    @classmethod
+    def __usersByUsername(cls, usernames):
+        u'''
+        Pobiera z bazy obiekty User o podanych nazwach.
+
+        @param usernames list nazwy użytkowników
+        @returns dict słownik, w którym kluczem jest nazwa użytkownika, a wartością obiekt User
+        '''
+        users = {}
+        for batch in cls.__batches(list(usernames)):
+            for user in User.objects.filter(username__in=batch):
+                users[user.username] = user
+        return users
+
+    @staticmethod
+    def __save(instance, counter, **values):
+        u'''
+        Przypisuje obiektowi wartości pobrane z bazy LDAP i zapisuje go tylko wtedy, gdy jest nowy
+        albo któraś z wartości się zmieniła (zapisywane są wówczas jedynie zmienione pola).
+        Dla istniejących obiektów zwiększa licznik counter.changed albo counter.unchanged.
+
+        @param instance django.db.models.Model obiekt lokalnej bazy
+        @param counter LdapSync.InstancesCounter licznik obiektów danego typu
+        @param values wartości pól obiektu
+        '''
+        changedFields = []
+        for name, value in values.iteritems():
+            if getattr(instance, name) != value:
+                setattr(instance, name, value)
+                changedFields.append(name)
+        if instance.pk is None:
+            instance.save()
+        elif changedFields:
+            instance.save(update_fields=changedFields)
+            counter.changed += 1
+        else:
+            counter.unchanged += 1
+
+    @classmethod
+    def __markNonSynced(cls, model, localObjects, syncedPks):
+        u'''
+        Oznacza flagą isLdapSynced == False te obiekty, których nie ma w bazie LDAP,
+        zapisując tylko obiekty, w których flaga była ustawiona.
+
+        @param model klasa modelu lokalnej bazy
+        @param localObjects iterable obiekty wczytane z lokalnej bazy przed synchronizacją
+        @param syncedPks set klucze obiektów odnalezionych w bazie LDAP
+        '''
+        pks = [localObject.pk for localObject in localObjects
+               if localObject.isLdapSynced and localObject.pk not in syncedPks]
+        for batch in cls.__batches(pks):
+            model.objects.filter(pk__in=batch).update(isLdapSynced=False)
+
+    @classmethod
+    def __sweep(cls, logger):
+        u'''
+        Oznacza flagą isLdapSynced == False obiekty, których wpisy zostały usunięte z bazy LDAP,
+        i usuwa powiązania student-cykl kształcenia takich obiektów.
+        Z bazy LDAP pobierane są jedynie identyfikatory wpisów, więc operacja jest tania
+        i może być wykonywana okresowo w trybie synchronizacji przyrostowej
+        (synchronizacja pełna oznacza takie obiekty na bieżąco).
+        '''
+        for ldapModel, model, key in (
+            (LdapStudent, Student, 'user__username'),
+            (LdapStudyCycle, StudyCycle, 'ldapId'),
+            (LdapEmployee, Employee, 'user__username'),
+            (LdapOrganization, Organization, 'user__username'),
+        ):
+            ldapIds = cls.__fromSnapshot(('ldapIds', ldapModel), partial(cls.__fetchLdapIds, ldapModel))
+            pks = [pk for pk, ldapId in model.objects.filter(isLdapSynced=True).values_list('pk', key)
+                   if ldapId not in ldapIds]
+            for batch in cls.__batches(pks):
+                model.objects.filter(pk__in=batch).update(isLdapSynced=False)
+            logger.info(u'Oznaczono jako niezsynchronizowane %s obiektów %s usuniętych z bazy LDAP.', len(pks), model.__name__)
+        Student.studyCycles.through.objects.filter(
+            Q(student__isLdapSynced=False) | Q(studycycle__isLdapSynced=False)).delete()
 
 
     @classmethod
-    def __syncStudents(cls, logger):
+    def __syncStudents(cls, logger, lookups=None):
         u'''
         Synchronizuje bazę obiektów Student z zewnętrzną bazą LDAP (modele models.LdapStudent).
-        Uwaga - zrywane są zależności z klucza obcego faculty.models.Student.studyCycle.
         Ustawiona flaga faculty.models.Student.isLdapSynced oznacza jedynie, że zsynchronizowane są dane osobowe studenta:
-        imię, nazwisko i email. Pozostałe pola są nullowane, aby przygotować je do następnych
-        etapów synchronizacji (jak np. __syncStudyCycles()).
+        imię, nazwisko i email. Powiązania z cyklami kształcenia są uzgadniane na następnym etapie
+        synchronizacji (__syncStudyCycles()).
+        Zapisywane są jedynie obiekty nowe i te, których dane w bazie LDAP uległy zmianie.
+
+        @param lookups dict Jeśli jest podany, to synchronizowane są tylko wpisy LDAP spełniające te warunki
+            (np. zmienione od poprzedniej synchronizacji).
         '''
         studentsCounter = cls.InstancesCounter()
         usersCounter = cls.InstancesCounter()
 
-        #oznacz wszystkie obiekty Student jako niezsynchronizowane z LDAPem
-        for localStudent in Student.objects.all():
-            #usuń powiązania ze StudyCycle, żeby przygotować obiekty do synchronizacji cyklów kształcenia
-            localStudent.studyCycles.clear()
-            localStudent.isLdapSynced = False
-            localStudent.save()
+        ldapStudents = cls.__ldapObjects(LdapStudent, lookups)
+
+        #wczytaj całe bazy (LDAP i lokalną) do słowników indeksowanych nazwą użytkownika,
+        # żeby nie odpytywać bazy osobno dla każdego studenta
+        ldapStudents = dict((ldapStudent.username, ldapStudent) for ldapStudent in ldapStudents)
+        localStudents = dict((localStudent.user.username, localStudent)
+                             for localStudent in Student.objects.select_related('user'))
+        localUsers = cls.__usersByUsername(ldapStudents.keys())
+
         #aktualizuj wszystkie lokalne obiekty Student, które są odzwierciedlone w LDAPie;
-        # jeśli któregoś Studenta tam nie ma, to pozostanie on oznaczony flagą isLdapSynced == False
-        for ldapStudent in LdapStudent.objects.all():
-            localUser = None
-            localStudent = None
-            try:
-                localStudent = Student.objects.get(user__username=ldapStudent.username)
-                localUser = localStudent.user
-                logger.debug(u'W bazie odnaleziono użytkownika "%s" z powiązanym obiektem Student.', ldapStudent.username)
-            except Student.DoesNotExist:
-                try:
-                    localUser = User.objects.get(username=ldapStudent.username)
-                    logger.info(u'Użytkownik "%s" istnieje w bazie, jednak nie ma przypisanego obiektu Student.', ldapStudent.username)
-                except User.DoesNotExist:
-                    #TODO: być może last_login powinien być ustawiany na bardziej logiczną wartość, np. None
-                    #      (w tej chwili niemożliwe, bo pole jest wymagane).
-                    localUser = User(
-                                     username=ldapStudent.username,
-                                     last_login=datetime(1970, 1, 1, tzinfo=pytz.utc),
-                                     date_joined=timezone.now())
-                    logger.info(u'Utworzono nowego użytkownika "%s".', localUser.username)
-                    usersCounter.created += 1
-                localStudent = Student()
-                logger.info(u'Utworzono nowy obiekt Student dla użytkownika "%s".', ldapStudent.username)
-                studentsCounter.created += 1
+        # jeśli któregoś Studenta tam nie ma, to zostanie on oznaczony flagą isLdapSynced == False
+        newUsers = []
+        for batch in cls.__commitBatches(ldapStudents.items()):
+            with transaction.atomic():
+                for username, ldapStudent in batch:
+                    localUser = localUsers.get(username)
+                    if localUser is None:
+                        #TODO: być może last_login powinien być ustawiany na bardziej logiczną wartość, np. None
+                        #      (w tej chwili niemożliwe, bo pole jest wymagane).
+                        localUser = User(
+                                         username=username,
+                                         first_name=ldapStudent.firstName,
+                                         last_name=ldapStudent.lastName,
+                                         email=ldapStudent.email,
+                                         last_login=datetime(1970, 1, 1, tzinfo=pytz.utc),
+                                         date_joined=timezone.now())
+                        newUsers.append(localUser)
+                        logger.info(u'Utworzono nowego użytkownika "%s".', username)
+                        usersCounter.created += 1
+                    else:
+                        if username not in localStudents:
+                            logger.info(u'Użytkownik "%s" istnieje w bazie, jednak nie ma przypisanego obiektu Student.', username)
+                        cls.__save(localUser, usersCounter,
+                                   first_name=ldapStudent.firstName,
+                                   last_name=ldapStudent.lastName,
+                                   email=ldapStudent.email)
+                    usersCounter.synced += 1
+        #bulk_create nie ustawia kluczy głównych utworzonych obiektów, więc należy je pobrać ponownie
+        User.objects.bulk_create(newUsers)
+        localUsers.update(cls.__usersByUsername([newUser.username for newUser in newUsers]))
 
-            localUser.first_name = ldapStudent.firstName
-            localUser.last_name = ldapStudent.lastName
-            localUser.email = ldapStudent.email
-            localUser.save()
-            logger.debug(u'Zaktualizowano dane w obiekcie User: username="%s", pk="%s".', localUser.username, localUser.pk)
-            usersCounter.synced += 1
-            localStudent.user = localUser
-            localStudent.isLdapSynced = True
-            localStudent.save()
-            permissions.registerStudent(localStudent)
-            logger.debug(u'Zaktualizowano dane w obiekcie Student: user.username="%s" pk="%s".', localStudent.user.username, localStudent.pk)
+        newStudents = []
+        resyncedStudents = []
+        syncedStudents = set()
+        for username in ldapStudents:
+            localStudent = localStudents.get(username)
+            if localStudent is None:
+                newStudents.append(Student(user=localUsers[username], isLdapSynced=True))
+                logger.info(u'Utworzono nowy obiekt Student dla użytkownika "%s".', username)
+                studentsCounter.created += 1
+            elif not localStudent.isLdapSynced:
+                resyncedStudents.append(localStudent.pk)
+                studentsCounter.changed += 1
+            else:
+                studentsCounter.unchanged += 1
+            if localStudent is not None:
+                syncedStudents.add(localStudent.pk)
             studentsCounter.synced += 1
-        
+        Student.objects.bulk_create(newStudents)
+        for batch in cls.__batches(resyncedStudents):
+            Student.objects.filter(pk__in=batch).update(isLdapSynced=True)
+        if lookups is None:
+            cls.__markNonSynced(Student, localStudents.values(), syncedStudents)
+
         studentsCounter.nonSynced = Student.objects.filter(isLdapSynced=False).count()
         logger.info(
-            u'Zsynchronizowano %s obiektów Student (w tym utworzono: %s), pozostało niezsynchronizowanych: %s.',
-            studentsCounter.synced, studentsCounter.created, studentsCounter.nonSynced
+            u'Zsynchronizowano %s obiektów Student (w tym utworzono: %s, zmieniono: %s, bez zmian: %s), '
+            u'pozostało niezsynchronizowanych: %s.',
+            studentsCounter.synced, studentsCounter.created, studentsCounter.changed, studentsCounter.unchanged,
+            studentsCounter.nonSynced
         )
         logger.info(
-            u'Zaktualizowano dane %s użytkowników (w tym utworzono: %s)',
-            usersCounter.synced, usersCounter.created
+            u'Zaktualizowano dane %s użytkowników (w tym utworzono: %s, zmieniono: %s, bez zmian: %s)',
+            usersCounter.synced, usersCounter.created, usersCounter.changed, usersCounter.unchanged
         )
 
 
     @classmethod
-    def __syncStudyCycles(cls, logger):
+    def __syncStudyCycles(cls, logger, lookups=None):
         u'''
         Synchronizuje bazę obiektów faculty.models.StudyCycle z zewnętrzną bazą LDAP (modele models.LdapStudyCycle).
-        Uwaga - wymaga przygotowania obiektów Student: muszą być wcześniej zsynchronizowane z bazą LDAP,
-        a ich referencje na obiekty faculty.models.StudyCycle muszą być wyczyszczone (zostaną odtworzone na tym etapie synchronizacji).
+        Uwaga - wymaga przygotowania obiektów Student: muszą być wcześniej zsynchronizowane z bazą LDAP.
+        Powiązania student-cykl kształcenia są uzgadniane jako różnica zbiorów: brakujące są dodawane,
+        a nadmiarowe usuwane, bez zmieniania pozostałych.
+
+        @param lookups dict Jeśli jest podany, to synchronizowane są tylko wpisy LDAP spełniające te warunki
+            (np. zmienione od poprzedniej synchronizacji), a powiązania ze studentami są uzgadniane tylko dla tych cykli.
         '''
         studyCyclesCounter = cls.InstancesCounter()
+        membershipsCounter = cls.InstancesCounter()
+        Membership = Student.studyCycles.through
+        localStudents = dict(Student.objects.filter(isLdapSynced=True).values_list('user__username', 'pk'))
+        #pożądane powiązania (student_id, studycycle_id) według bazy LDAP
+        memberships = set()
 
-        #oznacz wszystkie obiekty StudyCycle jako niezsynchronizowane z LDAPem
-        for localStudyCycle in StudyCycle.objects.all():
-            localStudyCycle.isLdapSynced = False
-            localStudyCycle.save()
+        ldapStudyCycles = cls.__ldapObjects(LdapStudyCycle, lookups)
+        localStudyCycles = dict((localStudyCycle.ldapId, localStudyCycle) for localStudyCycle in StudyCycle.objects.all())
+        syncedStudyCycles = set()
+        studentUsernames = cls.__namesByDn(LdapStudent, set(studentDn for ldapStudyCycle in ldapStudyCycles
+                                                             for studentDn in ldapStudyCycle.studentsDnList))
         #aktualizuj wszystkie lokalne obiekty StudyCycle, które mają swoje kopie w LDAPie;
-        #jeśli któryś StudyCycle nie istnieje w LDAP, to w bazie pozostanie oznaczony flagą isLdapSynced == False
-        for ldapStudyCycle in LdapStudyCycle.objects.all():
-            localStudyCycle = None
-            try:
-                localStudyCycle = StudyCycle.objects.get(ldapId=ldapStudyCycle.name)
+        #jeśli któryś StudyCycle nie istnieje w LDAP, to w bazie zostanie oznaczony flagą isLdapSynced == False
+        for ldapStudyCycle in ldapStudyCycles:
+            localStudyCycle = localStudyCycles.get(ldapStudyCycle.name)
+            if localStudyCycle is not None:
                 logger.debug(u'W bazie odnaleziono cykl kształcenia "%s".', ldapStudyCycle.name)
-            except StudyCycle.DoesNotExist:
+            else:
                 localStudyCycle = StudyCycle(ldapId=ldapStudyCycle.name, name=ldapStudyCycle.name)
                 logger.info(u'Utworzono nowy cykl kształcenia "%s".', ldapStudyCycle.name)
                 studyCyclesCounter.created += 1
 
-            localStudyCycle.isLdapSynced = True
-            localStudyCycle.save()
+            cls.__save(localStudyCycle, studyCyclesCounter, isLdapSynced=True)
             logger.debug(u'Zaktualizowano dane w obiekcie StudyCycle: name="%s", pk="%s".', localStudyCycle.name, localStudyCycle.pk)
+            syncedStudyCycles.add(localStudyCycle.pk)
             studyCyclesCounter.synced += 1
 
-            #zaktualizuj przynależność studentów należących do tego StudyCycle
+            #zbierz przynależność studentów należących do tego StudyCycle
             studentsCounter = cls.InstancesCounter()
-            for ldapStudent in ldapStudyCycle.students:
-                try:
-                    localStudent = Student.objects.get(user__username=ldapStudent.username)
-                    localStudent.studyCycles.add(localStudyCycle)
-                    localStudent.save()
+            for studentDn in ldapStudyCycle.studentsDnList:
+                username = studentUsernames.get(studentDn)
+                if username in localStudents:
+                    memberships.add((localStudents[username], localStudyCycle.pk))
                     studentsCounter.synced += 1
-                except Student.DoesNotExist:
+                else:
                     logger.warn(
                         u'Student "%s" jest wymieniony w bazie LDAP jako uczestnik cyklu kształcenia "%s", '
                         u'ale nie ma go w bazie LDAP wśród studentów uczelni. '
                         u'Powiązanie cykl-student zostało zignorowane.',
-                        ldapStudent.username, ldapStudyCycle.name
+                        username or studentDn, ldapStudyCycle.name
                     )
                     studentsCounter.nonSynced += 1
             logger.debug(
@@ -199,79 +761,110 @@ class LdapSync:
                 u'%s studentów wymienionych w cyklu nie odnaleziono w bazie.',
                 studentsCounter.synced, studentsCounter.nonSynced
             )
+        if lookups is None:
+            cls.__markNonSynced(StudyCycle, localStudyCycles.values(), syncedStudyCycles)
+
+        #uzgodnij powiązania zapisane w bazie z pożądanymi: w trybie pełnym wszystkie,
+        # a w przeciwnym razie tylko powiązania zsynchronizowanych cykli
+        if lookups is None:
+            existing = list(Membership.objects.values_list('pk', 'student_id', 'studycycle_id'))
+        else:
+            existing = []
+            for batch in cls.__batches(list(syncedStudyCycles)):
+                existing.extend(Membership.objects.filter(studycycle_id__in=batch)
+                                                  .values_list('pk', 'student_id', 'studycycle_id'))
+        obsolete = [pk for pk, studentId, studyCycleId in existing if (studentId, studyCycleId) not in memberships]
+        for batch in cls.__batches(obsolete):
+            Membership.objects.filter(pk__in=batch).delete()
+        existing = set((studentId, studyCycleId) for pk, studentId, studyCycleId in existing)
+        Membership.objects.bulk_create([Membership(student_id=studentId, studycycle_id=studyCycleId)
+                                        for studentId, studyCycleId in memberships - existing])
+        membershipsCounter.created = len(memberships - existing)
+        membershipsCounter.deleted = len(obsolete)
+        membershipsCounter.unchanged = len(memberships) - membershipsCounter.created
+        logger.info(
+            u'Zaktualizowano dane %s cyklów kształcenia (w tym utworzono: %s, zmieniono: %s, bez zmian: %s)',
+            studyCyclesCounter.synced, studyCyclesCounter.created, studyCyclesCounter.changed, studyCyclesCounter.unchanged
+        )
         logger.info(
-            u'Zaktualizowano dane %s cyklów kształcenia (w tym utworzono: %s)',
-            studyCyclesCounter.synced, studyCyclesCounter.created
+            u'Uzgodniono powiązania student-cykl kształcenia (dodano: %s, usunięto: %s, bez zmian: %s)',
+            membershipsCounter.created, membershipsCounter.deleted, membershipsCounter.unchanged
         )
 
 
     @classmethod
-    def __syncEmployees(cls, logger):
+    def __syncEmployees(cls, logger, lookups=None):
         u'''
         Synchronizuje bazę obiektów faculty.models.Employee z zewnętrzną bazą LDAP (modele models.LdapEmployee).
-        Uwaga - zrywane są zależności z klucza obcego faculty.models.Employee.organizationalUnit.
         Ustawiona flaga faculty.models.Employee.isLdapSynced oznacza jedynie, że zsynchronizowane są dane osobowe pracownika:
-        imię, nazwisko, email, tytuł naukowy i stanowisko. Pozostałe pola są nullowane, aby przygotować je do następnych
-        etapów synchronizacji (jak np. __syncOrganizationalUnits()).
+        imię, nazwisko, email, tytuł naukowy i stanowisko. Powiązania z jednostkami organizacyjnymi
+        są odtwarzane na następnym etapie synchronizacji (__syncOrganizationalUnits()).
+        Zapisywane są jedynie obiekty nowe i te, których dane w bazie LDAP uległy zmianie.
+
+        @param lookups dict Jeśli jest podany, to synchronizowane są tylko wpisy LDAP spełniające te warunki
+            (np. zmienione od poprzedniej synchronizacji).
         '''
         employeesCounter = cls.InstancesCounter()
         usersCounter = cls.InstancesCounter()
 
-        #oznacz wszystkie obiekty Employee jako niezsynchronizowane z LDAPem
-        for localEmployee in Employee.objects.all():
-            #usuń powiązania z OrganizationalUnit, żeby przygotować obiekty do synchronizacji jednostek organizacyjnych
-            localEmployee.organizationalUnit = None
-            localEmployee.isLdapSynced = False
-            localEmployee.save()
+        ldapEmployees = cls.__ldapObjects(LdapEmployee, lookups)
+        localEmployees = dict((localEmployee.user.username, localEmployee)
+                              for localEmployee in Employee.objects.select_related('user'))
+        localUsers = cls.__usersByUsername([ldapEmployee.username for ldapEmployee in ldapEmployees])
+        syncedEmployees = set()
         #aktualizuj wszystkie lokalne obiekty Employee, które są odzwierciedlone w LDAPie;
-        # jeśli któregoś Employee tam nie ma, to pozostanie on oznaczony flagą isLdapSynced == False
-        for ldapEmployee in LdapEmployee.objects.all():
-            localUser = None
-            localEmployee = None
-            try:
-                localEmployee = Employee.objects.get(user__username=ldapEmployee.username)
-                localUser = localEmployee.user
-                logger.debug(u'W bazie odnaleziono użytkownika "%s" z powiązanym obiektem Employee.', ldapEmployee.username)
-            except Employee.DoesNotExist:
-                try:
-                    localUser = User.objects.get(username=ldapEmployee.username)
-                    logger.info(u'Użytkownik "%s" istnieje w bazie, jednak nie ma przypisanego obiektu Employee.', ldapEmployee.username)
-                except User.DoesNotExist:
-                    #TODO: być może last_login powinien być ustawiany na bardziej logiczną wartość, np. None
-                    #      (w tej chwili niemożliwe, bo pole jest wymagane).
-                    localUser = User(
-                                     username=ldapEmployee.username,
-                                     last_login=datetime(1970, 1, 1, tzinfo=pytz.utc),
-                                     date_joined=timezone.now())
-                    logger.info(u'Utworzono nowego użytkownika "%s".', localUser.username)
-                    usersCounter.created += 1
-                localEmployee = Employee()
-                logger.info(u'Utworzono nowy obiekt Employee dla użytkownika "%s".', ldapEmployee.username)
-                employeesCounter.created += 1
-
-            localUser.first_name = ldapEmployee.firstName
-            localUser.last_name = ldapEmployee.lastName
-            localUser.email = ldapEmployee.email
-            localUser.save()
-            logger.debug(u'Zaktualizowano dane w obiekcie User: username="%s", pk="%s".', localUser.username, localUser.pk)
-            usersCounter.synced += 1
-            localEmployee.user = localUser
-            localEmployee.title = ldapEmployee.title
-            localEmployee.position = ldapEmployee.position
-            localEmployee.isLdapSynced = True
-            localEmployee.save()
-            permissions.registerEmployee(localEmployee)
-            logger.debug(u'Zaktualizowano dane w obiekcie Employee: user.username="%s" pk="%s".', localEmployee.user.username, localEmployee.pk)
-            employeesCounter.synced += 1
+        # jeśli któregoś Employee tam nie ma, to zostanie on oznaczony flagą isLdapSynced == False
+        for batch in cls.__commitBatches(ldapEmployees):
+            with transaction.atomic():
+                for ldapEmployee in batch:
+                    localEmployee = localEmployees.get(ldapEmployee.username)
+                    if localEmployee is not None:
+                        localUser = localEmployee.user
+                        logger.debug(u'W bazie odnaleziono użytkownika "%s" z powiązanym obiektem Employee.', ldapEmployee.username)
+                    else:
+                        localUser = localUsers.get(ldapEmployee.username)
+                        if localUser is not None:
+                            logger.info(u'Użytkownik "%s" istnieje w bazie, jednak nie ma przypisanego obiektu Employee.', ldapEmployee.username)
+                        else:
+                            #TODO: być może last_login powinien być ustawiany na bardziej logiczną wartość, np. None
+                            #      (w tej chwili niemożliwe, bo pole jest wymagane).
+                            localUser = User(
+                                             username=ldapEmployee.username,
+                                             last_login=datetime(1970, 1, 1, tzinfo=pytz.utc),
+                                             date_joined=timezone.now())
+                            logger.info(u'Utworzono nowego użytkownika "%s".', localUser.username)
+                            usersCounter.created += 1
+                        localEmployee = Employee()
+                        logger.info(u'Utworzono nowy obiekt Employee dla użytkownika "%s".', ldapEmployee.username)
+                        employeesCounter.created += 1
+
+                    cls.__save(localUser, usersCounter,
+                               first_name=ldapEmployee.firstName,
+                               last_name=ldapEmployee.lastName,
+                               email=ldapEmployee.email)
+                    logger.debug(u'Zaktualizowano dane w obiekcie User: username="%s", pk="%s".', localUser.username, localUser.pk)
+                    usersCounter.synced += 1
+                    localEmployee.user = localUser
+                    cls.__save(localEmployee, employeesCounter,
+                               title=ldapEmployee.title,
+                               position=ldapEmployee.position,
+                               isLdapSynced=True)
+                    logger.debug(u'Zaktualizowano dane w obiekcie Employee: user.username="%s" pk="%s".', localEmployee.user.username, localEmployee.pk)
+                    syncedEmployees.add(localEmployee.pk)
+                    employeesCounter.synced += 1
+        if lookups is None:
+            cls.__markNonSynced(Employee, localEmployees.values(), syncedEmployees)
 
         employeesCounter.nonSynced = Employee.objects.filter(isLdapSynced=False).count()
         logger.info(
-            u'Zsynchronizowano %s obiektów Employee (w tym utworzono: %s), pozostało niezsynchronizowanych: %s.',
-            employeesCounter.synced, employeesCounter.created, employeesCounter.nonSynced
+            u'Zsynchronizowano %s obiektów Employee (w tym utworzono: %s, zmieniono: %s, bez zmian: %s), '
+            u'pozostało niezsynchronizowanych: %s.',
+            employeesCounter.synced, employeesCounter.created, employeesCounter.changed, employeesCounter.unchanged,
+            employeesCounter.nonSynced
         )
         logger.info(
-            u'Zaktualizowano dane %s użytkowników (w tym utworzono: %s)',
-            usersCounter.synced, usersCounter.created
+            u'Zaktualizowano dane %s użytkowników (w tym utworzono: %s, zmieniono: %s, bez zmian: %s)',
+            usersCounter.synced, usersCounter.created, usersCounter.changed, usersCounter.unchanged
         )
 
 
@@ -280,130 +873,167 @@ class LdapSync:
         u'''
         Synchronizuje bazę obiektów faculty.models.OrganizationalUnit z zewnętrzną bazą LDAP
         (modele models.LdapOrganizationalUnit).
-        Uwaga - wymaga przygotowania obiektów faculty.models.Employee: muszą być wcześniej zsynchronizowane z bazą LDAP,
-        a ich referencje na obiekty faculty.models.OrganizationalUnit muszą być wyczyszczone
-        (zostaną odtworzone na tym etapie synchronizacji).
+        Uwaga - wymaga przygotowania obiektów faculty.models.Employee: muszą być wcześniej zsynchronizowane z bazą LDAP.
+        Przynależność pracowników do jednostek jest wyznaczana w pamięci na podstawie indeksu
+        LdapOrganizationalUnit.getEmployeesIndex(), a zapisywana zbiorczo tylko dla pracowników, których jednostka
+        uległa zmianie (także w trybie przyrostowym, bo przynależność do jednostek jest przechowywana w osobnych wpisach LDAP).
+
+        @returns set klucze główne użytkowników, którzy są kierownikami jednostek według bazy LDAP
+            (patrz permissions.memberships())
         '''
         organizationalUnitsCounter = cls.InstancesCounter()
+        employeesCounter = cls.InstancesCounter()
+        localEmployees = dict((localEmployee.user.username, localEmployee)
+                              for localEmployee in Employee.objects.select_related('user'))
 
-        #oznacz wszystkie obiekty OrganizationalUnit jako niezsynchronizowane z LDAPem
-        for localOrganizationalUnit in OrganizationalUnit.objects.all():
-            localOrganizationalUnit.isLdapSynced = False
-            localOrganizationalUnit.save()
-        #aktualizuj wszystkie lokalne obiekty OrganizationalUnit, które mają swoje kopie w LDAPie;
-        #jeśli któraś OrganizationalUnit nie istnieje w LDAP, to w bazie pozostanie oznaczona flagą isLdapSynced == False
-        for ldapOrganizationalUnit in LdapOrganizationalUnit.objects.all():
-            localOrganizationalUnit = None
-            try:
-                localOrganizationalUnit = OrganizationalUnit.objects.get(ldapId=ldapOrganizationalUnit.name)
+        localOrganizationalUnits = dict((localOrganizationalUnit.ldapId, localOrganizationalUnit)
+                                        for localOrganizationalUnit in OrganizationalUnit.objects.all())
+        departmentHeads = set()
+        #aktualizuj wszystkie lokalne obiekty OrganizationalUnit, które mają swoje kopie w LDAPie
+        for ldapOrganizationalUnit in cls.__ldapObjects(LdapOrganizationalUnit):
+            localOrganizationalUnit = localOrganizationalUnits.get(ldapOrganizationalUnit.name)
+            if localOrganizationalUnit is not None:
                 logger.debug(u'W bazie odnaleziono jednostkę ogranizacyjną "%s".', localOrganizationalUnit.name)
-            except OrganizationalUnit.DoesNotExist:
+            else:
                 localOrganizationalUnit = OrganizationalUnit(
                                                              ldapId=ldapOrganizationalUnit.name,
                                                              name=ldapOrganizationalUnit.name)
+                localOrganizationalUnits[localOrganizationalUnit.ldapId] = localOrganizationalUnit
                 logger.info(u'Utworzono nową jednostkę ogranizacyjną "%s".', localOrganizationalUnit.name)
                 organizationalUnitsCounter.created += 1
 
-            #przypisz kierownika jednostki
-            try:
-                localOrganizationalUnit.head = Employee.objects.get(user__username=ldapOrganizationalUnit.head.username)
-                permissions.registerDepartmentHead(localOrganizationalUnit.head)
-                logger.debug(u'Przypisano kierownika jednostki organizacyjnej: "%s".', localOrganizationalUnit.head.user.username)
-            except:
-                logger.warn(u'W bazie nie odnaleziono kierownika jednostki organizacyjnej "%s" (szukany username: "%s").', localOrganizationalUnit.name, ldapOrganizationalUnit.head.username)
-            localOrganizationalUnit.isLdapSynced = True
-            localOrganizationalUnit.save()
+            #przypisz kierownika jednostki; jeśli go nie odnaleziono, pozostaje dotychczasowy,
+            # ale nie należy do grupy kierowników katedr
+            values = {}
+            ldapHead = ldapOrganizationalUnit.head
+            localHead = localEmployees.get(ldapHead.username) if ldapHead is not None else None
+            if localHead is not None:
+                values['head_id'] = localHead.pk
+                departmentHeads.add(localHead.user_id)
+                logger.debug(u'Przypisano kierownika jednostki organizacyjnej: "%s".', localHead.user.username)
+            else:
+                logger.warn(u'W bazie nie odnaleziono kierownika jednostki organizacyjnej "%s" (szukany username: "%s").',
+                            localOrganizationalUnit.name, ldapHead.username if ldapHead is not None else None)
+            cls.__save(localOrganizationalUnit, organizationalUnitsCounter, **values)
             logger.debug(u'Zaktualizowano dane w obiekcie OrganizationalUnit: name="%s", pk="%s".', localOrganizationalUnit.name, localOrganizationalUnit.pk)
             organizationalUnitsCounter.synced += 1
 
-            #zaktualizuj przynależność pracowników należących do tej OrganizationalUnit
-            employeesCounter = cls.InstancesCounter()
-            for ldapEmployee in ldapOrganizationalUnit.employees:
-                try:
-                    localEmployee = Employee.objects.get(user__username=ldapEmployee.username)
-                    localEmployee.organizationalUnit = localOrganizationalUnit
-                    localEmployee.save()
-                    employeesCounter.synced += 1
-                except Employee.DoesNotExist:
-                    logger.warn(
-                        u'Pracownik "%s" jest wymieniony w bazie LDAP jako członek jednostki organizacyjnej "%s", '
-                        u'ale nie ma go w bazie LDAP wśród pracowników uczelni. '
-                        u'Powiązanie jednostka-pracownik zostało zignorowane.',
-                        ldapEmployee.username, ldapOrganizationalUnit.name
-                    )
-                    employeesCounter.nonSynced += 1
+        #wyznacz docelową jednostkę każdego pracownika; pracownicy spoza indeksu nie należą do żadnej jednostki
+        employeesIndex = cls.__fromSnapshot('employeesIndex', cls.__fetchEmployeesIndex)
+        #DN w indeksie są znormalizowane, więc nazwy odczytane z RDN są porównywane bez uwzględniania wielkości liter
+        employeeUsernames = cls.__namesByDn(LdapEmployee, employeesIndex.keys())
+        employeesByUsername = dict((username.lower(), localEmployee) for username, localEmployee in localEmployees.iteritems())
+        unitsByEmployee = {}
+        for employeeDn, ldapOrganizationalUnit in employeesIndex.iteritems():
+            username = employeeUsernames.get(employeeDn)
+            localEmployee = employeesByUsername.get(username.lower()) if username is not None else None
+            localOrganizationalUnit = localOrganizationalUnits.get(ldapOrganizationalUnit.name)
+            if localEmployee is None or localOrganizationalUnit is None:
+                logger.warn(
+                    u'Pracownik "%s" jest wymieniony w bazie LDAP jako członek jednostki organizacyjnej "%s", '
+                    u'ale nie ma go w bazie LDAP wśród pracowników uczelni. '
+                    u'Powiązanie jednostka-pracownik zostało zignorowane.',
+                    username or employeeDn, ldapOrganizationalUnit.name
+                )
+                employeesCounter.nonSynced += 1
+                continue
+            unitsByEmployee[localEmployee.pk] = localOrganizationalUnit
+
+        #zapisz zmienione przypisania, jednym zapytaniem UPDATE dla każdej jednostki
+        changedEmployees = {}
+        for localEmployee in localEmployees.itervalues():
+            localOrganizationalUnit = unitsByEmployee.get(localEmployee.pk)
+            unitPk = localOrganizationalUnit.pk if localOrganizationalUnit is not None else None
+            if localEmployee.organizationalUnit_id == unitPk:
+                employeesCounter.unchanged += 1
+                continue
+            changedEmployees.setdefault(unitPk, (localOrganizationalUnit, []))[1].append(localEmployee.pk)
+            employeesCounter.changed += 1
+        for localOrganizationalUnit, employeePks in changedEmployees.itervalues():
+            for batch in cls.__batches(employeePks):
+                Employee.objects.filter(pk__in=batch).update(organizationalUnit=localOrganizationalUnit)
 
-            logger.debug(
-                u'Zaktualizowano zależności obiektu OrganizationalUnit: %s pracowników przypisano do cyklu, '
-                u'%s pracowników wymienionych w jednostce nie odnaleziono w bazie.',
-                employeesCounter.synced, employeesCounter.nonSynced
-            )
         logger.info(
             u'Zaktualizowano dane %s jednostek organizacyjnych (w tym utworzono: %s)',
             organizationalUnitsCounter.synced, organizationalUnitsCounter.created
         )
+        logger.info(
+            u'Uzgodniono przynależność pracowników do jednostek organizacyjnych (zmieniono: %s, bez zmian: %s, '
+            u'nie odnaleziono w bazie: %s)',
+            employeesCounter.changed, employeesCounter.unchanged, employeesCounter.nonSynced
+        )
+        return departmentHeads
 
 
     @classmethod
-    def __syncOrganizations(cls, logger):
+    def __syncOrganizations(cls, logger, lookups=None):
         u'''
         Synchronizuje bazę obiektów faculty.models.Organization z zewnętrzną bazą LDAP (modele models.LdapOrganization).
+        Zapisywane są jedynie obiekty nowe i te, których dane w bazie LDAP uległy zmianie.
+
+        @param lookups dict Jeśli jest podany, to synchronizowane są tylko wpisy LDAP spełniające te warunki
+            (np. zmienione od poprzedniej synchronizacji).
         '''
         organizationsCounter = cls.InstancesCounter()
         usersCounter = cls.InstancesCounter()
 
-        #oznacz wszystkie obiekty Organization jako niezsynchronizowane z LDAPem
-        for localOrganization in Organization.objects.all():
-            localOrganization.isLdapSynced = False
-            localOrganization.save()
+        ldapOrganizations = cls.__ldapObjects(LdapOrganization, lookups)
+        localOrganizations = dict((localOrganization.user.username, localOrganization)
+                                  for localOrganization in Organization.objects.select_related('user'))
+        localUsers = cls.__usersByUsername([ldapOrganization.username for ldapOrganization in ldapOrganizations])
+        syncedOrganizations = set()
         #aktualizuj wszystkie lokalne obiekty Organization, które są odzwierciedlone w LDAPie;
-        # jeśli którejś Organization tam nie ma, to pozostanie ona oznaczona flagą isLdapSynced == False
-        for ldapOrganization in LdapOrganization.objects.all():
-            localUser = None
-            localOrganization = None
-            try:
-                localOrganization = Organization.objects.get(user__username=ldapOrganization.username)
-                localUser = localOrganization.user
-                logger.debug(u'W bazie odnaleziono użytkownika "%s" z powiązanym obiektem Organization.', ldapOrganization.username)
-            except Organization.DoesNotExist:
-                try:
-                    localUser = User.objects.get(username=ldapOrganization.username)
-                    logger.info(u'Użytkownik "%s" istnieje w bazie, jednak nie ma przypisanego obiektu Organization.', ldapOrganization.username)
-                except User.DoesNotExist:
-                    #TODO: być może last_login powinien być ustawiany na bardziej logiczną wartość, np. None
-                    #      (w tej chwili niemożliwe, bo pole jest wymagane).
-                    localUser = User(
-                                     username=ldapOrganization.username,
-                                     last_login=datetime(1970, 1, 1, tzinfo=pytz.utc),
-                                     date_joined=timezone.now())
-                    logger.info(u'Utworzono nowego użytkownika "%s".', localUser.username)
-                    usersCounter.created += 1
-                localOrganization = Organization()
-                logger.info(u'Utworzono nowy obiekt Organization dla użytkownika "%s".', ldapOrganization.username)
-                organizationsCounter.created += 1
-
-            localUser.first_name = ldapOrganization.representantFirstName
-            localUser.last_name = ldapOrganization.representantLastName
-            localUser.email = ldapOrganization.representantEmail
-            localUser.save()
-            logger.debug(u'Zaktualizowano dane w obiekcie User: username="%s", pk="%s".', localUser.username, localUser.pk)
-            usersCounter.synced += 1
-            localOrganization.user = localUser
-            localOrganization.name = ldapOrganization.name
-            localOrganization.isLdapSynced = True
-            localOrganization.save()
-            permissions.registerOrganization(localOrganization)
-            logger.debug(u'Zaktualizowano dane w obiekcie Organization: user.username="%s" pk="%s".', localOrganization.user.username, localOrganization.pk)
-            organizationsCounter.synced += 1
-        
+        # jeśli którejś Organization tam nie ma, to zostanie ona oznaczona flagą isLdapSynced == False
+        for batch in cls.__commitBatches(ldapOrganizations):
+            with transaction.atomic():
+                for ldapOrganization in batch:
+                    localOrganization = localOrganizations.get(ldapOrganization.username)
+                    if localOrganization is not None:
+                        localUser = localOrganization.user
+                        logger.debug(u'W bazie odnaleziono użytkownika "%s" z powiązanym obiektem Organization.', ldapOrganization.username)
+                    else:
+                        localUser = localUsers.get(ldapOrganization.username)
+                        if localUser is not None:
+                            logger.info(u'Użytkownik "%s" istnieje w bazie, jednak nie ma przypisanego obiektu Organization.', ldapOrganization.username)
+                        else:
+                            #TODO: być może last_login powinien być ustawiany na bardziej logiczną wartość, np. None
+                            #      (w tej chwili niemożliwe, bo pole jest wymagane).
+                            localUser = User(
+                                             username=ldapOrganization.username,
+                                             last_login=datetime(1970, 1, 1, tzinfo=pytz.utc),
+                                             date_joined=timezone.now())
+                            logger.info(u'Utworzono nowego użytkownika "%s".', localUser.username)
+                            usersCounter.created += 1
+                        localOrganization = Organization()
+                        logger.info(u'Utworzono nowy obiekt Organization dla użytkownika "%s".', ldapOrganization.username)
+                        organizationsCounter.created += 1
+
+                    cls.__save(localUser, usersCounter,
+                               first_name=ldapOrganization.representantFirstName,
+                               last_name=ldapOrganization.representantLastName,
+                               email=ldapOrganization.representantEmail)
+                    logger.debug(u'Zaktualizowano dane w obiekcie User: username="%s", pk="%s".', localUser.username, localUser.pk)
+                    usersCounter.synced += 1
+                    localOrganization.user = localUser
+                    cls.__save(localOrganization, organizationsCounter,
+                               name=ldapOrganization.name,
+                               isLdapSynced=True)
+                    logger.debug(u'Zaktualizowano dane w obiekcie Organization: user.username="%s" pk="%s".', localOrganization.user.username, localOrganization.pk)
+                    syncedOrganizations.add(localOrganization.pk)
+                    organizationsCounter.synced += 1
+        if lookups is None:
+            cls.__markNonSynced(Organization, localOrganizations.values(), syncedOrganizations)
+
         organizationsCounter.nonSynced = Organization.objects.filter(isLdapSynced=False).count()
         logger.info(
-            u'Zsynchronizowano %s obiektów Organization (w tym utworzono: %s), pozostało niezsynchronizowanych: %s.',
-            organizationsCounter.synced, organizationsCounter.created, organizationsCounter.nonSynced
+            u'Zsynchronizowano %s obiektów Organization (w tym utworzono: %s, zmieniono: %s, bez zmian: %s), '
+            u'pozostało niezsynchronizowanych: %s.',
+            organizationsCounter.synced, organizationsCounter.created, organizationsCounter.changed,
+            organizationsCounter.unchanged, organizationsCounter.nonSynced
         )
         logger.info(
-            u'Zaktualizowano dane %s użytkowników (w tym utworzono: %s)',
-            usersCounter.synced, usersCounter.created
+            u'Zaktualizowano dane %s użytkowników (w tym utworzono: %s, zmieniono: %s, bez zmian: %s)',
+            usersCounter.synced, usersCounter.created, usersCounter.changed, usersCounter.unchanged
         )
 
 
@@ -416,13 +1046,7 @@ class LdapSync:
 
         #typ RoleTuple - używać podobnie jak zwykłą krotkę, ale z zawartością dostępną poprzez atrybuty .ldap i .local
         RoleTuple = namedtuple('RoleTuple', ('ldapName', 'localName'))
-        #odpowiadające sobie nazwy ról w bazie LDAP i w bazie lokalnej
-        authorityRoles = (
-            RoleTuple(LdapAuthorities.DEAN, Authority.DEAN),
-            RoleTuple(LdapAuthorities.VICE_DEAN_FOR_PROMOTION, Authority.VICE_DEAN_FOR_PROMOTION),
-            RoleTuple(LdapAuthorities.VICE_DEAN_FOR_RESEARCH, Authority.VICE_DEAN_FOR_RESEARCH),
-            RoleTuple(LdapAuthorities.VICE_DEAN_FOR_STUDENTS, Authority.VICE_DEAN_FOR_STUDENTS),
-        )
+        authorityRoles = tuple(RoleTuple(ldapName, localName) for ldapName, localName in cls.__authorityRoles)
         #usuń obiekty Authority o rolach nieznanych systemowi
         unknownRolesAuthorities = Authority.objects.exclude(role__in = [role.localName for role in authorityRoles])
         authoritiesCounter.deleted = unknownRolesAuthorities.count()
@@ -478,11 +1102,6 @@ class LdapSync:
             localAuthority.occupant = Employee.objects.get(user__username=ldapAuthority.username)
             localAuthority.save()
 
-            if localAuthority.role == Authority.DEAN:
-                permissions.registerFacultyHead(localAuthority.occupant)
-            elif localAuthority.role == Authority.VICE_DEAN_FOR_STUDENTS:
-                permissions.registerFacultyHead(localAuthority.occupant)
-            
             logger.debug(
                 u'Obiektowi Authority o roli "%s" (rola LDAP: "%s") przypisano pracownika "%s".',
                 role.localName, role.ldapName, localAuthority.occupant.user.username
@@ -492,4 +1111,18 @@ class LdapSync:
         logger.info(
             u'Zsynchronizowano %s obiektów Authority (w tym utworzono: %s), usunięto: %s.',
             authoritiesCounter.synced, authoritiesCounter.created, authoritiesCounter.deleted
-        )
\ No newline at end of file
+        )
+
+
+    @classmethod
+    def __syncPermissions(cls, logger, departmentHeads):
+        u'''
+        Uzgadnia przynależność użytkowników do grup uprawnień (moduł permissions) ze zsynchronizowanymi obiektami:
+        dodaje i usuwa jedynie te powiązania, które uległy zmianie, nie usuwając samych grup ani uprawnień.
+
+        @param departmentHeads set kierownicy jednostek wyznaczeni przez LdapSync.__syncOrganizationalUnits()
+            albo None, jeśli jednostki nie były synchronizowane
+        '''
+        with transaction.atomic():
+            added, removed = permissions.reconcile(permissions.memberships(departmentHeads), SQL_BATCH_SIZE)
+        logger.info(u'Uzgodniono przynależność użytkowników do grup uprawnień (dodano: %s, usunięto: %s).', added, removed)
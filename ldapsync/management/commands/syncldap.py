@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
 from django.core.management.base import BaseCommand
+from optparse import make_option
 import logging
 from ldapsync.ldapsync import LdapSync
 from itertools import izip
@@ -13,8 +14,30 @@ class Command(BaseCommand):
            komunikatow wypisywanych na konsole.
            Dostepne opcje: NOTSET, DEBUG, INFO, WARNING, ERROR, CRITICAL.
            Domyslnym poziomem jest INFO.
+           Domyslnie przeprowadzana jest pelna synchronizacja, opcja --incremental
+           ogranicza ja do wpisow LDAP zmienionych od poprzedniej synchronizacji,
+           opcja --staged zapisuje wszystkie zmiany w jednej transakcji po pobraniu
+           i sprawdzeniu danych z bazy LDAP, a opcja --follow synchronizuje baze na biezaco (syncrepl), az do przerwania.
            '''
 
+    option_list = BaseCommand.option_list + (
+        make_option('--incremental',
+            action='store_true',
+            dest='incremental',
+            default=False,
+            help='Synchronizuje tylko wpisy LDAP zmienione od poprzedniej synchronizacji.'),
+        make_option('--staged',
+            action='store_true',
+            dest='staged',
+            default=False,
+            help='Pobiera i sprawdza dane z bazy LDAP przed synchronizacja, a zmiany zapisuje w jednej transakcji.'),
+        make_option('--follow',
+            action='store_true',
+            dest='follow',
+            default=False,
+            help='Synchronizuje baze na biezaco na podstawie powiadomien serwera LDAP (RFC 4533).'),
+    )
+
     log_levels = {
         'NOTSET': logging.NOTSET,
         'DEBUG': logging.DEBUG,
@@ -36,7 +59,12 @@ class Command(BaseCommand):
         else:
             logger.setLevel(logging.INFO)
         #uruchom synchronizację
-        LdapSync.sync(logger)
+        if options['follow']:
+            # moduł wymaga ldap.syncrepl (python-ldap >= 2.4.14), więc jest importowany tylko w tym trybie
+            from ldapsync.syncrepl import follow
+            follow(logger)
+        else:
+            LdapSync.sync(logger, incremental=options['incremental'], staged=options['staged'])
 
 
     class PolishUnicodeToAsciiFormatter(logging.Formatter):
@@ -4,13 +4,17 @@ u''' @package ldapsync.models
 Moduł gromadzący wszystkie modele opisujące dane przechowywane w bazie LDAP.
 
 Modele LdapXxx są wykorzystywane przez moduł ldapsync.ldapsync do synchronizowania
-lokalnej, relacyjnej bazy danych z bazą LDAP.
+lokalnej, relacyjnej bazy danych z bazą LDAP. Model SyncState przechowuje w bazie lokalnej
+stan synchronizacji przyrostowej.
 '''
 
 from ldapdb.models.fields import (CharField, ImageField, ListField, IntegerField, FloatField)
+from ldapdb.models.cache import normalize_dn
 from django.db import models
 import ldapdb.models
 import ldap
+import threading
+import time
 
 ### Bazowe Distinguished Name dla wszystkich modeli LdapXxx
 LDAP_BASE_DN = 'ou=FCS,o=BUT,c=pl'
@@ -18,6 +22,8 @@ LDAP_BASE_DN = 'ou=FCS,o=BUT,c=pl'
 LDAP_ORGANIZATIONAL_UNIT_HEAD_NODE = 'cn=kierownik'
 ### Nazwa węzła zawierającego pracowników jednostki organizacyjnej
 LDAP_ORGANIZATIONAL_UNIT_EMPLOYEES_NODE = 'cn=pracownicy'
+### Czas ważności (w sekundach) indeksu przypisującego pracownikom jednostki organizacyjne
+LDAP_EMPLOYEES_INDEX_TTL = 300
 
 class LdapStudent(ldapdb.models.Model):
     u'''
@@ -36,6 +42,9 @@ class LdapStudent(ldapdb.models.Model):
     fullName = CharField(db_column='cn')
     email = CharField(db_column='mail')
 
+    ### czas ostatniej modyfikacji wpisu (atrybut operacyjny, w formacie generalizedTime) - tylko do odczytu
+    modifyTimestamp = CharField(db_column='modifyTimestamp')
+
     def __unicode__(self):
         return '%s %s' % (self.username, self.fullName)
 
@@ -59,6 +68,9 @@ class LdapOrganization(ldapdb.models.Model):
     ### email osoby reprezentującej organizację
     representantEmail = CharField(db_column='mail')
 
+    ### czas ostatniej modyfikacji wpisu (atrybut operacyjny, w formacie generalizedTime) - tylko do odczytu
+    modifyTimestamp = CharField(db_column='modifyTimestamp')
+
     def __unicode__(self):
         return '%s, %s %s' % (self.name, self.representantFirstName, self.representantLastName)
 
@@ -83,6 +95,9 @@ class LdapEmployee(ldapdb.models.Model):
     ### stanowisko pracy (asystent, adiunkt, itp.)
     position = CharField(db_column='employeeType')
 
+    ### czas ostatniej modyfikacji wpisu (atrybut operacyjny, w formacie generalizedTime) - tylko do odczytu
+    modifyTimestamp = CharField(db_column='modifyTimestamp')
+
     def __getattr__(self, name):
         u'''
         Zapewnia przekierowanie wywołań atrybutu LdapEmployee.organizationalUnit
@@ -101,15 +116,7 @@ class LdapEmployee(ldapdb.models.Model):
         Odwoływać się poprzez LdapEmployee.organizationalUnit (nadpisano LdapEmployee.__getattr__()).
         @returns LdapOrganizationalUnit
         '''
-        result = None
-
-        organizationalUnits = LdapOrganizationalUnit.objects.all()
-        for unit in organizationalUnits:
-            if self in unit.employees:
-                result = unit
-                break
-
-        return result
+        return LdapOrganizationalUnit.getEmployeesIndex().get(normalize_dn(self.dn))
 
     ### Nadpisany operator porównania.
     def __eq__(self, other):
@@ -133,6 +140,9 @@ class LdapStudyCycle(ldapdb.models.Model):
     ### lista DN studentów realizujących dany cykl
     studentsDnList = ListField(db_column='member')
 
+    ### czas ostatniej modyfikacji wpisu (atrybut operacyjny, w formacie generalizedTime) - tylko do odczytu
+    modifyTimestamp = CharField(db_column='modifyTimestamp')
+
     def __getattr__(self, name):
         u'''
         Zapewnia przekierowanie wywołań atrybutu LdapStudyCycle.students
@@ -150,10 +160,8 @@ class LdapStudyCycle(ldapdb.models.Model):
         Odwoływać się poprzez LdapStudyCycle.students (nadpisano LdapStudyCycle.__getattr__()).
         @returns [LdapStudent] lista studentów
         '''
-        result = []
-        for studentDn in self.studentsDnList:
-            result += LdapStudent.scoped(studentDn).objects.all()
-        return result
+        students = LdapStudent.resolve_dns(self.studentsDnList)
+        return [students[dn] for dn in self.studentsDnList if dn in students]
 
     def __unicode__(self):
         return self.name
@@ -186,6 +194,49 @@ class LdapOrganizationalUnit(ldapdb.models.Model):
         else:
             raise AttributeError(name)
 
+    ### indeks DN pracownika -> jednostka organizacyjna, patrz getEmployeesIndex()
+    __employeesIndex = None
+    ### czas zbudowania indeksu
+    __employeesIndexTime = 0
+    __employeesIndexLock = threading.Lock()
+
+    @classmethod
+    def getEmployeesIndex(cls):
+        u'''
+        Zwraca indeks przypisujący znormalizowanym DN pracowników ich jednostki organizacyjne
+        (odpowiednik atrybutu memberOf). Indeks jest budowany dwoma zapytaniami: o wszystkie jednostki
+        i o wszystkie grupy pracowników, a następnie przechowywany przez LDAP_EMPLOYEES_INDEX_TTL sekund.
+        Pracownik należący do kilku jednostek jest przypisany do pierwszej z nich.
+        @returns {str: LdapOrganizationalUnit}
+        '''
+        with cls.__employeesIndexLock:
+            if cls.__employeesIndex is not None and time.time() - cls.__employeesIndexTime < LDAP_EMPLOYEES_INDEX_TTL:
+                return cls.__employeesIndex
+
+            groupName = LDAP_ORGANIZATIONAL_UNIT_EMPLOYEES_NODE.split('=', 1)[1]
+            groups = LdapOrganizationalMemebersGroup.scoped(cls.base_dn).objects.filter(name=groupName)
+            groupsByDn = dict((normalize_dn(group.dn), group) for group in groups)
+
+            index = {}
+            for unit in cls.objects.all():
+                group = groupsByDn.get(normalize_dn('%s,%s' % (LDAP_ORGANIZATIONAL_UNIT_EMPLOYEES_NODE, unit.dn)))
+                if group is None:
+                    continue
+                for memberDn in group.members:
+                    index.setdefault(normalize_dn(memberDn), unit)
+
+            cls.__employeesIndex = index
+            cls.__employeesIndexTime = time.time()
+            return index
+
+    @classmethod
+    def clearEmployeesIndex(cls):
+        u'''
+        Unieważnia indeks zwracany przez LdapOrganizationalUnit.getEmployeesIndex().
+        '''
+        with cls.__employeesIndexLock:
+            cls.__employeesIndex = None
+
     # self.head : LdapEmployee
     def __getHead(self):
         u'''
@@ -193,11 +244,11 @@ class LdapOrganizationalUnit(ldapdb.models.Model):
         Odwoływać się poprzez LdapOrganizationalUnit.head (nadpisano LdapOrganizationalUnit.__getattr__()).
         @returns LdapEmployee kierownik jednostki
         '''
-        headRole = LdapOrganizationalRole.scoped('%s,%s' % (LDAP_ORGANIZATIONAL_UNIT_HEAD_NODE, self.dn)).objects.first()
-        if headRole is not None:
-            return headRole.occupant
-        else:
+        try:
+            headRole = LdapOrganizationalRole.get_by_dn('%s,%s' % (LDAP_ORGANIZATIONAL_UNIT_HEAD_NODE, self.dn))
+        except LdapOrganizationalRole.DoesNotExist:
             return None
+        return headRole.occupant
     
     # self.employees : Lista<LdapEmployee>
     def __getEmployees(self):
@@ -206,15 +257,15 @@ class LdapOrganizationalUnit(ldapdb.models.Model):
         Odwoływać się poprzez LdapOrganizationalUnit.employees (nadpisano LdapOrganizationalUnit.__getattr__()).
         @returns [LdapEmployee] pracownicy jednostki
         '''
-        scopedModel = LdapOrganizationalMemebersGroup.scoped('%s,%s' % (LDAP_ORGANIZATIONAL_UNIT_EMPLOYEES_NODE, self.dn))
         # pozyskanie grupy pracowników jako listy DN
-        employeesGroup = scopedModel.objects.first()
+        try:
+            employeesGroup = LdapOrganizationalMemebersGroup.get_by_dn('%s,%s' % (LDAP_ORGANIZATIONAL_UNIT_EMPLOYEES_NODE, self.dn))
+        except LdapOrganizationalMemebersGroup.DoesNotExist:
+            return []
 
-        result = []
-        for employeeDn in employeesGroup.members:
-            # pobieranie odpowiedniego LdapEmployee i dodanie do listy
-            result += LdapEmployee.scoped(employeeDn).objects.all()
-        return result
+        # pobranie wszystkich LdapEmployee zbiorczymi zapytaniami
+        employees = LdapEmployee.resolve_dns(employeesGroup.members)
+        return [employees[dn] for dn in employeesGroup.members if dn in employees]
 
     def __unicode__(self):
         return self.name
@@ -247,7 +298,10 @@ class LdapOrganizationalRole(ldapdb.models.Model):
         Odwoływać się poprzez LdapOrganizationalRole.occupant (nadpisano LdapOrganizationalRole.__getattr__()).
         @returns LdapEmployee osoba pełniąca daną rolę
         '''
-        return LdapEmployee.scoped(self.occupantDn).objects.first()
+        try:
+            return LdapEmployee.get_by_dn(self.occupantDn)
+        except LdapEmployee.DoesNotExist:
+            return None
 
     def __unicode__(self):
         return '%s => %s' % (self.name, self.occupant)
@@ -289,12 +343,32 @@ class LdapAuthorities(object):
         @param name nazwa roli w bazie LDAP
         @returns LdapEmployee
         '''
-        scopedModel = LdapOrganizationalRole.scoped('cn=%s,%s' % (name, cls.base_dn))
-        role = scopedModel.objects.first()
-        if role is not None:
-            return role.getOccupant()
-        else:
+        try:
+            role = LdapOrganizationalRole.get_by_dn('cn=%s,%s' % (name, cls.base_dn))
+        except LdapOrganizationalRole.DoesNotExist:
             raise DoesNotExist(name)
+        return role.getOccupant()
+
+class SyncState(models.Model):
+    u'''
+    Stan synchronizacji lokalnej bazy danych z bazą LDAP, przechowywany w bazie lokalnej.
+    Istnieje tylko jeden taki obiekt, zwracany przez metodę SyncState.load().
+    '''
+    ### znacznik czasu (w formacie generalizedTime), od którego synchronizacja przyrostowa pobiera zmienione wpisy LDAP
+    highWaterMark = models.CharField(max_length=32, null=True, blank=True)
+    ### czas ostatniej pełnej synchronizacji
+    lastFullSyncAt = models.DateTimeField(null=True, blank=True)
+    ### czas ostatniego wyszukiwania wpisów usuniętych z bazy LDAP
+    lastSweepAt = models.DateTimeField(null=True, blank=True)
+    ### ciasteczko synchronizacji syncrepl (RFC 4533), pozwalające wznowić ją po ponownym uruchomieniu
+    cookie = models.TextField(null=True, blank=True)
+
+    @classmethod
+    def load(cls):
+        u'''
+        Zwraca obiekt stanu synchronizacji, tworząc go, jeśli jeszcze nie istnieje.
+        '''
+        return cls.objects.get_or_create(pk=1)[0]
 
 class DoesNotExist(Exception):
     u'''
@@ -5,19 +5,24 @@ Moduł zapewniający funkcje służące do rejestracji użytkowników w systemie
 
 Moduł jest wykorzystywany w module synchronizującym lokalne modele z systemem LDAP.
 
-Przed rejestrowaniem użytkowników należy wywołać funkcję prepareForSync(),
-która usunie i stworzy na nowo niezbędne obiekty uprawnień oraz grup,
+Przed synchronizacją należy wywołać funkcję initialize(), która utworzy brakujące obiekty uprawnień oraz grup.
+Po synchronizacji funkcja reconcile() uzgadnia przynależność użytkowników do grup z wyznaczoną przez
+funkcję memberships(), dodając i usuwając jedynie te powiązania, które uległy zmianie - obiekty grup
+i uprawnień nie są przy tym usuwane ani tworzone na nowo.
+
+Funkcja reload() (i jej alias prepareForSync()) usuwa i tworzy na nowo obiekty uprawnień oraz grup,
 jednocześnie zrywając wcześniejsze powiązania użytkowników z uprawnieniami.
 '''
 
 from django.utils.translation import pgettext
-from django.contrib.auth.models import Permission, Group
+from django.contrib.auth.models import Permission, Group, User
 from django.db.utils import OperationalError
 from django.contrib.contenttypes.models import ContentType
 from topics.models import ThesisTopic
 from authorships.models import SubmissionCriterion, Authorship, SubmissionCriterionValue
 from reviews.models import Review
 from theses.models import Thesis
+from faculty.models import Student, Employee, Organization, Authority
 
 def initialize():
     u'''
@@ -180,6 +185,61 @@ def registerSupervisor(employee):
     '''
     employee.user.groups.add(__group(SUPERVISORS_GROUP))
 
+def memberships(departmentHeads=None):
+    u'''
+    Wyznacza na podstawie obiektów zsynchronizowanych z bazą LDAP, którzy użytkownicy powinni należeć
+    do grup używanych przez moduł. Przydział odpowiada funkcjom register*(): studenci należą do grupy studentów,
+    pracownicy ze stopniem co najmniej doktora i przedstawiciele organizacji - do grup jak w registerEmployee()
+    i registerOrganization(), podani kierownicy jednostek - do grupy kierowników katedr, a dziekan i prodziekan
+    ds. studenckich - do grupy władz wydziału.
+
+    @param departmentHeads set klucze główne użytkowników, którzy są kierownikami jednostek według bazy LDAP;
+        jeśli nie zostanie podany, to grupa kierowników katedr jest pomijana (patrz reconcile())
+    @returns dict słownik, w którym kluczem jest nazwa kodowa grupy, a wartością zbiór kluczy głównych użytkowników
+    '''
+    result = dict((key, set()) for key in __groups)
+    result[STUDENTS_GROUP].update(Student.objects.filter(isLdapSynced=True).values_list('user_id', flat=True))
+    for employee in Employee.objects.filter(isLdapSynced=True):
+        if employee.isDoctorOrAbove:
+            for key in (THESIS_SUBJECT_AUTHORS_GROUP, SUPERVISORS_GROUP, REVIEWERS_GROUP):
+                result[key].add(employee.user_id)
+    result[THESIS_SUBJECT_AUTHORS_GROUP].update(
+        Organization.objects.filter(isLdapSynced=True).values_list('user_id', flat=True))
+    if departmentHeads is None:
+        del result[DEPARTMENT_HEAD_GROUP]
+    else:
+        result[DEPARTMENT_HEAD_GROUP].update(departmentHeads)
+    result[FACULTY_HEAD_GROUP].update(
+        Authority.objects.filter(role__in=[Authority.DEAN, Authority.VICE_DEAN_FOR_STUDENTS],
+                                 occupant__isLdapSynced=True).values_list('occupant__user_id', flat=True))
+    return result
+
+def reconcile(members, batchSize):
+    u'''
+    Uzgadnia przynależność użytkowników do grup używanych przez moduł z podaną: brakujące powiązania są dodawane
+    zbiorczo, a nadmiarowe usuwane, bez zmieniania pozostałych oraz samych obiektów grup i uprawnień.
+
+    @param members dict słownik, w którym kluczem jest nazwa kodowa grupy, a wartością zbiór kluczy głównych
+        użytkowników (patrz memberships()); przynależność do grup, których nie ma w słowniku, pozostaje bez zmian
+    @param batchSize int maksymalna liczba użytkowników usuwanych z grupy jednym zapytaniem
+    @returns tuple (liczba dodanych powiązań, liczba usuniętych powiązań)
+    '''
+    Membership = User.groups.through
+    added = removed = 0
+    for key in __groups:
+        if key not in members:
+            continue
+        group = __group(key)
+        desired = members[key]
+        existing = set(Membership.objects.filter(group=group).values_list('user_id', flat=True))
+        obsolete = list(existing - desired)
+        for i in xrange(0, len(obsolete), batchSize):
+            Membership.objects.filter(group=group, user_id__in=obsolete[i:i + batchSize]).delete()
+        Membership.objects.bulk_create([Membership(user_id=userId, group=group) for userId in desired - existing])
+        added += len(desired - existing)
+        removed += len(obsolete)
+    return added, removed
+
 def __permission(key):
     u'''
     Getter obiektu uprawnienia.
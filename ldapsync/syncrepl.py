@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+
+u''' @package ldapsync.syncrepl
+Moduł zapewniający ciągłą synchronizację lokalnej bazy danych z bazą LDAP na podstawie
+powiadomień o zmianach wysyłanych przez serwer LDAP (RFC 4533, tryb refreshAndPersist).
+
+Zmienione wpisy są zbierane w paczki i przekazywane do LdapSync.syncEntries(), a usunięcie
+wpisów powoduje wywołanie LdapSync.syncDeletions(). Jednostki organizacyjne, władze wydziału i uprawnienia
+są synchronizowane (LdapSync.syncDependents()) raz, po zastosowaniu wszystkich zebranych paczek.
+Ciasteczko synchronizacji jest zapisywane w obiekcie models.SyncState dopiero po zastosowaniu zmian,
+więc po ponownym uruchomieniu serwer przesyła jedynie zmiany, które nie zostały zastosowane.
+Z tego samego powodu zmiany odebrane przed utratą połączenia lub błędem serwera LDAP są porzucane
+- serwer prześle je ponownie.
+
+follow() uruchamia synchronizację, która trwa do czasu przerwania procesu.
+'''
+
+import logging
+import time
+import ldap
+from ldap.ldapobject import LDAPObject
+from ldap.syncrepl import SyncreplConsumer
+from django.db import close_old_connections, connections
+from ldapdb.router import Router
+from models import LDAP_BASE_DN, SyncState
+from ldapsync import LdapSync
+import permissions
+
+### Czas (w sekundach) oczekiwania na kolejne powiadomienia, po którym zebrane zmiany są stosowane
+FOLLOW_BATCH_TIMEOUT = 1
+### Maksymalna liczba zmienionych wpisów stosowanych jednocześnie
+FOLLOW_BATCH_SIZE = 500
+### Czas (w sekundach) oczekiwania przed ponownym połączeniem z serwerem LDAP
+FOLLOW_RECONNECT_DELAY = 10
+### Kod błędu e-syncRefreshRequired (RFC 4533): ciasteczko jest nieaktualne i wymagane jest pełne odświeżenie
+SYNC_REFRESH_REQUIRED = 0x1000
+
+
+class LdapFollower(LDAPObject, SyncreplConsumer):
+    u'''
+    Połączenie z serwerem LDAP odbierające powiadomienia o zmianach i stosujące je w lokalnej bazie danych.
+    '''
+    def __init__(self, uri, logger):
+        LDAPObject.__init__(self, uri)
+        self.logger = logger
+        ### stan synchronizacji zapisany w lokalnej bazie
+        self.state = SyncState.load()
+        ### ciasteczko synchronizacji odpowiadające odebranym powiadomieniom
+        self.cookie = self.state.cookie
+        ### DN zmienionych wpisów, które nie zostały jeszcze zastosowane
+        self.changedDns = set()
+        ### czy odebrano powiadomienie o usunięciu wpisów, które nie zostało jeszcze zastosowane
+        self.deleted = False
+        ### czy zastosowano zmiany, po których nie wykonano jeszcze LdapSync.syncDependents()
+        self.applied = False
+        ### czy zastosowane zmiany wymagają synchronizacji jednostek organizacyjnych i władz wydziału
+        self.syncUnits = self.syncAuthorities = False
+
+    def syncrepl_get_cookie(self):
+        return self.cookie
+
+    def syncrepl_set_cookie(self, cookie):
+        self.cookie = cookie
+
+    def syncrepl_entry(self, dn, attributes, uuid):
+        self.changedDns.add(dn)
+        if len(self.changedDns) >= FOLLOW_BATCH_SIZE:
+            self.applyEntries()
+
+    def syncrepl_delete(self, uuids):
+        #powiadomienie zawiera jedynie identyfikatory UUID usuniętych wpisów,
+        # więc usunięte obiekty są wyszukiwane przez LdapSync.syncDeletions()
+        self.deleted = True
+
+    def syncrepl_present(self, uuids, refreshDeletes=False):
+        #wpisy niewymienione w fazie "present" zostały usunięte,
+        # co jest obsługiwane po zakończeniu fazy odświeżania (syncrepl_refreshdone())
+        pass
+
+    def syncrepl_refreshdone(self):
+        self.deleted = True
+        self.flush()
+        self.logger.info(u'Zakończono odświeżanie, oczekiwanie na powiadomienia o zmianach w bazie LDAP...')
+
+    def applyEntries(self):
+        u'''
+        Stosuje w lokalnej bazie zebrane zmiany wpisów, bez synchronizacji jednostek organizacyjnych,
+        władz wydziału i uprawnień (patrz LdapFollower.flush()) i bez zapisywania ciasteczka synchronizacji.
+        '''
+        if not self.changedDns:
+            return
+        close_old_connections()
+        self.logger.info(u'Synchronizacja %s zmienionych wpisów LDAP...', len(self.changedDns))
+        syncUnits, syncAuthorities = LdapSync.syncEntries(self.changedDns, self.logger)
+        self.changedDns = set()
+        self.applied = True
+        self.syncUnits = self.syncUnits or syncUnits
+        self.syncAuthorities = self.syncAuthorities or syncAuthorities
+
+    def flush(self):
+        u'''
+        Stosuje w lokalnej bazie odebrane zmiany, synchronizuje raz jednostki organizacyjne, władze wydziału
+        i uprawnienia, a następnie zapisuje ciasteczko synchronizacji.
+        '''
+        self.applyEntries()
+        if self.deleted:
+            close_old_connections()
+            self.logger.info(u'Synchronizacja usuniętych wpisów LDAP...')
+            LdapSync.syncDeletions(self.logger)
+            self.deleted = False
+            self.applied = self.syncUnits = self.syncAuthorities = True
+        if self.applied:
+            LdapSync.syncDependents(self.logger, self.syncUnits, self.syncAuthorities)
+            self.applied = self.syncUnits = self.syncAuthorities = False
+        if self.cookie != self.state.cookie:
+            self.state.cookie = self.cookie
+            self.state.save(update_fields=['cookie'])
+
+    def discard(self):
+        u'''
+        Porzuca odebrane zmiany bez zapisywania ciasteczka synchronizacji (serwer prześle je ponownie)
+        i zamyka połączenie.
+        '''
+        self.changedDns = set()
+        self.deleted = False
+        self.applied = self.syncUnits = self.syncAuthorities = False
+        try:
+            self.unbind_s()
+        except ldap.LDAPError:
+            pass
+
+
+def isRefreshRequired(error):
+    u'''
+    Sprawdza, czy błąd serwera LDAP oznacza, że ciasteczko synchronizacji jest nieaktualne
+    i wymagane jest pełne odświeżenie (e-syncRefreshRequired, RFC 4533).
+
+    @param error ldap.LDAPError błąd zgłoszony przez serwer LDAP
+    '''
+    info = error.args[0] if error.args and isinstance(error.args[0], dict) else {}
+    return info.get('result') == SYNC_REFRESH_REQUIRED or 'refresh required' in info.get('desc', '').lower()
+
+def resetCookie():
+    u'''
+    Usuwa zapisane ciasteczko synchronizacji, więc po ponownym połączeniu serwer przeprowadzi pełne odświeżenie.
+    '''
+    close_old_connections()
+    state = SyncState.load()
+    state.cookie = None
+    state.save(update_fields=['cookie'])
+
+
+def connect(logger):
+    u'''
+    Otwiera połączenie odbierające powiadomienia, z parametrami bazy LDAP z ustawień Django.
+    '''
+    settingsDict = connections[Router().ldap_alias].settings_dict
+    follower = LdapFollower(settingsDict['NAME'], logger)
+    for opt, value in settingsDict.get('CONNECTION_OPTIONS', {}).items():
+        follower.set_option(opt, value)
+    if settingsDict.get('TLS', False):
+        follower.start_tls_s()
+    follower.simple_bind_s(settingsDict['USER'], settingsDict['PASSWORD'])
+    return follower
+
+def follow(logger=None):
+    u'''
+    Synchronizuje lokalną bazę danych z bazą LDAP na bieżąco, do czasu przerwania procesu.
+    Po utracie połączenia z serwerem LDAP lub błędzie serwera łączy się ponownie i wznawia synchronizację
+    od zapisanego ciasteczka, a jeśli serwer uzna je za nieaktualne - od pełnego odświeżenia.
+
+    @param logger logging.Logger patrz LdapSync.sync()
+    '''
+    if not logger:
+        logger = logging.getLogger(__name__)
+    permissions.initialize()
+    while True:
+        follower = None
+        try:
+            follower = connect(logger)
+            msgid = follower.syncrepl_search(LDAP_BASE_DN, ldap.SCOPE_SUBTREE, mode='refreshAndPersist')
+            while True:
+                try:
+                    if not follower.syncrepl_poll(msgid=msgid, timeout=FOLLOW_BATCH_TIMEOUT, all=1):
+                        break
+                except ldap.TIMEOUT:
+                    #brak nowych powiadomień - zastosuj zebrane zmiany
+                    follower.flush()
+            follower.flush()
+            follower.unbind_s()
+            logger.warn(u'Serwer LDAP zakończył wysyłanie powiadomień, ponowne połączenie.')
+        except ldap.LDAPError as e:
+            delay = FOLLOW_RECONNECT_DELAY
+            if isinstance(e, ldap.SERVER_DOWN):
+                logger.warn(u'Utracono połączenie z serwerem LDAP (%s), ponowne połączenie za %s s.', e, delay)
+            elif isRefreshRequired(e):
+                delay = 0
+                logger.warn(u'Serwer LDAP uznał ciasteczko synchronizacji za nieaktualne, '
+                            u'zostanie przeprowadzone pełne odświeżenie.')
+                resetCookie()
+            else:
+                logger.error(u'Błąd serwera LDAP (%s), ponowne połączenie za %s s.', e, delay)
+            #zmiany niezapisane w lokalnej bazie zostaną przesłane ponownie, bo ciasteczko ich nie obejmuje
+            if follower is not None:
+                follower.discard()
+            time.sleep(delay)
@@ -1,11 +1,95 @@
-"""
-This file demonstrates writing tests using the unittest module. These will pass
-when you run "manage.py test".
-
-Replace this with more appropriate tests for your application.
-"""
+# -*- coding: utf-8 -*-
 
+import logging
+import ldap
+from unittest import skipIf
+from django.contrib.auth.models import User
 from django.test import TestCase
+from faculty.models import Student, Employee, OrganizationalUnit
+from models import SyncState, LdapStudent, LdapStudyCycle, LdapEmployee, LdapOrganization, LdapOrganizationalUnit
+from models import LdapAuthorities
+from ldapsync import LdapSync, SnapshotError
+import ldapsync
+import models
+import permissions
+
+try:
+    import syncrepl
+except ImportError:
+    #python-ldap bez obsługi RFC 4533
+    syncrepl = None
+
+
+class Entry(object):
+    u'''
+    Zastępuje wpis LDAP, przechowując jedynie podane atrybuty.
+    '''
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class BrokenEntry(Entry):
+    u'''
+    Wpis LDAP, którego odczytanie kończy się błędem.
+    '''
+    @property
+    def firstName(self):
+        raise ValueError(self.username)
+
+
+class StubManager(object):
+    u'''
+    Zastępuje menedżer modelu LDAP, zwracając podane wpisy i zliczając zapytania.
+    '''
+    def __init__(self, entries):
+        self.entries = entries
+        self.queries = 0
+
+    def all(self):
+        self.queries += 1
+        return list(self.entries)
+
+    def filter(self, **kwargs):
+        return self.all()
+
+
+class StopFollowing(Exception):
+    u'''
+    Przerywa pętlę syncrepl.follow() po wyczerpaniu przygotowanych połączeń.
+    '''
+    pass
+
+
+class ListHandler(logging.Handler):
+    u'''
+    Zapisuje komunikaty wypisane przez logger.
+    '''
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+class RecordingLdapSync(object):
+    u'''
+    Zastępuje LdapSync, zapisując jedynie wywołania synchronizacji.
+    '''
+    calls = []
+
+    @classmethod
+    def syncEntries(cls, dns, logger=None):
+        cls.calls.append(('entries', set(dns)))
+        return any('ou=units' in dn for dn in dns), False
+
+    @classmethod
+    def syncDeletions(cls, logger=None):
+        cls.calls.append(('deletions', ))
+
+    @classmethod
+    def syncDependents(cls, logger=None, units=True, authorities=True):
+        cls.calls.append(('dependents', units, authorities))
 
 
 class SimpleTest(TestCase):
@@ -14,3 +98,528 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+if syncrepl is not None:
+    class ScriptedFollower(syncrepl.LdapFollower):
+        u'''
+        Połączenie bez serwera LDAP: kolejne wywołania syncrepl_poll() wykonują podane funkcje.
+        '''
+        def __init__(self, logger, polls, searchError=None):
+            syncrepl.LdapFollower.__init__(self, 'ldap://stub', logger)
+            self.polls = list(polls)
+            self.searchError = searchError
+            self.unbound = False
+
+        def syncrepl_search(self, base, scope, mode, **kwargs):
+            if self.searchError is not None:
+                raise self.searchError
+            return 1
+
+        def syncrepl_poll(self, msgid, timeout, all):
+            if not self.polls:
+                return False
+            self.polls.pop(0)(self)
+            return True
+
+        def unbind_s(self):
+            self.unbound = True
+
+
+@skipIf(syncrepl is None, 'python-ldap does not support syncrepl')
+class FollowTestCase(TestCase):
+    def setUp(self):
+        self.logger = logging.getLogger('ldapsync.tests')
+        self.logger.disabled = True
+        self.saved = (syncrepl.LdapSync, syncrepl.connect, syncrepl.time.sleep, syncrepl.permissions.initialize)
+        RecordingLdapSync.calls = []
+        syncrepl.LdapSync = RecordingLdapSync
+        syncrepl.time.sleep = self.sleep
+        syncrepl.permissions.initialize = lambda: None
+        self.delays = []
+        self.followers = []
+        self.cookies = []
+
+    def tearDown(self):
+        syncrepl.LdapSync, syncrepl.connect, syncrepl.time.sleep, syncrepl.permissions.initialize = self.saved
+        self.logger.disabled = False
+
+    def sleep(self, delay):
+        self.delays.append(delay)
+
+    def follow(self, *scripts):
+        u'''
+        Uruchamia follow() z połączeniami tworzonymi według podanych (polls, searchError)
+        i zwraca utworzone połączenia.
+        '''
+        scripts = list(scripts)
+
+        def connect(logger):
+            if not scripts:
+                raise StopFollowing()
+            follower = ScriptedFollower(logger, *scripts.pop(0))
+            self.cookies.append(follower.cookie)
+            self.followers.append(follower)
+            return follower
+        syncrepl.connect = connect
+        self.assertRaises(StopFollowing, syncrepl.follow, self.logger)
+        return self.followers
+
+    def test_flush(self):
+        def receive(follower):
+            follower.syncrepl_set_cookie('c1')
+            follower.syncrepl_entry('uid=a,ou=people,dc=example,dc=org', {}, 'u1')
+            follower.syncrepl_delete(['u2'])
+
+        def timeout(follower):
+            raise ldap.TIMEOUT()
+        followers = self.follow(([receive, timeout], ))
+        self.assertEqual(RecordingLdapSync.calls,
+                         [('entries', set(['uid=a,ou=people,dc=example,dc=org'])), ('deletions', ),
+                          ('dependents', True, True)])
+        self.assertEqual(SyncState.load().cookie, 'c1')
+        self.assertTrue(followers[0].unbound)
+        self.assertEqual(self.delays, [])
+
+    def test_batches(self):
+        state = SyncState.load()
+        state.cookie = 'c0'
+        state.save()
+        self.batchSize = syncrepl.FOLLOW_BATCH_SIZE
+        syncrepl.FOLLOW_BATCH_SIZE = 2
+        self.addCleanup(setattr, syncrepl, 'FOLLOW_BATCH_SIZE', self.batchSize)
+
+        def receive(follower):
+            follower.syncrepl_set_cookie('c1')
+            for dn in ('uid=a,ou=people,dc=example,dc=org', 'ou=u1,ou=units,dc=example,dc=org',
+                       'uid=b,ou=people,dc=example,dc=org'):
+                follower.syncrepl_entry(dn, {}, 'u1')
+            #paczka została zastosowana, ale ciasteczko jest zapisywane dopiero po synchronizacji zależności
+            self.assertEqual(len(RecordingLdapSync.calls), 1)
+            self.assertEqual(SyncState.load().cookie, 'c0')
+
+        def timeout(follower):
+            raise ldap.TIMEOUT()
+        self.follow(([receive, timeout, timeout], ))
+        #jednostki, władze wydziału i uprawnienia są synchronizowane raz dla wszystkich paczek
+        self.assertEqual(RecordingLdapSync.calls,
+                         [('entries', set(['uid=a,ou=people,dc=example,dc=org', 'ou=u1,ou=units,dc=example,dc=org'])),
+                          ('entries', set(['uid=b,ou=people,dc=example,dc=org'])),
+                          ('dependents', True, False)])
+        self.assertEqual(SyncState.load().cookie, 'c1')
+
+    def test_server_down(self):
+        state = SyncState.load()
+        state.cookie = 'c0'
+        state.save()
+
+        def receive(follower):
+            follower.syncrepl_set_cookie('c1')
+            follower.syncrepl_entry('uid=a,ou=people,dc=example,dc=org', {}, 'u1')
+
+        def disconnect(follower):
+            raise ldap.SERVER_DOWN()
+        followers = self.follow(([receive, disconnect], ), ([], ))
+        #zmiany odebrane przed utratą połączenia nie są stosowane, a ciasteczko nie jest zapisywane
+        self.assertEqual(RecordingLdapSync.calls, [])
+        self.assertEqual(followers[0].changedDns, set())
+        self.assertEqual(self.cookies, ['c0', 'c0'])
+        self.assertEqual(SyncState.load().cookie, 'c0')
+        self.assertEqual(self.delays, [syncrepl.FOLLOW_RECONNECT_DELAY])
+
+    def test_refresh_required(self):
+        state = SyncState.load()
+        state.cookie = 'stale'
+        state.save()
+        error = ldap.LDAPError({'result': syncrepl.SYNC_REFRESH_REQUIRED, 'desc': 'Content Sync Refresh Required'})
+        followers = self.follow(([], error), ([], ))
+        self.assertEqual(self.cookies, ['stale', None])
+        self.assertIsNone(SyncState.load().cookie)
+        self.assertTrue(followers[0].unbound)
+        self.assertEqual(self.delays, [0])
+
+    def test_ldap_error(self):
+        state = SyncState.load()
+        state.cookie = 'c0'
+        state.save()
+        followers = self.follow(([], ldap.OTHER({'desc': 'Other (e.g., implementation specific) error'})), ([], ))
+        self.assertEqual(self.cookies, ['c0', 'c0'])
+        self.assertTrue(followers[0].unbound)
+        self.assertEqual(self.delays, [syncrepl.FOLLOW_RECONNECT_DELAY])
+
+
+class SyncEntriesTestCase(TestCase):
+    base = 'ou=FCS,o=BUT,c=pl'
+
+    def setUp(self):
+        self.logger = logging.getLogger('ldapsync.tests.entries')
+        self.handler = ListHandler()
+        self.logger.addHandler(self.handler)
+        self.logger.setLevel(logging.INFO)
+        self.logger.propagate = False
+        self.calls = []
+        for phase in ('Students', 'StudyCycles', 'Employees', 'Organizations'):
+            self.patch(LdapSync, '_LdapSync__sync' + phase, classmethod(
+                lambda cls, logger, lookups, phase=phase: self.calls.append((phase, sorted(lookups['pk__in'])))))
+        students = {'uid=s2,ou=first,ou=students,ou=people,%s' % self.base: Entry(username=u's2')}
+        LdapStudent.resolve_dns = classmethod(
+            lambda cls, dns: dict((dn, students[dn]) for dn in dns if dn in students))
+        self.addCleanup(delattr, LdapStudent, 'resolve_dns')
+
+    def tearDown(self):
+        self.logger.removeHandler(self.handler)
+        self.logger.propagate = True
+
+    def patch(self, owner, name, value):
+        self.addCleanup(setattr, owner, name, owner.__dict__[name])
+        setattr(owner, name, value)
+
+    def test_entries(self):
+        dns = ['uid=s1,ou=students,ou=people,%s',
+               #wpisy w poddrzewie modelu są odnajdywane w bazie LDAP
+               'uid=s2,ou=first,ou=students,ou=people,%s',
+               'uid=s3,ou=first,ou=students,ou=people,%s',
+               'cn=c1,ou=studycycles,%s',
+               #cykle kształcenia są wyszukiwane tylko bezpośrednio pod bazowym węzłem
+               'cn=x,cn=c1,ou=studycycles,%s',
+               'cn=pracownicy,ou=u1,ou=units,%s',
+               'ou=other,%s']
+        dns = [dn % self.base for dn in dns]
+        self.assertEqual(LdapSync.syncEntries(dns, self.logger), (True, False))
+        self.assertEqual(self.calls, [('Students', [u's1', u's2']), ('StudyCycles', [u'c1'])])
+        for dn in (dns[2], dns[4], dns[6]):
+            self.assertTrue(any(dn in message for message in self.handler.messages), dn)
+        self.assertEqual(len(self.handler.messages), 3)
+
+
+class MembershipsTestCase(TestCase):
+    def setUp(self):
+        permissions.initialize()
+
+    def employee(self, username):
+        return Employee.objects.create(user=User.objects.create(username=username), isLdapSynced=True)
+
+    def members(self, key):
+        return set(User.objects.filter(groups__name=key).values_list('pk', flat=True))
+
+    def test_department_heads(self):
+        e1 = self.employee('e1')
+        self.assertEqual(permissions.memberships(set([e1.user_id]))[permissions.DEPARTMENT_HEAD_GROUP],
+                         set([e1.user_id]))
+        #grupa jest pomijana, jeśli jednostki nie były synchronizowane
+        self.assertFalse(permissions.DEPARTMENT_HEAD_GROUP in permissions.memberships())
+
+    def test_reconcile(self):
+        e1, e2, e3 = [self.employee(username).user_id for username in ('e1', 'e2', 'e3')]
+        group = permissions.DEPARTMENT_HEAD_GROUP
+        self.assertEqual(permissions.reconcile({group: set([e1, e2])}, 1), (2, 0))
+        self.assertEqual(self.members(group), set([e1, e2]))
+
+        self.assertEqual(permissions.reconcile({group: set([e2, e3])}, 1), (1, 1))
+        self.assertEqual(self.members(group), set([e2, e3]))
+
+        #przynależność do grup nieobecnych w słowniku pozostaje bez zmian
+        self.assertEqual(permissions.reconcile({permissions.STUDENTS_GROUP: set()}, 1), (0, 0))
+        self.assertEqual(self.members(group), set([e2, e3]))
+
+        self.assertEqual(permissions.reconcile({group: set()}, 1), (0, 2))
+        self.assertEqual(self.members(group), set())
+
+
+class SyncTestCase(TestCase):
+    u'''
+    Przeprowadza synchronizację na podstawie wpisów LDAP przygotowanych w pamięci (self.entries, self.employeesIndex).
+    '''
+    base = 'ou=FCS,o=BUT,c=pl'
+
+    def setUp(self):
+        self.logger = logging.getLogger('ldapsync.tests.sync')
+        self.handler = ListHandler()
+        self.logger.addHandler(self.handler)
+        self.logger.setLevel(logging.INFO)
+        self.logger.propagate = False
+        self.lookups = []
+        self.unit = Entry(name=u'Unit 1', head=Entry(username=u'e1'))
+        self.entries = {
+            LdapStudent: [self.student(u's1'), self.student(u's2'), self.student(u's3')],
+            LdapStudyCycle: [self.studyCycle(u'c1', u's1', u's2'), self.studyCycle(u'c2', u's3')],
+            LdapEmployee: [self.employee(u'e1'), self.employee(u'e2')],
+            LdapOrganization: [],
+            LdapOrganizationalUnit: [self.unit],
+        }
+        self.employeesIndex = {}
+        for username in (u'e1', u'e2'):
+            self.employeesIndex[('uid=%s,ou=employees,ou=people,%s' % (username, self.base)).lower()] = self.unit
+        self.patch(ldapsync, 'SYNC_PARALLEL', False)
+        self.patch(LdapSync, '_LdapSync__ldapObjects', classmethod(lambda cls, ldapModel, lookups=None:
+                                                                   self.ldapObjects(ldapModel, lookups)))
+        self.patch(LdapSync, '_LdapSync__fetchEmployeesIndex', staticmethod(lambda: self.employeesIndex))
+        self.patch(LdapSync, '_LdapSync__fetchLdapIds', staticmethod(lambda ldapModel: set(
+            getattr(entry, ldapModel._meta.pk.attname) for entry in self.entries[ldapModel])))
+        self.patch(LdapAuthorities, 'getAuthority', classmethod(lambda cls, name: self.getAuthority(name)))
+
+    def tearDown(self):
+        self.logger.removeHandler(self.handler)
+        self.logger.propagate = True
+
+    def patch(self, owner, name, value):
+        self.addCleanup(setattr, owner, name, owner.__dict__[name] if isinstance(owner, type) else getattr(owner, name))
+        setattr(owner, name, value)
+
+    def student(self, username):
+        return Entry(username=username, firstName=u'First', lastName=username.upper(), email=u'%s@example.org' % username,
+                     modifyTimestamp='20150101000000Z')
+
+    def studyCycle(self, name, *usernames):
+        return Entry(name=name, studentsDnList=[u'uid=%s,ou=students,ou=people,%s' % (username, self.base)
+                                                for username in usernames],
+                     modifyTimestamp='20150101000000Z')
+
+    def employee(self, username):
+        return Entry(username=username, firstName=u'First', lastName=username.upper(), email=u'%s@example.org' % username,
+                     title=u'', position=u'', modifyTimestamp='20150101000000Z')
+
+    def ldapObjects(self, ldapModel, lookups):
+        self.lookups.append((ldapModel, lookups))
+        entries = self.entries[ldapModel]
+        if lookups and 'pk__in' in lookups:
+            entries = [entry for entry in entries if getattr(entry, ldapModel._meta.pk.attname) in lookups['pk__in']]
+        if lookups and 'modifyTimestamp__gte' in lookups:
+            entries = [entry for entry in entries if entry.modifyTimestamp >= lookups['modifyTimestamp__gte']]
+        return list(entries)
+
+    def getAuthority(self, name):
+        raise models.DoesNotExist(name)
+
+    def groupMembers(self, key):
+        return set(User.objects.filter(groups__name=key).values_list('username', flat=True))
+
+    def synced(self, model):
+        return dict(model.objects.values_list('user__username', 'isLdapSynced'))
+
+    def test_students(self):
+        #użytkownik bez obiektu Student otrzymuje go podczas synchronizacji
+        User.objects.create(username=u's1', first_name=u'First', last_name=u'S1', email=u's1@example.org')
+        LdapSync.sync(self.logger)
+        self.assertEqual(self.synced(Student), {u's1': True, u's2': True, u's3': True})
+        self.assertEqual(User.objects.get(username=u's2').last_name, u'S2')
+        self.assertIn(u'Zsynchronizowano 3 obiektów Student (w tym utworzono: 3, zmieniono: 0, bez zmian: 0), '
+                      u'pozostało niezsynchronizowanych: 0.', self.handler.messages)
+        self.assertIn(u'Zaktualizowano dane 3 użytkowników (w tym utworzono: 2, zmieniono: 0, bez zmian: 1)',
+                      self.handler.messages)
+
+        #student usunięty z bazy LDAP jest oznaczany jako niezsynchronizowany, a po powrocie - ponownie zsynchronizowany
+        removed = self.entries[LdapStudent].pop()
+        LdapSync.sync(self.logger)
+        self.assertEqual(self.synced(Student), {u's1': True, u's2': True, u's3': False})
+        self.entries[LdapStudent].append(removed)
+        del self.handler.messages[:]
+        LdapSync.sync(self.logger)
+        self.assertEqual(self.synced(Student), {u's1': True, u's2': True, u's3': True})
+        self.assertIn(u'Zsynchronizowano 3 obiektów Student (w tym utworzono: 0, zmieniono: 1, bez zmian: 2), '
+                      u'pozostało niezsynchronizowanych: 0.', self.handler.messages)
+        self.assertEqual(Student.objects.count(), 3)
+
+    def test_incremental(self):
+        #bez znacznika poprzedniej synchronizacji przeprowadzana jest pełna synchronizacja
+        LdapSync.sync(self.logger, incremental=True)
+        self.assertIn((LdapStudent, None), self.lookups)
+        since = SyncState.load().highWaterMark
+        self.assertIsNotNone(since)
+
+        #synchronizowane są jedynie wpisy zmienione od poprzedniej synchronizacji
+        del self.lookups[:]
+        self.entries[LdapStudent][0].lastName = u'Changed'
+        self.entries[LdapStudent][0].modifyTimestamp = '29990101000000Z'
+        self.entries[LdapStudent][1].lastName = u'Stale'
+        removed = self.entries[LdapStudent].pop()
+        LdapSync.sync(self.logger, incremental=True)
+        self.assertIn((LdapStudent, {'modifyTimestamp__gte': since}), self.lookups)
+        self.assertEqual(User.objects.get(username=u's1').last_name, u'Changed')
+        self.assertEqual(User.objects.get(username=u's2').last_name, u'S2')
+        self.assertEqual(self.synced(Student), {u's1': True, u's2': True, u's3': True})
+
+        #wpisy usunięte z bazy LDAP są wyszukiwane co SYNC_SWEEP_INTERVAL sekund
+        self.patch(ldapsync, 'SYNC_SWEEP_INTERVAL', 0)
+        LdapSync.sync(self.logger, incremental=True)
+        self.assertEqual(self.synced(Student), {u's1': True, u's2': True, u's3': False})
+        self.assertEqual(Student.objects.get(user__username=removed.username).studyCycles.count(), 0)
+
+    def memberships(self):
+        return dict(((username, name), pk) for pk, username, name in Student.studyCycles.through.objects.values_list(
+            'pk', 'student__user__username', 'studycycle__ldapId'))
+
+    def test_study_cycles(self):
+        LdapSync.sync(self.logger)
+        memberships = self.memberships()
+        self.assertEqual(set(memberships), set([(u's1', u'c1'), (u's2', u'c1'), (u's3', u'c2')]))
+
+        #brakujące powiązania są dodawane, a nadmiarowe usuwane, bez zmieniania pozostałych
+        self.entries[LdapStudyCycle][0] = self.studyCycle(u'c1', u's1', u's3')
+        del self.handler.messages[:]
+        LdapSync.sync(self.logger)
+        changed = self.memberships()
+        self.assertEqual(set(changed), set([(u's1', u'c1'), (u's3', u'c1'), (u's3', u'c2')]))
+        self.assertEqual(changed[(u's1', u'c1')], memberships[(u's1', u'c1')])
+        self.assertEqual(changed[(u's3', u'c2')], memberships[(u's3', u'c2')])
+        self.assertIn(u'Uzgodniono powiązania student-cykl kształcenia (dodano: 1, usunięto: 1, bez zmian: 2)',
+                      self.handler.messages)
+
+    def units(self):
+        return dict(Employee.objects.values_list('user__username', 'organizationalUnit__ldapId'))
+
+    def test_organizational_units(self):
+        LdapSync.sync(self.logger)
+        self.assertEqual(self.units(), {u'e1': u'Unit 1', u'e2': u'Unit 1'})
+
+        #pracownik usunięty z indeksu nie należy do żadnej jednostki, pozostali są zapisywani tylko po zmianie
+        e2 = ('uid=e2,ou=employees,ou=people,%s' % self.base).lower()
+        del self.employeesIndex[e2]
+        del self.handler.messages[:]
+        LdapSync.sync(self.logger)
+        self.assertEqual(self.units(), {u'e1': u'Unit 1', u'e2': None})
+        self.assertIn(u'Uzgodniono przynależność pracowników do jednostek organizacyjnych (zmieniono: 1, bez zmian: 1, '
+                      u'nie odnaleziono w bazie: 0)', self.handler.messages)
+
+        #pracownicy przeniesieni do nowej jednostki
+        unit = Entry(name=u'Unit 2', head=None)
+        self.entries[LdapOrganizationalUnit].append(unit)
+        for dn in self.employeesIndex.keys() + [e2]:
+            self.employeesIndex[dn] = unit
+        LdapSync.sync(self.logger)
+        self.assertEqual(self.units(), {u'e1': u'Unit 2', u'e2': u'Unit 2'})
+
+    def test_commit_batches(self):
+        commitBatches = LdapSync._LdapSync__commitBatches
+        self.assertEqual(list(commitBatches(range(5))), [range(5)])
+        self.patch(ldapsync, 'SYNC_COMMIT_BATCH_SIZE', 2)
+        self.assertEqual(list(commitBatches(range(5))), [[0, 1], [2, 3], [4]])
+
+        #błąd w jednym fragmencie nie wycofuje fragmentów zapisanych wcześniej
+        self.patch(ldapsync, 'SYNC_COMMIT_BATCH_SIZE', 1)
+        self.entries[LdapEmployee][1] = BrokenEntry(username=u'e2')
+        self.assertRaises(ValueError, LdapSync.sync, self.logger)
+        self.assertEqual(self.synced(Employee), {u'e1': True})
+
+    def test_phase_transaction(self):
+        #bez SYNC_COMMIT_BATCH_SIZE błąd wycofuje cały etap, ale nie etapy wykonane wcześniej
+        self.entries[LdapEmployee][1] = BrokenEntry(username=u'e2')
+        self.assertRaises(ValueError, LdapSync.sync, self.logger)
+        self.assertEqual(self.synced(Employee), {})
+        self.assertEqual(self.synced(Student), {u's1': True, u's2': True, u's3': True})
+
+    def test_staged(self):
+        LdapSync.sync(self.logger, staged=True)
+        self.assertEqual(self.synced(Student), {u's1': True, u's2': True, u's3': True})
+        self.assertEqual(self.units(), {u'e1': u'Unit 1', u'e2': u'Unit 1'})
+
+        #migawka bez wpisów studentów nie jest zapisywana w bazie
+        self.entries[LdapStudent] = []
+        self.entries[LdapEmployee][0].title = u'dr'
+        self.assertRaises(SnapshotError, LdapSync.sync, self.logger, staged=True)
+        self.assertEqual(self.synced(Student), {u's1': True, u's2': True, u's3': True})
+        self.assertEqual(Employee.objects.get(user__username=u'e1').title, u'')
+
+        #synchronizacja przyrostowa może nie zwrócić żadnych wpisów
+        LdapSync.sync(self.logger, incremental=True, staged=True)
+        self.assertEqual(Employee.objects.get(user__username=u'e1').title, u'')
+
+    def test_unchanged(self):
+        LdapSync.sync(self.logger)
+        saves = []
+        save = Employee.save
+        Employee.save = lambda instance, *args, **kwargs: (saves.append(kwargs.get('update_fields')),
+                                                           save(instance, *args, **kwargs))
+        self.addCleanup(delattr, Employee, 'save')
+
+        #ponowna synchronizacja niezmienionych wpisów niczego nie zapisuje
+        del self.handler.messages[:]
+        LdapSync.sync(self.logger)
+        self.assertEqual(saves, [])
+        self.assertIn(u'Zsynchronizowano 2 obiektów Employee (w tym utworzono: 0, zmieniono: 0, bez zmian: 2), '
+                      u'pozostało niezsynchronizowanych: 0.', self.handler.messages)
+        self.assertIn(u'Zaktualizowano dane 2 użytkowników (w tym utworzono: 0, zmieniono: 0, bez zmian: 2)',
+                      self.handler.messages)
+
+        #zapisywane są jedynie zmienione pola zmienionych obiektów
+        self.entries[LdapEmployee][0].title = u'dr'
+        del self.handler.messages[:]
+        LdapSync.sync(self.logger)
+        self.assertEqual(saves, [['title']])
+        self.assertEqual(Employee.objects.get(user__username=u'e1').title, u'dr')
+        self.assertIn(u'Zsynchronizowano 2 obiektów Employee (w tym utworzono: 0, zmieniono: 1, bez zmian: 1), '
+                      u'pozostało niezsynchronizowanych: 0.', self.handler.messages)
+
+    def test_department_head(self):
+        LdapSync.sync(self.logger)
+        self.assertEqual(OrganizationalUnit.objects.get(ldapId=u'Unit 1').head.user.username, u'e1')
+        self.assertEqual(self.groupMembers(permissions.DEPARTMENT_HEAD_GROUP), set([u'e1']))
+
+        #jednostka zachowuje dotychczasowego kierownika, ale nie należy on już do grupy kierowników katedr
+        self.unit.head = None
+        LdapSync.sync(self.logger)
+        self.assertEqual(OrganizationalUnit.objects.get(ldapId=u'Unit 1').head.user.username, u'e1')
+        self.assertEqual(self.groupMembers(permissions.DEPARTMENT_HEAD_GROUP), set())
+
+        #podobnie, jeśli jednostki nie ma w bazie LDAP
+        self.unit.head = Entry(username=u'e2')
+        LdapSync.sync(self.logger)
+        self.assertEqual(self.groupMembers(permissions.DEPARTMENT_HEAD_GROUP), set([u'e2']))
+        self.entries[LdapOrganizationalUnit] = []
+        LdapSync.sync(self.logger)
+        self.assertEqual(self.groupMembers(permissions.DEPARTMENT_HEAD_GROUP), set())
+
+    def test_dependents(self):
+        LdapSync.sync(self.logger)
+        #bez synchronizacji jednostek grupa kierowników katedr pozostaje bez zmian
+        self.unit.head = None
+        LdapSync.syncDependents(self.logger, units=False, authorities=False)
+        self.assertEqual(self.groupMembers(permissions.DEPARTMENT_HEAD_GROUP), set([u'e1']))
+        LdapSync.syncDependents(self.logger)
+        self.assertEqual(self.groupMembers(permissions.DEPARTMENT_HEAD_GROUP), set())
+
+
+class EmployeesIndexTestCase(TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        self.saved = (models.time, models.LdapOrganizationalUnit.__dict__['objects'])
+        models.time = Entry(time=lambda: self.now)
+        unit1 = Entry(dn='ou=u1,ou=units,ou=FCS,o=BUT,c=pl')
+        unit2 = Entry(dn='ou=u2,ou=units,ou=FCS,o=BUT,c=pl')
+        self.units = StubManager([unit1, unit2])
+        self.groups = StubManager([
+            Entry(dn='cn=pracownicy,' + unit1.dn, members=['uid=e1,ou=employees', 'uid=e2,ou=employees']),
+            Entry(dn='cn=pracownicy,' + unit2.dn, members=['uid=e2,ou=employees', 'uid=e3,ou=employees'])])
+        models.LdapOrganizationalUnit.objects = self.units
+        models.LdapOrganizationalMemebersGroup.scoped = staticmethod(lambda baseDn: Entry(objects=self.groups))
+        models.LdapOrganizationalUnit.clearEmployeesIndex()
+
+    def tearDown(self):
+        models.time, models.LdapOrganizationalUnit.objects = self.saved
+        del models.LdapOrganizationalMemebersGroup.scoped
+        models.LdapOrganizationalUnit.clearEmployeesIndex()
+
+    def test_index(self):
+        index = models.LdapOrganizationalUnit.getEmployeesIndex()
+        self.assertEqual(dict((dn, unit.dn[3:5]) for dn, unit in index.items()),
+                         {'uid=e1,ou=employees': 'u1', 'uid=e2,ou=employees': 'u1', 'uid=e3,ou=employees': 'u2'})
+        self.assertEqual(self.units.queries, 1)
+        self.assertEqual(self.groups.queries, 1)
+
+    def test_ttl(self):
+        index = models.LdapOrganizationalUnit.getEmployeesIndex()
+        self.now += models.LDAP_EMPLOYEES_INDEX_TTL - 1
+        self.assertTrue(models.LdapOrganizationalUnit.getEmployeesIndex() is index)
+        self.assertEqual(self.units.queries, 1)
+
+        #po upływie LDAP_EMPLOYEES_INDEX_TTL indeks jest budowany od nowa
+        self.now += 1
+        self.assertFalse(models.LdapOrganizationalUnit.getEmployeesIndex() is index)
+        self.assertEqual(self.units.queries, 2)
+
+    def test_clear(self):
+        index = models.LdapOrganizationalUnit.getEmployeesIndex()
+        models.LdapOrganizationalUnit.clearEmployeesIndex()
+        self.assertFalse(models.LdapOrganizationalUnit.getEmployeesIndex() is index)
+        self.assertEqual(self.units.queries, 2)
+        self.assertEqual(self.groups.queries, 2)